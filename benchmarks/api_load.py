@@ -0,0 +1,187 @@
+"""
+Load benchmark for the HTTP API in modules.api.
+
+Writes a synthetic universe to a temporary folder, serves it with
+python -m modules.api on localhost and fires concurrent requests at a mix of
+endpoints. Each server setting is measured in three phases:
+    cold: first request for every url, nothing cached yet.
+    warm: the same urls again, served from the response cache.
+    revalidate: the same urls with If-None-Match, answered with 304s.
+
+The whole run is repeated with the response cache turned off, to show what
+caching buys.
+
+Run from the project root:
+    python -m benchmarks.api_load --tickers 200 --requests 2000 --concurrency 32
+"""
+
+from modules.files import save_json
+from benchmarks.synthetic import make_universe
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def write_universe(n_tickers, n_years, path):
+    """
+    Save a synthetic universe to path the way company.save_statements() does.
+
+    returns: list of tickers.
+    """
+    companies = make_universe(n_tickers, n_years = n_years)
+    for co in companies:
+        for key, statement in co.statements.items():
+            statement['currency'] = co.currency
+            save_json(statement, path + co.ticker + '_' + key + '.json')
+
+    return [co.ticker for co in companies]
+
+def get_urls(tickers, n_requests):
+    """
+    Build a request mix weighted toward per-ticker reads, like a dashboard.
+    """
+    mix = []
+    for i, ticker in enumerate(tickers):
+        mix.append('/metrics/{}'.format(ticker))
+        mix.append('/statements/{}/is'.format(ticker))
+        if i % 10 == 0:
+            mix.append('/segment?tickers={}'.format(','.join(tickers[i:i + 5])))
+    mix += ['/tickers', '/screen?where=net_margin,>,0.1&last_years=3', '/screen?where=current_ratio,>,1.5&how=any']
+
+    return [mix[i % len(mix)] for i in range(n_requests)]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(path, port, cache_size):
+    """
+    Start python -m modules.api in a subprocess and wait for it to answer.
+    """
+    from urllib.request import urlopen
+
+    server = subprocess.Popen([sys.executable, '-m', 'modules.api', '--port', str(port), '--path', path,
+                                '--cache-size', str(cache_size), '--log-level', 'WARNING'], cwd = ROOT_DIR)
+    for i in range(100):
+        try:
+            urlopen('http://127.0.0.1:{}/tickers'.format(port), timeout = 1)
+            return server
+        except OSError:
+            time.sleep(0.1)
+
+    server.kill()
+    raise RuntimeError('API server did not start on port {}'.format(port))
+
+async def fire(port, urls, concurrency, etags = None):
+    """
+    Request every url with at most concurrency requests in flight.
+
+    returns: tuple of (latencies in seconds, dict of url to ETag, status counts).
+    """
+    from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+
+    AsyncHTTPClient.configure(None, max_clients = concurrency)
+    client = AsyncHTTPClient()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    seen_etags = dict()
+    statuses = dict()
+
+    async def one(url):
+        headers = {'Accept-Encoding':'gzip'}
+        if etags != None and url in etags.keys():
+            headers['If-None-Match'] = etags[url]
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.fetch('http://127.0.0.1:{}{}'.format(port, url), headers = headers, decompress_response = True)
+                code = response.code
+                seen_etags[url] = response.headers.get('Etag')
+            except HTTPClientError as e:
+                code = e.code
+            latencies.append(time.perf_counter() - start)
+            statuses[code] = statuses.get(code, 0) + 1
+
+    await asyncio.gather(*[one(x) for x in urls])
+
+    return latencies, seen_etags, statuses
+
+def summarize(phase, latencies, seconds, statuses):
+    latencies = sorted(latencies)
+    result = dict(phase = phase,
+                    requests = len(latencies),
+                    requests_per_second = len(latencies) / seconds,
+                    p50_ms = statistics.median(latencies) * 1000,
+                    p95_ms = latencies[int(len(latencies) * 0.95) - 1] * 1000,
+                    p99_ms = latencies[int(len(latencies) * 0.99) - 1] * 1000,
+                    statuses = {str(k):v for k, v in statuses.items()})
+    print('{:<24} {:>8.0f} req/s   p50 {:>7.2f} ms   p95 {:>7.2f} ms   p99 {:>7.2f} ms   {}'.format(
+        phase, result['requests_per_second'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['statuses']))
+
+    return result
+
+def run_phase(phase, port, urls, concurrency, etags = None):
+    start = time.perf_counter()
+    latencies, seen_etags, statuses = asyncio.run(fire(port, urls, concurrency, etags))
+
+    return summarize(phase, latencies, time.perf_counter() - start, statuses), seen_etags
+
+def run(n_tickers = 100, n_years = 10, n_requests = 1000, concurrency = 16, cache_sizes = [512, 0]):
+    """
+    Serve a synthetic universe and measure every phase for each cache size.
+
+    returns: dict with parameters and a list of phase results.
+    """
+    workdir = tempfile.mkdtemp(prefix = 'financial_reporting_api_') + os.sep
+    results = []
+    try:
+        tickers = write_universe(n_tickers, n_years, workdir)
+        # Unique urls first, so the cold phase really is cold
+        urls = get_urls(tickers, n_requests)
+        unique_urls = list(dict.fromkeys(urls))
+
+        for cache_size in cache_sizes:
+            port = free_port()
+            server = start_server(workdir, port, cache_size)
+            label = 'cache {}'.format(cache_size) if cache_size > 0 else 'no cache'
+            try:
+                cold, etags = run_phase('{} cold'.format(label), port, unique_urls, concurrency)
+                warm, etags = run_phase('{} warm'.format(label), port, urls, concurrency)
+                revalidate, etags = run_phase('{} revalidate'.format(label), port, urls, concurrency, etags)
+            finally:
+                server.terminate()
+                server.wait()
+            for result in [cold, warm, revalidate]:
+                result['cache_size'] = cache_size
+                results.append(result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors = True)
+
+    return dict(parameters = dict(tickers = n_tickers, years = n_years, requests = n_requests, concurrency = concurrency),
+                results = results)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Load test the HTTP API on a synthetic universe.')
+    parser.add_argument('--tickers', type = int, default = 100)
+    parser.add_argument('--years', type = int, default = 10)
+    parser.add_argument('--requests', type = int, default = 1000)
+    parser.add_argument('--concurrency', type = int, default = 16)
+    parser.add_argument('--output', type = str, default = None, help = 'Optional path to write JSON results to.')
+    args = parser.parse_args()
+
+    results = run(n_tickers = args.tickers, n_years = args.years, n_requests = args.requests, concurrency = args.concurrency)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
@@ -0,0 +1,78 @@
+"""
+Import-time benchmark.
+
+Times how long a fresh python process takes to import each module below, and
+lists which heavy third-party packages each import dragged in. Batch workers
+and the web app pay this cost on every start, so it should stay small.
+
+Run from the project root:
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --repeat 10 --output import_times.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Modules a cold start should be able to import cheaply
+TARGETS = ['modules.classes', 'modules.universe', 'modules.screening', 'modules.files']
+
+# Packages that should only load when scraping, plotting or forex code runs
+HEAVY_PACKAGES = ['selenium', 'bs4', 'plotly', 'pandas', 'forex_python', 'requests']
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in a fresh interpreter so nothing is already cached in sys.modules
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {target}
+elapsed = time.perf_counter() - start
+print(json.dumps(dict(seconds = elapsed, loaded = [x for x in {heavy} if x in sys.modules])))
+"""
+
+def time_import(target, repeat = 5):
+    """
+    Import target in repeat fresh processes.
+
+    returns: dict with the best and mean seconds plus the heavy packages loaded.
+    """
+    timings = []
+    loaded = []
+    for i in range(repeat):
+        probe = PROBE.format(target = target, heavy = HEAVY_PACKAGES)
+        result = subprocess.run([sys.executable, '-c', probe], cwd = ROOT_DIR, capture_output = True, text = True, check = True)
+        measured = json.loads(result.stdout.strip().splitlines()[-1])
+        timings.append(measured['seconds'])
+        loaded = measured['loaded']
+
+    return dict(module = target,
+                best_seconds = min(timings),
+                mean_seconds = sum(timings) / len(timings),
+                heavy_packages_loaded = loaded)
+
+def run(targets = TARGETS, repeat = 5):
+    """
+    Time every target module and print a summary table.
+    """
+    results = [time_import(x, repeat) for x in targets]
+
+    for r in results:
+        print('{:<22} best {:>7.1f} ms   mean {:>7.1f} ms   heavy: {}'.format(
+            r['module'], r['best_seconds'] * 1000, r['mean_seconds'] * 1000, ', '.join(r['heavy_packages_loaded']) or 'none'))
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Time cold imports of this package.')
+    parser.add_argument('--repeat', type = int, default = 5, help = 'Fresh processes per module.')
+    parser.add_argument('--output', type = str, default = None, help = 'Optional path of a JSON file to write results to.')
+    args = parser.parse_args()
+
+    results = run(repeat = args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
@@ -0,0 +1,204 @@
+"""
+Benchmark suite for the analysis hot paths.
+
+Every benchmark runs against synthetic companies (see benchmarks.synthetic),
+so results are comparable between machines and runs and never touch the
+network or the output folder. Each one is timed over several repeats and run
+once more under tracemalloc to record peak memory.
+
+Results are written to a JSON file. Pass a previous results file with
+--compare to flag regressions.
+
+Run from the project root:
+    python -m benchmarks.run_benchmarks --tickers 200 --years 10
+    python -m benchmarks.run_benchmarks --compare bench_results_main.json
+"""
+
+from definitions import ASSET_PATH
+from modules.files import save_json, import_statement_json
+from benchmarks.synthetic import make_universe, make_cpiu, CURRENCIES
+
+import argparse
+import copy
+import json
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from functools import reduce
+
+import numpy as np
+
+def measure(setup, func, repeat = 5):
+    """
+    Time func(setup()) repeat times, then run it once more with tracemalloc on.
+
+    setup() isn't timed. It builds a fresh copy of whatever func mutates.
+
+    returns: dict of timings in seconds and peak traced memory in bytes.
+    """
+    timings = []
+    for i in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        func(state)
+        timings.append(time.perf_counter() - start)
+
+    state = setup()
+    tracemalloc.start()
+    func(state)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return dict(best_seconds = min(timings),
+                mean_seconds = statistics.mean(timings),
+                median_seconds = statistics.median(timings),
+                peak_bytes = peak)
+
+def get_benchmarks(companies, workdir, cpiu):
+    """
+    Build the (name, setup, func) list of benchmarks over a synthetic universe.
+    """
+    def fresh():
+        return copy.deepcopy(companies)
+
+    def calculated():
+        state = copy.deepcopy(companies)
+        for co in state:
+            co.calculate_metrics()
+        return state
+
+    # Statement files written once, up front, for the import benchmark
+    saved = []
+    for co in companies:
+        for key, statement in co.statements.items():
+            filepath = os.path.join(workdir, '{}_{}.json'.format(co.ticker, key))
+            save_json(statement, filepath)
+            saved.append(filepath)
+
+    def save_all(state):
+        for co in state:
+            for key, statement in co.statements.items():
+                save_json(statement, os.path.join(workdir, 'save_{}_{}.json'.format(co.ticker, key)))
+
+    def convert_all(state):
+        for co in state:
+            if co.currency != 'USD':
+                co.convert_currency(co.currency, 'USD')
+
+    def plot_all(state):
+        from modules.plotting import plot_companies
+        plot_companies(state[:50], 'net_margin')
+        for co in state[:20]:
+            co.plot(['gross_margin','operating_margin','net_margin'])
+
+    benchmarks = [
+        ('import_statement_json', lambda: saved, lambda state: [import_statement_json(x) for x in state]),
+        ('save_json', lambda: companies, save_all),
+        ('align_statements', fresh, lambda state: [co.align_statements() for co in state]),
+        ('calculate_metrics', fresh, lambda state: [co.calculate_metrics() for co in state]),
+        ('convert_currency', fresh, convert_all),
+        ('normalize_statements', fresh, lambda state: [co.normalize_statements(cpiu = cpiu) for co in state]),
+        ('sequential_transforms', fresh, lambda state: [(co.normalize_statements(cpiu = cpiu), co.calculate_metrics()) for co in state]),
+        ('fused_plan', fresh, lambda state: [co.plan().align().normalize(cpiu = cpiu).metrics().execute(cache = False) for co in state]),
+        ('add_companies', fresh, lambda state: reduce(lambda a, b: a + b, state)),
+        ('compact_statements', fresh, lambda state: [co.compact_statements() for co in state]),
+        ('plotting', calculated, plot_all)
+    ]
+
+    return benchmarks
+
+def run(n_tickers = 100, n_years = 10, extra_rows = 20, missing_rate = 0.1, currencies = CURRENCIES, repeat = 5, only = None):
+    """
+    Build a synthetic universe and run every benchmark on it.
+
+    returns: dict with run metadata and a list of benchmark results.
+    """
+    companies = make_universe(n_tickers, n_years = n_years, extra_rows = extra_rows,
+                                missing_rate = missing_rate, currencies = currencies)
+    # convert_currency() needs a conversion table in the assets folder
+    missing_tables = [x for x in set(currencies) if x != 'USD' and not os.path.exists(ASSET_PATH + x.lower() + '_to_usd.json')]
+    cpiu = make_cpiu()
+    workdir = tempfile.mkdtemp(prefix = 'financial_reporting_bench_')
+
+    results = []
+    try:
+        for name, setup, func in get_benchmarks(companies, workdir, cpiu):
+            if only != None and name not in only:
+                continue
+            if name == 'convert_currency' and len(missing_tables) > 0:
+                results.append(dict(name = name, skipped = 'no conversion table for {}'.format(', '.join(missing_tables))))
+                continue
+            try:
+                result = measure(setup, func, repeat = repeat)
+            except ImportError as e:
+                # plotting needs plotly. Report it instead of failing the whole run.
+                results.append(dict(name = name, skipped = str(e)))
+                continue
+            result['name'] = name
+            results.append(result)
+            print('{:<24} best {:>9.2f} ms   median {:>9.2f} ms   peak {:>8.1f} MB'.format(
+                name, result['best_seconds'] * 1000, result['median_seconds'] * 1000, result['peak_bytes'] / 1e6))
+    finally:
+        shutil.rmtree(workdir, ignore_errors = True)
+
+    return dict(timestamp = datetime.now().isoformat(timespec = 'seconds'),
+                python = platform.python_version(),
+                numpy = np.__version__,
+                machine = platform.platform(),
+                parameters = dict(tickers = n_tickers, years = n_years, extra_rows = extra_rows,
+                                missing_rate = missing_rate, currencies = currencies, repeat = repeat),
+                results = results)
+
+def compare(current, previous, threshold = 0.2):
+    """
+    Print benchmarks whose median time or peak memory grew by more than
+    threshold (0.2 = 20%) relative to a previous results dict.
+
+    returns: list of regressed benchmark names.
+    """
+    previous_results = {x['name']:x for x in previous['results'] if 'skipped' not in x.keys()}
+
+    regressions = []
+    for result in current['results']:
+        if 'skipped' in result.keys() or result['name'] not in previous_results.keys():
+            continue
+        before = previous_results[result['name']]
+        for measure_name in ['median_seconds', 'peak_bytes']:
+            if before[measure_name] > 0 and result[measure_name] > before[measure_name] * (1 + threshold):
+                print('REGRESSION {}: {} {:.4g} -> {:.4g}'.format(result['name'], measure_name, before[measure_name], result[measure_name]))
+                regressions.append(result['name'])
+
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark analysis hot paths on synthetic companies.')
+    parser.add_argument('--tickers', type = int, default = 100)
+    parser.add_argument('--years', type = int, default = 10)
+    parser.add_argument('--extra-rows', type = int, default = 20)
+    parser.add_argument('--missing-rate', type = float, default = 0.1)
+    parser.add_argument('--currencies', type = str, default = ','.join(CURRENCIES), help = 'Comma separated currency codes.')
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--only', type = str, default = None, help = 'Comma separated benchmark names to run.')
+    parser.add_argument('--output', type = str, default = 'bench_results.json')
+    parser.add_argument('--compare', type = str, default = None, help = 'Previous results file to check for regressions.')
+    parser.add_argument('--threshold', type = float, default = 0.2)
+    args = parser.parse_args()
+
+    current = run(n_tickers = args.tickers, n_years = args.years, extra_rows = args.extra_rows,
+                    missing_rate = args.missing_rate, currencies = args.currencies.split(','),
+                    repeat = args.repeat, only = None if args.only == None else args.only.split(','))
+
+    with open(args.output, 'w') as f:
+        json.dump(current, f, indent = 2)
+    print('Results written to {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(current, json.load(f), args.threshold)
+        if len(regressions) > 0:
+            raise SystemExit(1)
@@ -0,0 +1,199 @@
+"""
+Check modules.scheduler against a local stub server, without touching any
+real site.
+
+The stub answers on localhost:
+    /ok: 200 every time.
+    /flaky/<n>/<key>: 503 for the first n requests of each key, then 200.
+    /limited/<key>: 429 with Retry-After: 0 on the first request, then 200.
+    /slow: sleeps longer than the scheduler's timeout.
+
+Each check builds its own request_scheduler with short backoff, counts how
+many requests the stub saw and prints whether the scheduler behaved:
+    rate: requests past the burst are spaced by the host's rate.
+    retry: transient statuses are retried until they succeed.
+    give up: a host that keeps failing returns its last response after retries.
+    retry after: 429 responses honor Retry-After.
+    timeout: timeouts are retried, then raised.
+    call: call() retries retry_on exceptions and raises anything else at once.
+    cache: a cached response is served without a request.
+
+Run from the project root:
+    python -m benchmarks.scheduler_stub
+"""
+
+from modules.scheduler import request_scheduler
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import logging
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+class stub_handler(BaseHTTPRequestHandler):
+    """
+    Answers requests as described in the module docstring and counts them by path.
+    """
+    hits = dict()
+    lock = threading.Lock()
+    slow_seconds = 1.0
+
+    def do_GET(self):
+        with self.lock:
+            self.hits[self.path] = self.hits.get(self.path, 0) + 1
+            seen = self.hits[self.path]
+
+        parts = self.path.strip('/').split('/')
+        status, headers = 200, dict()
+        if parts[0] == 'flaky' and seen <= int(parts[1]):
+            status = 503
+        elif parts[0] == 'limited' and seen == 1:
+            status, headers = 429, {'Retry-After':'0'}
+        elif parts[0] == 'slow':
+            time.sleep(self.slow_seconds)
+
+        body = '{{"path": "{}", "seen": {}}}'.format(self.path, seen).encode('utf-8')
+        try:
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up on a slow response
+            pass
+
+    def log_message(self, format, *args):
+        return None
+
+def start_stub():
+    """
+    Serve the stub on a free localhost port in a daemon thread.
+
+    returns: tuple of (server, base url).
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), stub_handler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+def hits(path):
+    return stub_handler.hits.get(path, 0)
+
+def check_rate(base, rate = 20, burst = 2, n = 12):
+    """
+    n requests to one host take at least (n - burst) / rate seconds.
+    """
+    scheduler = request_scheduler(rates = {base[len('http://'):]:(rate, burst)}, cache_path = None)
+    start = time.perf_counter()
+    for i in range(n):
+        scheduler.get(base + '/ok')
+    seconds = time.perf_counter() - start
+    expected = (n - burst) / rate
+
+    return seconds >= expected * 0.95, '{} requests in {:.2f}s, at least {:.2f}s expected'.format(n, seconds, expected)
+
+def check_retry(base, failures = 2):
+    scheduler = request_scheduler(retries = 3, backoff = 0.01, cache_path = None)
+    path = '/flaky/{}/retry'.format(failures)
+    response = scheduler.get(base + path)
+
+    return response.status_code == 200 and hits(path) == failures + 1, 'status {} after {} requests'.format(response.status_code, hits(path))
+
+def check_give_up(base, retries = 3):
+    scheduler = request_scheduler(retries = retries, backoff = 0.01, cache_path = None)
+    path = '/flaky/100/give_up'
+    response = scheduler.get(base + path)
+
+    return response.status_code == 503 and hits(path) == retries + 1, 'status {} after {} requests'.format(response.status_code, hits(path))
+
+def check_retry_after(base):
+    # A large backoff shows Retry-After: 0 was honored instead
+    scheduler = request_scheduler(retries = 1, backoff = 30, cache_path = None)
+    path = '/limited/retry_after'
+    start = time.perf_counter()
+    response = scheduler.get(base + path)
+    seconds = time.perf_counter() - start
+
+    return response.status_code == 200 and seconds < 5, 'status {} in {:.2f}s'.format(response.status_code, seconds)
+
+def check_timeout(base, retries = 1):
+    import requests
+
+    scheduler = request_scheduler(retries = retries, backoff = 0.01, timeout = stub_handler.slow_seconds / 5, cache_path = None)
+    try:
+        scheduler.get(base + '/slow')
+    except requests.Timeout:
+        return hits('/slow') == retries + 1, 'raised Timeout after {} requests'.format(hits('/slow'))
+
+    return False, 'did not raise'
+
+def check_call():
+    scheduler = request_scheduler(retries = 3, backoff = 0.01, cache_path = None)
+    attempts = dict(transient = 0, bug = 0)
+
+    def transient():
+        attempts['transient'] += 1
+        if attempts['transient'] < 3:
+            raise ConnectionError('stub connection dropped')
+        return 'ok'
+
+    def bug():
+        attempts['bug'] += 1
+        raise ValueError('stub programming error')
+
+    result = scheduler.call('stub', transient)
+    try:
+        scheduler.call('stub', bug)
+    except ValueError:
+        pass
+
+    return result == 'ok' and attempts == dict(transient = 3, bug = 1), 'attempts {}'.format(attempts)
+
+def check_cache(base):
+    cache_path = tempfile.mkdtemp(prefix = 'financial_reporting_cache_') + '/'
+    try:
+        scheduler = request_scheduler(cache_path = cache_path)
+        first = scheduler.get(base + '/ok?cache')
+        second = scheduler.get(base + '/ok?cache')
+    finally:
+        shutil.rmtree(cache_path, ignore_errors = True)
+
+    return second.from_cache and hits('/ok?cache') == 1 and second.text == first.text, 'second from cache: {}, requests {}'.format(second.from_cache, hits('/ok?cache'))
+
+def run():
+    """
+    Run every check against a fresh stub.
+
+    returns: dict mapping check name to (passed, detail).
+    """
+    server, base = start_stub()
+    try:
+        results = {'rate':check_rate(base),
+                    'retry':check_retry(base),
+                    'give up':check_give_up(base),
+                    'retry after':check_retry_after(base),
+                    'timeout':check_timeout(base),
+                    'call':check_call(),
+                    'cache':check_cache(base)}
+    finally:
+        server.shutdown()
+
+    for name, (passed, detail) in results.items():
+        print('{:<12} {:<5} {}'.format(name, 'ok' if passed else 'FAIL', detail))
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Check the request scheduler against a local stub server.')
+    parser.add_argument('--log-level', type = str, default = 'ERROR', help = 'WARNING shows every retry.')
+    args = parser.parse_args()
+    logging.basicConfig(level = args.log_level.upper(), format = '%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    results = run()
+    sys.exit(0 if all(x[0] for x in results.values()) else 1)
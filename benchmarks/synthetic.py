@@ -0,0 +1,141 @@
+"""
+Synthetic company generator for benchmarks.
+
+Builds company objects shaped exactly like ones scraped from Yahoo Finance:
+year lists with a ttm column, newest first, and rows that satisfy the
+usual accounting identities. Nothing touches the network or the output folder.
+
+Example:
+    companies = make_universe(500, n_years = 10, extra_rows = 40, missing_rate = 0.1)
+"""
+
+from modules.classes import company
+from modules.cleaning import adjust_date
+
+import numpy as np
+
+# Currencies with conversion tables in the assets folder
+CURRENCIES = ['USD', 'EUR', 'JPY', 'KRW', 'TWD']
+
+# Rows calculate_metrics() handles being absent. Dropped at missing_rate.
+OPTIONAL_ROWS = ['inventory', 'research_and_development', 'selling_general_and_administrative']
+
+def make_years(n_years, last_year = 2021, fiscal_month = 12):
+    """
+    Build year and year_adjusted lists like dictify_statement() does, newest
+    first with a leading ttm column.
+    """
+    day = {1:31, 3:31, 6:30, 9:30, 12:31}.get(fiscal_month, 28)
+    year = ['ttm'] + ['{}/{}/{}'.format(fiscal_month, day, last_year - i) for i in range(n_years)]
+    adjusted = [adjust_date(x, 6) if x != 'ttm' else x for x in year]
+    year_adjusted = [x if x != 'ttm' else str(int(max([x for x in adjusted if x != 'ttm'])) + 1) for x in adjusted]
+
+    return year, year_adjusted
+
+def make_company(ticker, n_years = 10, extra_rows = 20, missing_rate = 0.0, currency = 'USD', seed = None, last_year = 2021):
+    """
+    Build one synthetic company object with is, bs and cfs statements.
+
+    args:
+        ticker: ticker symbol to give the company.
+        n_years: fiscal years per statement, not counting ttm.
+        extra_rows: filler rows added to each statement on top of the rows
+        calculate_metrics() needs. Real statements have 30-80 rows.
+        missing_rate: probability each optional or filler row is left out.
+        currency: reporting currency.
+        seed: random seed, for reproducible universes.
+
+    returns: company object. Metrics are not calculated.
+    """
+    rng = np.random.default_rng(seed)
+    year, year_adjusted = make_years(n_years, last_year = last_year)
+    n = len(year)
+
+    # Revenue follows a noisy growth path, oldest to newest, then flips to newest first
+    growth = rng.normal(0.06, 0.12, n)
+    revenue = np.flip(rng.lognormal(13, 1.5) * np.cumprod(1 + np.clip(growth, -0.5, 1.0)))
+
+    cost_of_revenue = revenue * rng.uniform(0.3, 0.7, n)
+    gross_profit = revenue - cost_of_revenue
+    sga = revenue * rng.uniform(0.05, 0.2, n)
+    rnd = revenue * rng.uniform(0.0, 0.15, n)
+    operating_expense = sga + rnd
+    operating_income = gross_profit - operating_expense
+    pretax_income = operating_income * rng.uniform(0.85, 1.05, n)
+    tax_provision = np.where(pretax_income > 0, pretax_income * rng.uniform(0.1, 0.3, n), 0)
+    net_income = pretax_income - tax_provision
+    shares = rng.uniform(1e4, 1e7) * np.ones(n)
+    # Yahoo leaves average shares blank in the ttm column
+    shares[0] = 0
+
+    income_statement = dict(year = year,
+                            year_adjusted = year_adjusted,
+                            total_revenue = revenue,
+                            cost_of_revenue = cost_of_revenue,
+                            gross_profit = gross_profit,
+                            operating_expense = operating_expense,
+                            selling_general_and_administrative = sga,
+                            research_and_development = rnd,
+                            operating_income = operating_income,
+                            pretax_income = pretax_income,
+                            tax_provision = tax_provision,
+                            net_income = net_income,
+                            basic_average_shares = shares,
+                            diluted_average_shares = shares * 1.02)
+
+    # Balance sheets don't have a ttm column
+    total_assets = revenue[1:] * rng.uniform(0.8, 2.5, n - 1)
+    total_liabilities = total_assets * rng.uniform(0.3, 0.8, n - 1)
+    current_assets = total_assets * rng.uniform(0.2, 0.5, n - 1)
+
+    balance_sheet = dict(year = year[1:],
+                        year_adjusted = year_adjusted[1:],
+                        total_assets = total_assets,
+                        total_liabilities_net_minority_interest = total_liabilities,
+                        total_equity_gross_minority_interest = total_assets - total_liabilities,
+                        current_assets = current_assets,
+                        current_liabilities = total_liabilities * rng.uniform(0.3, 0.6, n - 1),
+                        inventory = current_assets * rng.uniform(0.05, 0.3, n - 1))
+
+    cash_flow = dict(year = year,
+                    year_adjusted = year_adjusted,
+                    operating_cash_flow = net_income * rng.uniform(0.9, 1.4, n),
+                    capital_expenditure = -revenue * rng.uniform(0.02, 0.1, n))
+    cash_flow['free_cash_flow'] = cash_flow['operating_cash_flow'] + cash_flow['capital_expenditure']
+
+    statements = dict(zip(['is','bs','cfs'], [income_statement, balance_sheet, cash_flow]))
+    for key, statement in statements.items():
+        length = len(statement['year'])
+        for i in range(extra_rows):
+            statement['other_{}_{}'.format(key, i)] = np.rint(revenue[-length:] * rng.uniform(0.001, 0.1, length))
+        # Drop optional and filler rows at missing_rate
+        droppable = [x for x in statement.keys() if x in OPTIONAL_ROWS or x.startswith('other_')]
+        for row in droppable:
+            if rng.random() < missing_rate:
+                statement.pop(row)
+
+    co = company(ticker, method = None, reporting_currency = currency)
+    for key, statement in statements.items():
+        # Round to whole reporting units, like values scraped from Yahoo
+        for row, values in statement.items():
+            if isinstance(values, np.ndarray):
+                statement[row] = np.rint(values)
+        co.statements[key] = dict(company = ticker, statement = statement, currency = currency)
+    co.index_metrics()
+
+    return co
+
+def make_universe(n_tickers, n_years = 10, extra_rows = 20, missing_rate = 0.0, currencies = ['USD'], seed = 0):
+    """
+    Build a list of synthetic company objects. Currencies are assigned in turn
+    from the currencies list.
+    """
+    return [make_company('SYN{:05d}'.format(i), n_years = n_years, extra_rows = extra_rows, missing_rate = missing_rate,
+                        currency = currencies[i % len(currencies)], seed = seed + i) for i in range(n_tickers)]
+
+def make_cpiu(first_year = 1950, last_year = 2030, inflation = 0.03):
+    """
+    Local stand-in for get_cpiu(). Maps year strings to a CPI-U index that
+    grows by inflation each year.
+    """
+    return {str(x):100 * (1 + inflation) ** (x - first_year) for x in range(first_year, last_year + 1)}
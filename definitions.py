@@ -5,3 +5,11 @@ ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 WEBDRIVER_PATH = os.path.join(ROOT_DIR, 'webdriver\\')
 OUTPUT_PATH = os.path.join(ROOT_DIR, 'output\\')
 ASSET_PATH = os.path.join(ROOT_DIR, 'assets\\')
+INDEX_PATH = os.path.join(ROOT_DIR, 'indexes\\')
+CACHE_PATH = os.path.join(ROOT_DIR, 'cache\\')
+SHARED_PATH = os.path.join(ROOT_DIR, 'shared\\')
+JOB_PATH = os.path.join(ROOT_DIR, 'jobs\\')
+SEGMENT_PATH = os.path.join(ROOT_DIR, 'segments\\')
+EXPORT_PATH = os.path.join(ROOT_DIR, 'exports\\')
+QUARTERLY_PATH = os.path.join(ROOT_DIR, 'quarterly\\')
+HISTORY_PATH = os.path.join(ROOT_DIR, 'history\\')
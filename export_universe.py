@@ -0,0 +1,39 @@
+from modules.export import export_universe, EXPORT_FORMATS
+from modules.instrumentation import write_run_summary, write_prometheus_file
+import argparse
+import logging
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Stream every saved statement to long format files (ticker, statement, row, year, value, currency).')
+    parser.add_argument('tickers', type = str, nargs = '*', help = 'Optional ticker symbols to export. Default is every saved ticker.')
+    parser.add_argument('--name', type = str, default = 'universe', help = 'File name prefix. Shards are named <name>_<shard>.')
+    parser.add_argument('--format', type = str, default = 'csv', choices = list(EXPORT_FORMATS.keys()))
+    parser.add_argument('--shards', type = int, default = 1, help = 'Number of files to split tickers across.')
+    parser.add_argument('--workers', type = int, default = None, help = 'Worker processes writing shards. Default is one per shard, up to the CPU count.')
+    parser.add_argument('--metrics', action = 'store_true', help = 'Export saved metrics along with statement rows.')
+    parser.add_argument('--keep-missing', action = 'store_true', help = 'Write records for missing values too.')
+    parser.add_argument('--chunk-size', type = int, default = 10000, help = 'Records held in memory per writer at a time.')
+    parser.add_argument('--log-level', type = str, default = 'INFO', help = 'DEBUG, INFO, WARNING or ERROR.')
+    parser.add_argument('--metrics-json', type = str, default = None, help = 'Optional path to write a JSON timing summary of this run to.')
+    parser.add_argument('--metrics-prom', type = str, default = None, help = 'Optional path to write Prometheus text format metrics to.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level = args.log_level.upper(), format = '%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    results = export_universe(name = args.name,
+                            fmt = args.format,
+                            tickers = args.tickers or None,
+                            shards = args.shards,
+                            workers = args.workers,
+                            locations = ['statement', 'metrics'] if args.metrics else ['statement'],
+                            dropna = not args.keep_missing,
+                            chunk_size = args.chunk_size)
+
+    for filepath, count in results:
+        print('{} records: {}'.format(count, filepath))
+
+    if args.metrics_json:
+        write_run_summary(args.metrics_json)
+
+    if args.metrics_prom:
+        write_prometheus_file(args.metrics_prom)
@@ -1,12 +1,42 @@
 from modules.classes import company
+from modules.instrumentation import write_run_summary, write_prometheus_file
 import argparse
+import logging
 
-parser = argparse.ArgumentParser(description = 'Take a stock ticker symbol and gather company financials from Yahoo Finance.')
-parser.add_argument('ticker', type = str, help = 'All-caps ticker symbol of a company on Yahoo Finance. Script will gather all three financial statements for that company.')
-args = parser.parse_args()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Take a stock ticker symbol and gather company financials from Yahoo Finance.')
+    parser.add_argument('tickers', type = str, nargs = '+', help = 'All-caps ticker symbol(s) of companies on Yahoo Finance. Script will gather all three financial statements for each company.')
+    parser.add_argument('--browsers', type = int, default = None, help = 'Scrape with modules.pipeline using this many browsers. Default is the pipeline when more than one ticker is given.')
+    parser.add_argument('--parsers', type = int, default = None, help = 'Parser processes for the pipeline. Default is one per cpu.')
+    parser.add_argument('--quarterly', action = 'store_true', help = 'Also gather quarterly statements, which fill ttm values offline. See modules.quarterly.')
+    parser.add_argument('--log-level', type = str, default = 'INFO', help = 'DEBUG, INFO, WARNING or ERROR.')
+    parser.add_argument('--metrics-json', type = str, default = None, help = 'Optional path to write a JSON timing summary of this run to.')
+    parser.add_argument('--metrics-prom', type = str, default = None, help = 'Optional path to write Prometheus text format metrics to.')
+    args = parser.parse_args()
 
-ticker = args.ticker
+    logging.basicConfig(level = args.log_level.upper(), format = '%(asctime)s %(levelname)s %(name)s: %(message)s')
 
-co = company(ticker, method = 'scrape')
+    if len(args.tickers) == 1 and args.browsers == None:
+        ticker = args.tickers[0]
 
-co.save_statements()
+        co = company(ticker, method = 'scrape')
+
+        co.save_statements()
+    else:
+        # Imported here so single-ticker runs don't pay for the pipeline
+        from modules.pipeline import run_pipeline
+
+        jobs = [(ticker, statement) for ticker in args.tickers for statement in ['is','bs','cfs']]
+        run_pipeline(jobs, browsers = args.browsers or 2, parsers = args.parsers)
+
+    if args.quarterly:
+        from modules.quarterly import scrape_quarterly
+
+        for ticker in args.tickers:
+            scrape_quarterly(ticker)
+
+    if args.metrics_json:
+        write_run_summary(args.metrics_json)
+
+    if args.metrics_prom:
+        write_prometheus_file(args.metrics_prom)
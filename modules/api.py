@@ -0,0 +1,336 @@
+"""
+Read-only HTTP API over the saved universe.
+
+Serves statements, metrics, screens and segment aggregates as JSON, so
+dashboards and other consumers don't have to import this package and reread
+every statement file themselves.
+
+Endpoints (all GET):
+    /tickers                        saved tickers and their statements
+    /statements/<ticker>/<is|bs|cfs> one saved statement
+    /metrics/<ticker>?names=a,b     calculated metrics, optionally filtered
+    /screen?where=net_margin,>,0.2&where=current_ratio,>,1.5&last_years=5&how=all
+                                    tickers passing a screen (see modules.screening)
+    /segment?tickers=AAPL,MSFT&names=a,b
+                                    metrics of the tickers added together as a segment
+
+Responses are cached in memory. Every response's ETag is derived from the
+modified times of the statement files behind it, so a cached response is
+served until one of those files changes, and clients sending If-None-Match
+get a 304 without any work being done. Responses are gzipped for clients that
+accept it.
+
+Building a response (reading files, calculating metrics, screening) runs on
+a thread pool so the event loop keeps answering cached requests meanwhile.
+
+Run from the project root:
+    python -m modules.api --port 8888
+"""
+
+from definitions import OUTPUT_PATH
+from modules.classes import company
+from modules.files import get_available_tickers, import_statement_json
+from modules.screening import screen_index
+
+from collections import OrderedDict
+from functools import reduce
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Most responses held in memory by the response cache
+API_CACHE_SIZE = 512
+
+class response_cache():
+    """
+    Least recently used cache of encoded response bodies, keyed by request uri.
+    An entry only counts as a hit while its ETag still matches.
+    """
+    def __init__(self, size = API_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, uri, etag):
+        with self.lock:
+            entry = self.entries.get(uri)
+            if entry == None or entry[0] != etag:
+                return None
+            self.entries.move_to_end(uri)
+            return entry[1]
+
+    def put(self, uri, etag, body):
+        if self.size == 0:
+            return None
+
+        with self.lock:
+            self.entries[uri] = (etag, body)
+            self.entries.move_to_end(uri)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last = False)
+
+        return None
+
+def file_etag(filepaths):
+    """
+    Build an ETag from the names, modified times and sizes of files.
+    Files that don't exist are left out.
+    """
+    stamp = hashlib.sha1()
+    for filepath in sorted(filepaths):
+        try:
+            stat = os.stat(filepath)
+        except FileNotFoundError:
+            continue
+        stamp.update('{}:{}:{};'.format(os.path.basename(filepath), stat.st_mtime_ns, stat.st_size).encode('utf-8'))
+
+    return '"{}"'.format(stamp.hexdigest())
+
+def to_jsonable(value):
+    """
+    Convert np arrays and numbers in nested dicts/lists to plain python,
+    replacing NaN with None. json.dumps() would otherwise write NaN, which
+    isn't valid JSON.
+    """
+    if isinstance(value, dict):
+        return {str(k):to_jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_jsonable(x) for x in value]
+    if isinstance(value, np.ndarray):
+        return to_jsonable(value.tolist())
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+
+    return value
+
+def read_company(ticker, path = OUTPUT_PATH, statements = ['is','bs','cfs'], calculate = True):
+    """
+    Import a ticker's saved statements from path into a company object.
+
+    Same as company(ticker, method = 'import'), but reads from any folder and
+    skips statements that aren't saved.
+    """
+    co = company(ticker, method = None)
+    for statement in statements:
+        filepath = path + ticker + '_' + statement + '.json'
+        if os.path.exists(filepath):
+            co.statements[statement] = import_statement_json(filepath)
+            co.currency = co.statements[statement]['currency']
+
+    if calculate:
+        try:
+            co.calculate_metrics()
+        except KeyError as e:
+            logger.warning('Could not calculate metrics for %s. Missing row %s.', ticker, e)
+    co.index_metrics()
+
+    return co
+
+def company_metrics(co, names = None):
+    """
+    Pull years and metrics out of each of a company's statements.
+    """
+    result = dict(ticker = co.ticker, currency = co.currency, statements = dict())
+    for key, statement in co.statements.items():
+        metrics = statement.get('metrics', dict())
+        if names != None:
+            metrics = {k:v for k, v in metrics.items() if k in names}
+        result['statements'][key] = dict(year = statement['statement'].get('year'),
+                                        year_adjusted = statement['statement']['year_adjusted'],
+                                        metrics = metrics)
+
+    return result
+
+def parse_condition(condition):
+    """
+    Turn a where argument like 'net_margin,>,0.2' into a screen condition.
+    """
+    parts = condition.split(',')
+    if len(parts) != 3:
+        raise ValueError('Conditions look like metric,operator,threshold. Got {}'.format(condition))
+
+    return (parts[0], parts[1], float(parts[2]))
+
+class api_state():
+    """
+    Everything the request handlers share: where statements are saved, the
+    response cache and a screen_index that's rebuilt when the universe changes.
+    """
+    def __init__(self, path = OUTPUT_PATH, cache_size = API_CACHE_SIZE):
+        self.path = path
+        self.cache = response_cache(cache_size)
+        self.index = None
+        self.index_etag = None
+        self.index_lock = threading.Lock()
+
+    def available(self):
+        return get_available_tickers(self.path)
+
+    def ticker_files(self, ticker, statements = ['is','bs','cfs']):
+        return [self.path + ticker + '_' + x + '.json' for x in statements]
+
+    def universe_files(self):
+        return [self.path + x for x in os.listdir(self.path)]
+
+    def screen_index(self):
+        """
+        Return a screen_index over the saved universe, rebuilding it only when
+        a statement file has changed since the last build.
+        """
+        etag = file_etag(self.universe_files())
+        with self.index_lock:
+            if self.index == None or self.index_etag != etag:
+                companies = [read_company(x, self.path) for x in sorted(self.available().keys())]
+                self.index = screen_index(companies)
+                self.index_etag = etag
+
+        return self.index
+
+def make_app(path = OUTPUT_PATH, cache_size = API_CACHE_SIZE):
+    """
+    Build the tornado application.
+
+    args:
+        path: folder of saved statements to serve. Default is the output folder.
+        cache_size: most responses to keep in memory. 0 turns the cache off.
+    """
+    import tornado.web
+
+    class base_handler(tornado.web.RequestHandler):
+        def initialize(self, state):
+            self.state = state
+
+        def write_error(self, status_code, **kwargs):
+            self.set_header('Content-Type', 'application/json')
+            self.finish(json.dumps(dict(error = self._reason)))
+
+        async def respond(self, files, build):
+            """
+            Serve build()'s result as JSON, from the cache when none of files
+            has changed, or as a 304 when the client already has it.
+            """
+            etag = file_etag(files)
+            self.set_header('Etag', etag)
+            if self.check_etag_header():
+                self.set_status(304)
+                return None
+
+            body = self.state.cache.get(self.request.uri, etag)
+            if body == None:
+                try:
+                    body = await asyncio.get_running_loop().run_in_executor(None, lambda: json.dumps(to_jsonable(build())).encode('utf-8'))
+                except (KeyError, ValueError) as e:
+                    raise tornado.web.HTTPError(400, reason = str(e).strip('\'"'))
+                self.state.cache.put(self.request.uri, etag, body)
+
+            self.set_header('Content-Type', 'application/json')
+            self.write(body)
+
+            return None
+
+        def require_ticker(self, ticker):
+            # Checking a ticker's own files is much cheaper than listing the whole folder
+            saved = [x for x in ['is','bs','cfs'] if os.path.exists(self.state.path + ticker + '_' + x + '.json')]
+            if len(saved) == 0:
+                raise tornado.web.HTTPError(404, reason = '{} has no saved statements.'.format(ticker))
+
+            return saved
+
+        def list_argument(self, name):
+            value = self.get_argument(name, None)
+
+            return None if value == None else value.split(',')
+
+    class tickers_handler(base_handler):
+        async def get(self):
+            await self.respond(self.state.universe_files(), self.state.available)
+
+    class statement_handler(base_handler):
+        async def get(self, ticker, statement):
+            if statement not in self.require_ticker(ticker):
+                raise tornado.web.HTTPError(404, reason = '{} has no saved {} statement.'.format(ticker, statement))
+            filepath = self.state.path + ticker + '_' + statement + '.json'
+            await self.respond([filepath], lambda: import_statement_json(filepath))
+
+    class metrics_handler(base_handler):
+        async def get(self, ticker):
+            self.require_ticker(ticker)
+            names = self.list_argument('names')
+            await self.respond(self.state.ticker_files(ticker), lambda: company_metrics(read_company(ticker, self.state.path), names))
+
+    class screen_handler(base_handler):
+        async def get(self):
+            try:
+                conditions = [parse_condition(x) for x in self.get_arguments('where')]
+                last_years = self.get_argument('last_years', None)
+                last_years = None if last_years == None else int(last_years)
+            except ValueError as e:
+                raise tornado.web.HTTPError(400, reason = str(e))
+            years = self.list_argument('years')
+            how = self.get_argument('how', 'all')
+
+            def build():
+                tickers = self.state.screen_index().query(conditions, years = years, last_years = last_years, how = how)
+                return dict(conditions = conditions, tickers = tickers)
+
+            await self.respond(self.state.universe_files(), build)
+
+    class segment_handler(base_handler):
+        async def get(self):
+            tickers = self.list_argument('tickers')
+            if tickers == None:
+                raise tornado.web.HTTPError(400, reason = 'Provide tickers=A,B,C')
+            files = []
+            for ticker in tickers:
+                self.require_ticker(ticker)
+                files += self.state.ticker_files(ticker)
+            names = self.list_argument('names')
+
+            def build():
+                segment = reduce(lambda a, b: a + b, [read_company(x, self.state.path, calculate = False) for x in tickers])
+                segment.calculate_metrics()
+                return company_metrics(segment, names)
+
+            await self.respond(files, build)
+
+    state = api_state(path, cache_size)
+    routes = [
+        (r'/tickers', tickers_handler),
+        (r'/statements/([^/]+)/(is|bs|cfs)', statement_handler),
+        (r'/metrics/([^/]+)', metrics_handler),
+        (r'/screen', screen_handler),
+        (r'/segment', segment_handler)
+    ]
+
+    return tornado.web.Application([(route, handler, dict(state = state)) for route, handler in routes], compress_response = True)
+
+async def serve(port = 8888, path = OUTPUT_PATH, cache_size = API_CACHE_SIZE):
+    """
+    Serve the API until the process is stopped.
+    """
+    app = make_app(path, cache_size)
+    app.listen(port)
+    logger.info('Serving %s on port %s', path, port)
+    await asyncio.Event().wait()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Serve saved statements and metrics over HTTP.')
+    parser.add_argument('--port', type = int, default = 8888)
+    parser.add_argument('--path', type = str, default = OUTPUT_PATH, help = 'Folder of saved statements. Default is the output folder.')
+    parser.add_argument('--cache-size', type = int, default = API_CACHE_SIZE, help = 'Most responses to keep in memory. 0 turns the cache off.')
+    parser.add_argument('--log-level', type = str, default = 'INFO')
+    args = parser.parse_args()
+
+    logging.basicConfig(level = args.log_level.upper(), format = '%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    asyncio.run(serve(args.port, args.path, args.cache_size))
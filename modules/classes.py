@@ -10,18 +10,26 @@ It automatically calculates ratios insightful for financial statement analysis.
 Further analysis can be done on the object's attributes.
 """
 
-from definitions import WEBDRIVER_PATH, OUTPUT_PATH, ASSET_PATH
-import sys
-sys.path.append(WEBDRIVER_PATH) # Selenium breaks if not add to path
+from definitions import OUTPUT_PATH
 
+# scraping and forex only import selenium, bs4 and forex_python when a scrape
+# or forex request actually runs. plotly and pandas are imported inside plot()
+# and __repr__() for the same reason, so loading saved statements and
+# calculating metrics only costs numpy.
 from modules.scraping import scrape_statement, get_recent_quarter
-from modules.cleaning import unclean_statement_heading, rewrite_value, adjust_date, align_arrays
-from modules.forex import trend_mean_rates, get_cpiu
-from modules.files import save_json, import_statement_json, import_json
+from modules.cleaning import unclean_statement_heading, rewrite_value, adjust_date, align_arrays, compact_row
+from modules.forex import trend_mean_rates, get_cpiu, forex_file
+from modules.files import import_statement_json, import_json, run_save_hooks
+from modules.validation import check_statements, format_report, log_problems
+from modules.quarterly import get_ttm
+from modules.taxonomy import resolve_row_name
+from modules.history import save_versioned
 
 import numpy as np
-import pandas as pd
-import plotly.graph_objects as go
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
 
 class company():
     """
@@ -31,7 +39,7 @@ class company():
     Automatically calculates key financial ratios from those documents in
     numpy arrays for easy trending.
     """
-    def __init__(self, ticker_symbol = None, initial_statements=['is','bs','cfs'], method = 'import', reporting_currency = '[Unspecified Currency]'):
+    def __init__(self, ticker_symbol = None, initial_statements=['is','bs','cfs'], method = 'import', reporting_currency = '[Unspecified Currency]', validate = False):
         """
         Just provide a ticker symbol and optionally list the statements with
         which to pop your instance.
@@ -45,6 +53,9 @@ class company():
 
         In return, the instance will store the statement(s) you wanted as well
         as automatically calculated trends of financial ratios.
+
+        "validate" runs validate_statements() right after the statements are
+        scraped or imported and logs any integrity problems found as warnings.
         """
         initial_statements = [] if ticker_symbol == None else initial_statements
 
@@ -68,6 +79,13 @@ class company():
         # Instantiate empty dict to hold financial statements
         self.statements = dict()
 
+        # Set by compact_statements(). calculate_metrics() keeps metrics compact while it is.
+        self.compact = False
+
+        # Results of plan().execute(), keyed by plan signature. Cleared by
+        # every method that changes statements.
+        self.plan_cache = dict()
+
         if method == 'scrape':
             for x in initial_statements:
                 self.statements[x] = scrape_statement(ticker_symbol, x, skip_rows = self.metrics_rows)
@@ -78,6 +96,71 @@ class company():
         else:
             self.statements = dict()
 
+        # name -> (statement, section) lookup for every row and metric.
+        # Lets plot() and plot_companies() find a metric without scanning
+        # every statement. Kept current by index_metrics().
+        self.metric_index = dict()
+        self.index_metrics()
+
+        if validate and len(self.statements) > 0:
+            report = self.validate_statements()
+            if len(report) > 0:
+                logger.warning(format_report(report))
+
+    def index_metrics(self):
+        """
+        Rebuilds the object's metric_index, mapping every row and metric name
+        to the statement (is, bs, cfs) and section ('statement', 'metrics') that
+        holds it.
+
+        Called whenever statements or metrics change. When a name exists in
+        more than one place, the last statement wins, same as the old full scan.
+
+        Only the 'statement' and 'metrics' sections are indexed. Other dicts in
+        a statement, like projections (future years) and row_ids (name -> id),
+        repeat row names without holding their values.
+        """
+        metric_index = dict()
+        for statement_key, statement in self.statements.items():
+            for data_key in ['statement', 'metrics']:
+                for name in statement.get(data_key, dict()).keys():
+                    metric_index[name] = (statement_key, data_key)
+
+        self.metric_index = metric_index
+
+        return metric_index
+
+    def locate_metric(self, metric):
+        """
+        Returns (statement, section) for a row or metric name, like ('is', 'metrics')
+        for 'net_margin'.
+
+        Rebuilds the index once before giving up, in case statements were
+        edited directly rather than through this object's methods.
+        Raises KeyError when the metric isn't in any statement.
+        """
+        if metric not in self.metric_index.keys():
+            self.index_metrics()
+
+        if metric not in self.metric_index.keys():
+            raise KeyError('{} not found in statements of {}.'.format(metric, self.ticker))
+
+        return self.metric_index[metric]
+
+    def validate_statements(self, tolerance = 0.01):
+        """
+        Checks the object's statements for signs of a bad scrape: accounting
+        identities that don't hold (assets = liabilities + equity, etc.), years
+        out of order, rows with the wrong number of values and rows that
+        calculate_metrics() needs but can't find.
+
+        Uses modules.validation.check_statements(). Pass many company objects
+        to that function directly to sweep a whole universe at once.
+
+        returns: dict mapping ticker to a list of problems. Empty if all clear.
+        """
+        return check_statements([self], tolerance = tolerance)
+
     def align_statements(self):
         """
         In some cases, several statements in a single company object can have assymmetrical
@@ -93,6 +176,13 @@ class company():
         # STEP 1: Figure out which statements are in this object
         statements = {k:v['statement'] for k, v in self.statements.items() if 'statement' in v.keys()}
 
+        # Already aligned (every statement has the same years). Nothing to filter.
+        year_lists = [list(x['year_adjusted']) for x in statements.values()]
+        if all(x == year_lists[0] for x in year_lists):
+            return statements
+
+        self.plan_cache.clear()
+
         # STEP 2: Figure out which years all included statements have in common
         common_years = list(statements.values())[0]['year_adjusted']
         for statement in statements.values():
@@ -150,13 +240,13 @@ class company():
             # NOTE: Need to handle divide by zero, here, because items are 0 in ttm column (like basic average shares)
             # Just return 0. In ttm column, shares and eps will both be 0. intuitive to understand that data missing.
             statement['metrics']['tax_rate'] = np.divide(metrics_is['tax_provision'], metrics_is['pretax_income'],
-                                                                    out = np.zeros_like(metrics_is['tax_provision']),
+                                                                    out = np.zeros_like(metrics_is['tax_provision'], dtype = float),
                                                                     where = metrics_is['pretax_income'] != 0)
             statement['metrics']['basic_earnings_per_share'] = np.divide(metrics_is['net_income'], metrics_is['basic_average_shares'],
-                                                                    out = np.zeros_like(metrics_is['net_income']),
+                                                                    out = np.zeros_like(metrics_is['net_income'], dtype = float),
                                                                     where = metrics_is['basic_average_shares'] != 0)
             statement['metrics']['diluted_earnings_per_share'] = np.divide(metrics_is['net_income'], metrics_is['diluted_average_shares'],
-                                                                    out = np.zeros_like(metrics_is['net_income']),
+                                                                    out = np.zeros_like(metrics_is['net_income'], dtype = float),
                                                                     where = metrics_is['diluted_average_shares'] != 0)
 
         if 'bs' in self.statements.keys():
@@ -168,7 +258,7 @@ class company():
             try:
                 statement['metrics']['quick_ratio'] = (metrics_bs['current_assets'] - metrics_bs['inventory']) / metrics_bs['current_liabilities']
             except:
-                statement['metrics']['quick_ratio'] = np.zeros_like(metrics_bs['year_adjusted'])
+                statement['metrics']['quick_ratio'] = np.zeros_like(metrics_bs['current_assets'], dtype = float)
             statement['metrics']['debt_equity_ratio'] = metrics_bs['total_liabilities_net_minority_interest'] / metrics_bs['total_equity_gross_minority_interest']
             statement['metrics']['working_capital'] = metrics_bs['current_assets'] - metrics_bs['current_liabilities']
 
@@ -185,38 +275,61 @@ class company():
             if 'is' in self.statements.keys():
                 # NOTE: basic average shares not reported for ttm, so just fill this metric with 0 for that period
                 statement['metrics']['operating_cf_per_share'] = np.divide(metrics_cfs['operating_cash_flow'], metrics_is['basic_average_shares'],
-                                                                            out = np.zeros_like(metrics_cfs['operating_cash_flow']),
+                                                                            out = np.zeros_like(metrics_cfs['operating_cash_flow'], dtype = float),
                                                                             where = metrics_is['basic_average_shares'] != 0)
 
-    def fill_ttm(self, statement, ttm_row):
+        if self.compact:
+            self.compact_statements(rows = False)
+
+        self.index_metrics()
+
+    def fill_ttm(self, statement, ttm_row, live = False):
         """
         Some rows in financial statements are unpopulated in ttm period.
         Basic Average Shares is one of them.
         For some analyses, it's useful and practical to use the value from the
         most recent completed quarter.
 
-        This method does that. Gets most recent completed quarter from Yahoo Finance
-        and fills the ttm column in the row specified by fill_row.
+        This method does that. Reads the trailing figure computed from the
+        company's saved quarterly statement (see modules.quarterly) and fills
+        the ttm column in the row specified by ttm_row. Share counts take the
+        most recent quarter and flows sum the last four. Falls back to getting
+        the most recent completed quarter from Yahoo Finance when no quarterly
+        statement is saved.
 
         args:
             statement: is, bs or cfs. Which statement to check and to fill.
-            fill_row: string. Name of row as it appears on Yahoo Finance. Case sensitive.
+            ttm_row: string. Name of row as it appears on Yahoo Finance (case
+            sensitive when live), or its row name or a synonym. Resolved to the
+            row's canonical name (see modules.taxonomy).
+            live: always get the value from Yahoo Finance.
 
-        returns: None
+        returns: the filled row.
         """
-        statement_url = self.statement_urls[statement]
-        recent_quarter, row_name = get_recent_quarter(statement_url, ttm_row)
-        print('Recent Quarter: {}\nRow Name: {}'.format(recent_quarter, row_name))
+        row_name = resolve_row_name(ttm_row, self.statements[statement]['statement'])
+        period_end, figures = (None, dict()) if live else get_ttm(self.ticker, statement, [row_name])
+
+        if row_name in figures.keys() and not np.isnan(figures[row_name]):
+            recent_quarter = figures[row_name]
+            logger.info('TTM from quarters through %s: %s Row Name: %s', period_end, recent_quarter, row_name)
+        else:
+            if not live:
+                logger.warning('No saved quarterly %s for %s %s. Getting the recent quarter from Yahoo Finance.', row_name, self.ticker, statement)
+            statement_url = self.statement_urls[statement]
+            recent_quarter = get_recent_quarter(statement_url, ttm_row)[0]
+            logger.info('Recent Quarter: %s Row Name: %s', recent_quarter, row_name)
 
         # Figure out which index in the provided statement is ttm
         # Return that index, so we can replace the correct index
         # in fill_row with recent_quarter
-        ttm_index = self.statements[statement]['year'].index('ttm')
-        print('ttm_index: {}'.format(ttm_index))
+        ttm_index = self.statements[statement]['statement']['year'].index('ttm')
+        logger.debug('ttm_index: %s', ttm_index)
+
+        self.plan_cache.clear()
 
-        self.statements[statement] = rewrite_value(self.statements[statement],row_name,[ttm_index],[recent_quarter])
+        self.statements[statement]['statement'] = rewrite_value(self.statements[statement]['statement'],row_name,[ttm_index],[recent_quarter])
 
-        return self.statements[statement][row_name]
+        return self.statements[statement]['statement'][row_name]
 
     def convert_currency(self, currency_a, currency_b):
         """
@@ -233,8 +346,8 @@ class company():
             Example: [['2019', 1.5], ['2020', 1.4], ['2021', 1.6]].
             To be matched against ['year_adjusted'] index of financial statements.
         """
-        forex_file = ASSET_PATH + currency_a.lower() + '_to_' + currency_b.lower() + '.json'
-        forex_rates = import_json(forex_file)
+        forex_rates = import_json(forex_file(currency_a, currency_b))
+        self.plan_cache.clear()
         # STEP 1: Find years in company ['year_adjusted']
         for statement in self.statements.keys():
             statement_dict = self.statements[statement]['statement']
@@ -245,9 +358,10 @@ class company():
             # STEP 1: Filter forex dict for years in year_adjusted
             filtered_forex = {k:v for (k,v) in forex_rates.items() if k in statement_years}
 
-            # Need to flip forex_factors, because statements store years in reverse order
-            # While currency mapping json stores years in chron order
-            forex_factors = np.flip(np.asarray(list(filtered_forex.values())))
+            # Look rates up by year rather than relying on the rates table's
+            # order being the reverse of the statement's
+            aligned_years = align_arrays(forex_years, statement_years, statement_years)
+            forex_factors = np.asarray([forex_rates[x] for x in aligned_years])
 
             # STEP 2: Multiply each row of statement from array created in step 2
             for row in statement_dict.keys():
@@ -260,7 +374,7 @@ class company():
 
         return filtered_forex
 
-    def normalize_statements(self, reference_year = 0, origin_currency = 'USD'):
+    def normalize_statements(self, reference_year = 0, origin_currency = 'USD', cpiu = None):
         """
         Values in Yahoo Finance statements are reported in nominal currency.
 
@@ -284,6 +398,10 @@ class company():
             therefore isn't a very insightful measure of inflation in other countries.
             Forex transformation analytically accounts for non-US inflation by tracking
             differences in conversion rate year to year between USD and other currency.
+
+            cpiu: optional dict mapping year strings to CPI-U values, shaped like
+            get_cpiu() output. Default downloads it from the BLS. Pass a saved
+            copy to avoid the download (benchmarks and batch jobs do this).
         """
         # If origin_currency is not USD, convert to USD from origin_currency
         # consumer price index is inflation measure based on US prices
@@ -294,10 +412,12 @@ class company():
         if origin_currency != 'USD':
             self.convert_currency(origin_currency, 'USD')
 
+        self.plan_cache.clear()
+
         # Figure out which statements are in here
         statements = {k:v['statement'] for k, v in self.statements.items() if 'statement' in v.keys()}
         # Get consumer price index (CPI-U) lookup dict
-        cpiu = get_cpiu()
+        cpiu = get_cpiu() if cpiu == None else cpiu
         # Iterate through statements
         for k, v in statements.items():
             # Find max year
@@ -316,6 +436,136 @@ class company():
 
         return None
 
+    def compact_statements(self, rows = True, metrics = True):
+        """
+        Opt-in compact storage for large universes.
+
+        Statement rows are whole numbers in reporting units, so they're stored
+        as int32 (int64 when too large), or float32 when they hold NaN but are
+        small enough to stay exact. See modules.cleaning.compact_row(). Metrics
+        are ratios and are stored as float32. Row names and year labels are
+        interned, so thousands of companies share one copy of each string.
+
+        Every row still behaves like an np array in every method of this class.
+        Once called, calculate_metrics() keeps new metrics compact too. Use
+        check_compact_precision() to confirm metrics still match the float64 path.
+
+        args:
+            rows: compact statement rows.
+            metrics: compact metrics.
+
+        returns: None
+        """
+        self.plan_cache.clear()
+        for statement in self.statements.values():
+            if 'statement' in statement.keys():
+                statement_dict = statement['statement']
+                for year_key in ['year', 'year_adjusted']:
+                    if year_key in statement_dict.keys():
+                        statement_dict[year_key] = [sys.intern(x) if isinstance(x, str) else x for x in statement_dict[year_key]]
+                statement['statement'] = {sys.intern(k):compact_row(v) if rows else v for k, v in statement_dict.items()}
+
+            if 'metrics' in statement.keys():
+                statement['metrics'] = {sys.intern(k):v.astype(np.float32) if metrics and isinstance(v, np.ndarray) and v.dtype.kind == 'f' else v
+                                        for k, v in statement['metrics'].items()}
+
+        self.compact = True
+        self.index_metrics()
+
+        return None
+
+    def memory_report(self):
+        """
+        Bytes held by each statement, to see what compact_statements() saves.
+
+        data_bytes: values in np arrays.
+        object_bytes: np array objects, dicts and year lists around the values.
+        name_bytes: row names and year labels. After compact_statements() these
+        are interned and shared by every company, so they stop growing with
+        the number of companies loaded.
+
+        returns: dict mapping each statement, plus 'total', to a dict of
+        arrays, data_bytes, object_bytes, name_bytes and total_bytes.
+        """
+        measures = ['arrays', 'data_bytes', 'object_bytes', 'name_bytes', 'total_bytes']
+
+        report = dict()
+        for key, statement in self.statements.items():
+            entry = dict(arrays = 0, data_bytes = 0, object_bytes = sys.getsizeof(statement), name_bytes = 0)
+            for location in ['statement', 'metrics']:
+                section = statement.get(location, dict())
+                entry['object_bytes'] += sys.getsizeof(section)
+                for name, value in section.items():
+                    entry['name_bytes'] += sys.getsizeof(name)
+                    if isinstance(value, np.ndarray):
+                        entry['arrays'] += 1
+                        entry['data_bytes'] += value.nbytes
+                        # getsizeof() includes the values when the array owns them
+                        entry['object_bytes'] += sys.getsizeof(value) - (value.nbytes if value.base is None else 0)
+                    elif isinstance(value, list):
+                        entry['object_bytes'] += sys.getsizeof(value)
+                        entry['name_bytes'] += sum(sys.getsizeof(x) for x in value)
+            entry['total_bytes'] = entry['data_bytes'] + entry['object_bytes'] + entry['name_bytes']
+            report[key] = entry
+
+        report['total'] = {k:sum(x[k] for x in report.values()) for k in measures}
+
+        return report
+
+    def check_compact_precision(self, rtol = 1e-6):
+        """
+        Prove compact storage doesn't change results. Calculates metrics on a
+        float64 copy and a compact copy of this object and compares them.
+
+        args:
+            rtol: largest relative difference allowed between the two.
+
+        returns: dict mapping 'statement metric' to the largest relative
+        difference found, for metrics over rtol. Empty if all clear.
+        """
+        import copy
+
+        full = copy.deepcopy(self)
+        for statement in full.statements.values():
+            if 'statement' in statement.keys():
+                statement['statement'] = {k:v.astype(float) if isinstance(v, np.ndarray) and v.dtype.kind in 'fiu' else v
+                                            for k, v in statement['statement'].items()}
+        full.compact = False
+        full.calculate_metrics()
+
+        compact = copy.deepcopy(full)
+        compact.compact_statements()
+        compact.calculate_metrics()
+
+        problems = dict()
+        for key, statement in full.statements.items():
+            for metric, expected in statement.get('metrics', dict()).items():
+                if not isinstance(expected, np.ndarray) or expected.dtype.kind != 'f':
+                    continue
+                actual = compact.statements[key]['metrics'][metric].astype(float)
+                if np.allclose(actual, expected, rtol = rtol, atol = 0, equal_nan = True):
+                    continue
+                with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                    difference = np.abs(actual - expected) / np.abs(expected)
+                problems['{} {}'.format(key, metric)] = float(np.nanmax(difference))
+
+        return problems
+
+    def plan(self):
+        """
+        Start a lazy transformation plan. Record steps, then run them in one
+        pass per statement with execute(), which returns a new company:
+            co.plan().align().convert('EUR', 'USD').normalize(cpiu = cpiu).metrics().execute()
+
+        Years, forex rates and CPI-U factors are combined into one factor
+        vector per statement, so rows are only touched once. Results are
+        cached by plan signature until this object's statements change.
+        See modules.plan.
+        """
+        from modules.plan import transform_plan
+
+        return transform_plan(self)
+
     def quick_gather(self, ticker):
         """
         Convenience method that scrapes Yahoo Finance for statements for ticker
@@ -328,19 +578,32 @@ class company():
 
         return co
 
-    def save_statements(self, statements = None):
+    def save_statements(self, statements = None, force = False):
         """
-        Save statements stored in the instance to csv file after
-        converting to dataframe and long structure.
+        Save statements stored in the instance to one json file per
+        statement in the output directory. modules.export streams saved
+        statements out in long format (csv and others).
+
+        Every save also appends the cells that changed to the statement's
+        history (see modules.history). Statements without metrics that
+        haven't changed since their last save aren't rewritten, unless
+        force is True. Written statements are checked with
+        modules.validation and any problems are logged as warnings.
         """
         if statements == None:
             statements = self.statements.keys()
 
-        print('Statements to be saved: {}'.format(statements))
+        logger.info('Statements to be saved for %s: %s', self.ticker, ', '.join(statements))
+        written = []
         for statement in statements:
             self.statements[statement]['currency'] = self.currency
-            filename = OUTPUT_PATH + self.ticker + '_' + statement + '.json'
-            save_json(self.statements[statement], filename)
+            if save_versioned(self.ticker, statement, self.statements[statement], force = force):
+                written.append(statement)
+
+        # Let indexes over the saved universe pick up the new data
+        if len(written) > 0:
+            log_problems([self], statements = written)
+            run_save_hooks(self, written)
 
         return None
 
@@ -356,19 +619,21 @@ class company():
             or ['metrics'] dicts of the given statement.
 
             colors: list of colors to be applied to series in the plotly trend.
-            colors indices correspond to metrics indices.
+            colors indices correspond to metrics indices. Extended with
+            modules.plotting.series_colors() when there are more metrics.
         """
+        import plotly.graph_objects as go
+        from modules.plotting import series_colors
+
         data = []
+        # Extend the palette rather than failing when there are more metrics than colors
+        colors = series_colors(len(metrics), colors)
 
         for i, metric in enumerate(metrics):
-            for statement_key in self.statements.keys():
-                for data_key in self.statements[statement_key].keys():
-                    if isinstance(self.statements[statement_key][data_key], dict) and metric in self.statements[statement_key][data_key].keys():
-                        metric_location = data_key
-                        metric_statement = statement_key
-                        metric_vals = self.statements[statement_key][data_key][metric]
+            metric_statement, metric_location = self.locate_metric(metric)
+            metric_vals = self.statements[metric_statement][metric_location][metric]
 
-            x_var = self.statements[statement_key]['statement']['year_adjusted'][::-1]
+            x_var = self.statements[metric_statement]['statement']['year_adjusted'][::-1]
 
             plot = go.Scatter(
                 mode = 'lines+markers',
@@ -381,6 +646,20 @@ class company():
 
             data.append(plot)
 
+            # Draw projections from modules.projection as a dashed extension,
+            # starting at the newest actual year so the lines join up
+            projections = self.statements[metric_statement].get('projections', dict())
+            if metric in projections.get('values', dict()).keys():
+                projected_vals = np.concatenate([np.asarray(projections['values'][metric], dtype = float), metric_vals[:1]])
+                projection = go.Scatter(
+                    mode = 'lines',
+                    line = dict(color = colors[i], width = 4, dash = 'dash'),
+                    x = [x_var[-1]] + list(projections['year_adjusted'][::-1]),
+                    y = np.flip(projected_vals) / 1000000 if metric_location == 'statement' else np.flip(projected_vals),
+                    name = '{} ({} projection)'.format(metric.replace('_',' ').title(), projections['method'])
+                )
+                data.append(projection)
+
         pretty_metrics = [unclean_statement_heading(x) for x in metrics]
 
         layout = dict(
@@ -421,6 +700,7 @@ class company():
         Calling a company object without an attribute or method will
         display the object's metadata.
         """
+        import pandas as pd
 
         header = '|||Object Metadata|||\n'.format(self.ticker)
         data = [['Companies Included', '{}'.format(', '.join(self.ticker))],
@@ -487,7 +767,8 @@ class company():
                         # values in statement rows align with years in year_adjusted
                         self_aligned = align_arrays(years_other, years_self, self_statements[sheet][key])
                         other_aligned = align_arrays(years_self, years_other, other_statements[sheet][key])
-                        segment_dict[sheet]['statement'][key] = self_aligned + other_aligned
+                        # Add in float64, so compact int32 rows can't overflow across a segment
+                        segment_dict[sheet]['statement'][key] = np.add(self_aligned, other_aligned, dtype = float)
 
         # instantiate new company object for the combined segment
         segment = company(ticker_symbol = segment_tickers, method = None)
@@ -498,5 +779,6 @@ class company():
         segment.statements['cfs'] = segment_dict['cfs']
 
         segment.metrics_rows = self.metrics_rows
+        segment.index_metrics()
 
         return segment
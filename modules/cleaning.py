@@ -151,8 +151,122 @@ def align_arrays(reference_a, reference_b, subject_array_b):
     mask = [i for i, x in enumerate(reference_b) if x in reference_a]
 
     if isinstance(subject_array_b, list):
-        aligned_subject = [x for i, x in enumerate(reference_b) if i in mask]
+        # Take the subject's own values (like report dates in 'year'), not reference_b's
+        aligned_subject = [subject_array_b[i] for i in mask]
     elif isinstance(subject_array_b, np.ndarray):
         aligned_subject = subject_array_b[mask]
 
     return aligned_subject
+
+def company_label(co):
+    """
+    Ticker label used for a company object in cubes and reports. Segments
+    built with company.__add__() have a list of tickers, so those are joined
+    with ' + ' like plot_companies() does.
+    """
+    return co.ticker if isinstance(co.ticker, str) else ' + '.join(co.ticker)
+
+def stack_rows(rows, row_years, years):
+    """
+    Place many statement rows, each with its own year list, onto one shared
+    year axis. Result is a single 2D np array that can be filtered and compared
+    with array math instead of looping through dicts.
+
+    Companies rarely report the same set of years, so years a row doesn't
+    cover are filled with NaN.
+
+    args:
+        rows: list of np arrays (or None when a row is missing entirely).
+        row_years: list of year lists (usually year_adjusted), one per row.
+        years: list. The shared year axis, newest first like statements.
+
+    returns: 2D np array of floats. Shape is len(rows) x len(years).
+    """
+    year_positions = {year:i for i, year in enumerate(years)}
+    stacked = np.full((len(rows), len(years)), np.nan)
+
+    for i, (row, ry) in enumerate(zip(rows, row_years)):
+        if isinstance(row, np.ndarray):
+            cols = [year_positions[x] for x in ry if x in year_positions]
+            keep = [j for j, x in enumerate(ry) if x in year_positions]
+            stacked[i, cols] = row[keep]
+
+    return stacked
+
+def merge_statements(old_statement, new_statement):
+    """
+    Merge a freshly scraped statement into a previously saved one.
+
+    Yahoo Finance only shows the last four fiscal years, so overwriting a
+    saved statement with a new scrape throws away older years. This keeps
+    every year from both, preferring new values wherever both have a year.
+
+    args:
+        old_statement, new_statement: statement dicts like company.statements['is']['statement'].
+
+    returns: merged statement dict. Years newest first with ttm leading, like
+    dictify_statement() output. Rows one side doesn't have get NaN for that
+    side's years.
+    """
+    # STEP 1: Map each column (by report date) to the statement it comes from
+    # New columns overwrite old ones, including the ttm column
+    columns = dict()
+    for source in [old_statement, new_statement]:
+        for i, year in enumerate(source['year']):
+            columns[year] = (source, i)
+
+    dated = sorted([x for x in columns.keys() if x != 'ttm'], key = lambda x: dt.strptime(x, '%m/%d/%Y'), reverse = True)
+    years = (['ttm'] if 'ttm' in columns.keys() else []) + dated
+
+    # STEP 2: Rebuild year_adjusted the same way dictify_statement() does
+    adjusted_years = [adjust_date(x, 6) if x != 'ttm' else x for x in years]
+    year_adjusted = [x if x != 'ttm' else str(int(max([x for x in adjusted_years if x != 'ttm'])) + 1) for x in adjusted_years]
+
+    merged = dict(year = years, year_adjusted = year_adjusted)
+
+    # STEP 3: Fill every row from whichever statement owns each column
+    rows = [k for k, v in old_statement.items() if isinstance(v, np.ndarray)]
+    rows += [k for k, v in new_statement.items() if isinstance(v, np.ndarray) and k not in rows]
+    for row in rows:
+        values = np.full(len(years), np.nan)
+        for j, year in enumerate(years):
+            source, i = columns[year]
+            if isinstance(source.get(row), np.ndarray):
+                values[j] = source[row][i]
+        merged[row] = values
+
+    return merged
+
+# Largest magnitude stored as int32 by compact_row(). Leaves headroom so adding
+# or subtracting two compact rows can't overflow.
+INT32_LIMIT = 2 ** 30
+
+# Largest magnitude where every integer is exact in float32
+FLOAT32_EXACT_LIMIT = 2 ** 24
+
+def compact_row(row):
+    """
+    Helper function of compact_statements() method of company() class.
+
+    Returns the smallest dtype copy of a statement row that holds every
+    value exactly:
+        - Whole numbers with no NaN become int32, or int64 when too large.
+        - Whole numbers with NaN become float32 when small enough to be exact.
+        - Anything else is returned unchanged as float64.
+    """
+    if not isinstance(row, np.ndarray) or row.dtype.kind not in 'fiu':
+        return row
+
+    finite = row[np.isfinite(row)] if row.dtype.kind == 'f' else row
+    if len(finite) == 0:
+        return row.astype(np.float32)
+    if not np.all(np.mod(finite, 1) == 0):
+        return row
+
+    largest = np.abs(finite).max()
+    if len(finite) == len(row):
+        return row.astype(np.int32) if largest <= INT32_LIMIT else row.astype(np.int64)
+    if largest <= FLOAT32_EXACT_LIMIT:
+        return row.astype(np.float32)
+
+    return row
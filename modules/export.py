@@ -0,0 +1,254 @@
+"""
+Stream every saved statement out in long format:
+    (ticker, statement, row, year, value, currency)
+
+Statement files are read one at a time by a generator, and records are
+written in chunks, so memory holds one file and one chunk at a time no
+matter how big the universe is. Building the same table as a pandas
+DataFrame holds all of it at once.
+
+Formats:
+    csv: one header line, then one record per line.
+    ndjson: one JSON object per line.
+    columnar: one raw binary file per column, plus a JSON manifest.
+    ticker, statement, row and currency are int32 codes into lists in the
+    manifest, year is int32 and value is float64. read_columnar() memory
+    maps the columns back as np arrays.
+
+Tickers can be split into shards, which are written by parallel worker
+processes. Each shard is a complete file in the chosen format.
+
+Example:
+    export_universe('universe', fmt = 'csv', shards = 4)
+    for record in iter_records(): ...
+"""
+
+from definitions import OUTPUT_PATH, EXPORT_PATH
+from modules.files import get_available_tickers, import_statement_json
+
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Fields of every exported record, in order
+RECORD_FIELDS = ['ticker', 'statement', 'row', 'year', 'value', 'currency']
+
+# Formats export_shard() can write, and their file extensions
+EXPORT_FORMATS = {'csv':'.csv', 'ndjson':'.ndjson', 'columnar':'.json'}
+
+# Columnar columns stored as int32 codes into a list of labels in the manifest
+CODED_FIELDS = ['ticker', 'statement', 'row', 'currency']
+
+def iter_records(tickers = None, locations = ['statement'], dropna = True, path = OUTPUT_PATH):
+    """
+    Generator of long format records for saved statements.
+
+    args:
+        tickers: optional dict mapping ticker to a list of statements, like
+        get_available_tickers() returns. Default is everything saved in path.
+        locations: 'statement', 'metrics' or both. Metrics are only in files
+        saved after calculate_metrics().
+        dropna: skip missing values.
+        path: folder statements are saved in.
+
+    yields: (ticker, statement, row, year, value, currency) tuples. year is
+    the int year_adjusted.
+    """
+    tickers = get_available_tickers(path) if tickers == None else tickers
+
+    for ticker in sorted(tickers.keys()):
+        for statement in tickers[ticker]:
+            data = import_statement_json(path + ticker + '_' + statement + '.json')
+            currency = data.get('currency', '')
+            years = [int(x) for x in data['statement']['year_adjusted']]
+            for location in locations:
+                for row, values in data.get(location, dict()).items():
+                    if row in ['year', 'year_adjusted'] or not isinstance(values, (list, np.ndarray)):
+                        continue
+                    for year, value in zip(years, values):
+                        value = np.nan if value == None else float(value)
+                        if dropna and np.isnan(value):
+                            continue
+                        yield (ticker, statement, row, year, value, currency)
+
+def iter_chunks(records, chunk_size = 10000):
+    """
+    Group a record generator into lists of at most chunk_size records.
+    """
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if len(chunk) > 0:
+        yield chunk
+
+def write_csv(chunks, filepath):
+    """
+    Write record chunks to a CSV file with a header line.
+
+    returns: number of records written.
+    """
+    count = 0
+    with open(filepath, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(RECORD_FIELDS)
+        for chunk in chunks:
+            writer.writerows(chunk)
+            count += len(chunk)
+
+    return count
+
+def write_ndjson(chunks, filepath):
+    """
+    Write record chunks to a newline delimited JSON file. NaN is written as null.
+
+    returns: number of records written.
+    """
+    count = 0
+    with open(filepath, 'w') as f:
+        for chunk in chunks:
+            f.write(''.join(json.dumps(dict(zip(RECORD_FIELDS, x[:4] + (None if np.isnan(x[4]) else x[4], x[5])))) + '\n' for x in chunk))
+            count += len(chunk)
+
+    return count
+
+def column_file(filepath, field):
+    return filepath[:-len('.json')] + '.' + field + '.bin'
+
+def write_columnar(chunks, filepath):
+    """
+    Write record chunks to one raw binary file per column, appending each
+    chunk, then write the manifest at filepath.
+
+    Labels of coded columns are collected as they're seen, so memory grows
+    with the number of distinct tickers and rows, not records.
+
+    returns: number of records written.
+    """
+    labels = {x:dict() for x in CODED_FIELDS}
+    files = {x:open(column_file(filepath, x), 'wb') for x in RECORD_FIELDS}
+    count = 0
+    try:
+        for chunk in chunks:
+            columns = list(zip(*chunk))
+            for i, field in enumerate(RECORD_FIELDS):
+                if field in CODED_FIELDS:
+                    codes = labels[field]
+                    column = np.array([codes.setdefault(x, len(codes)) for x in columns[i]], dtype = np.int32)
+                elif field == 'year':
+                    column = np.array(columns[i], dtype = np.int32)
+                else:
+                    column = np.array(columns[i], dtype = np.float64)
+                column.tofile(files[field])
+            count += len(chunk)
+    finally:
+        for f in files.values():
+            f.close()
+
+    manifest = dict(count = count,
+                    columns = {x:dict(file = os.path.basename(column_file(filepath, x)),
+                                    dtype = 'float64' if x == 'value' else 'int32',
+                                    labels = list(labels[x].keys()) if x in CODED_FIELDS else None) for x in RECORD_FIELDS})
+    with open(filepath, 'w') as f:
+        json.dump(manifest, f)
+
+    return count
+
+def read_columnar(filepath):
+    """
+    Memory map a columnar export.
+
+    args:
+        filepath: the manifest written by write_columnar().
+
+    returns: dict mapping each field to a read-only np array, plus 'labels'
+    mapping coded fields to their label lists. Decode with
+    labels['ticker'][columns['ticker'][i]].
+    """
+    with open(filepath) as f:
+        manifest = json.load(f)
+
+    folder = os.path.dirname(filepath)
+    columns = dict(labels = dict())
+    for field, column in manifest['columns'].items():
+        if manifest['count'] == 0:
+            columns[field] = np.zeros(0, dtype = column['dtype'])
+        else:
+            columns[field] = np.memmap(os.path.join(folder, column['file']), dtype = column['dtype'], mode = 'r', shape = (manifest['count'],))
+        if column['labels'] != None:
+            columns['labels'][field] = column['labels']
+
+    return columns
+
+def export_shard(tickers, filepath, fmt = 'csv', locations = ['statement'], dropna = True, chunk_size = 10000, path = OUTPUT_PATH):
+    """
+    Stream one set of tickers to one file. Runs in a worker process when
+    export_universe() writes shards in parallel.
+
+    returns: tuple of (filepath, number of records written).
+    """
+    writers = dict(csv = write_csv, ndjson = write_ndjson, columnar = write_columnar)
+    chunks = iter_chunks(iter_records(tickers, locations, dropna, path), chunk_size)
+    count = writers[fmt](chunks, filepath)
+    logger.info('Exported %s records for %s tickers to %s', count, len(tickers), filepath)
+
+    return filepath, count
+
+def export_universe(name = 'universe', fmt = 'csv', tickers = None, shards = 1, workers = None, locations = ['statement'],
+                    dropna = True, chunk_size = 10000, path = OUTPUT_PATH, export_path = EXPORT_PATH):
+    """
+    Export every saved statement in long format.
+
+    args:
+        name: file name prefix. Shards are named <name>_<shard>.
+        fmt: csv, ndjson or columnar. See module docstring.
+        tickers: optional list of tickers. Default is every saved ticker.
+        shards: number of files to split tickers across.
+        workers: worker processes writing shards. Default is one per shard,
+        up to the CPU count. 1 writes shards one after another in this process.
+        locations: 'statement', 'metrics' or both.
+        dropna: skip missing values.
+        chunk_size: records held in memory per writer at a time.
+        path: folder statements are saved in.
+        export_path: folder to write to.
+
+    returns: list of (filepath, record count) tuples, one per shard.
+    """
+    if fmt not in EXPORT_FORMATS.keys():
+        raise ValueError('Invalid format provided. Should be one of {}. Is {}'.format(', '.join(EXPORT_FORMATS.keys()), fmt))
+
+    os.makedirs(export_path, exist_ok = True)
+
+    # STEP 1: Deal tickers into shards. Round robin keeps shards similar in size.
+    available = get_available_tickers(path)
+    names = sorted(available.keys()) if tickers == None else [x for x in tickers if x in available.keys()]
+    shards = max(1, min(shards, len(names)))
+    digits = len(str(shards - 1))
+    jobs = []
+    for i in range(shards):
+        shard_tickers = {x:available[x] for x in names[i::shards]}
+        suffix = '' if shards == 1 else '_' + str(i).zfill(digits)
+        jobs.append((shard_tickers, export_path + name + suffix + EXPORT_FORMATS[fmt]))
+
+    # STEP 2: Write shards
+    workers = min(shards, os.cpu_count() or 1) if workers == None else workers
+    options = dict(fmt = fmt, locations = locations, dropna = dropna, chunk_size = chunk_size, path = path)
+    if workers <= 1 or shards == 1:
+        results = [export_shard(x, filepath, **options) for x, filepath in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            futures = [executor.submit(export_shard, x, filepath, **options) for x, filepath in jobs]
+            results = [x.result() for x in futures]
+
+    logger.info('Exported %s records in %s shards', sum(x[1] for x in results), len(results))
+
+    return results
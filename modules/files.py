@@ -1,9 +1,15 @@
 import json
 import numpy as np
 from modules.cleaning import get_dictkey, listify_nparrays
+from modules.instrumentation import timed, increment
 import os
+import importlib
+import logging
 from definitions import OUTPUT_PATH
 
+logger = logging.getLogger(__name__)
+
+@timed('save_json')
 def save_json(dictlike, filepath):
     """
     Take a dictionary (ideally the dict created by scrape_statement or import_statement)
@@ -18,6 +24,10 @@ def save_json(dictlike, filepath):
     with open(filepath, 'w') as f:
         f.write(statement)
 
+    increment('files_written')
+    increment('bytes_written', len(statement))
+    logger.debug('Saved %s bytes to %s', len(statement), filepath)
+
     return None
 
 def import_json(filepath):
@@ -54,16 +64,18 @@ def import_statement_json(filepath):
 
     return data
 
-def get_available_tickers():
+def get_available_tickers(path = OUTPUT_PATH):
     """
     Return a list of tickers and statements saved to the output directory.
 
     Intended to be used to remind one's self which companies have been stored so far.
 
     Or to make it easy to iterate through saved statements to update them in some way.
+
+    path is the folder to look in. Default is the output directory.
     """
     available_tickers = dict()
-    output_files = os.listdir(OUTPUT_PATH)
+    output_files = os.listdir(path)
 
     for f in output_files:
         ticker = f.split('_')[0]
@@ -74,3 +86,53 @@ def get_available_tickers():
             available_tickers[ticker] = [statement]
 
     return available_tickers
+
+# Functions registered here are called every time company.save_statements()
+# writes statements to the output directory. Lets indexes built over the saved
+# universe (like modules.screening.screen_index) stay current without a rebuild.
+SAVE_HOOKS = []
+
+# Modules that register save hooks when imported. They're imported the first
+# time statements are saved, so every script that saves statements keeps them
+# current without importing them itself.
+SAVE_HOOK_MODULES = ['modules.segments']
+
+def register_save_hook(hook):
+    """
+    Register a function to be called after company.save_statements() writes
+    statements to disk.
+
+    args:
+        hook: function taking (company_object, statements). statements is the
+        list of statement keys (is, bs, cfs) that were just saved.
+
+    returns: None
+    """
+    if hook not in SAVE_HOOKS:
+        SAVE_HOOKS.append(hook)
+
+    return None
+
+def unregister_save_hook(hook):
+    """
+    Stop calling a function previously passed to register_save_hook().
+    """
+    if hook in SAVE_HOOKS:
+        SAVE_HOOKS.remove(hook)
+
+    return None
+
+def run_save_hooks(co, statements):
+    """
+    Helper function of save_statements() method of company() class.
+
+    Calls every registered save hook with the company object and the statements
+    that were just saved.
+    """
+    for module in SAVE_HOOK_MODULES:
+        importlib.import_module(module)
+
+    for hook in list(SAVE_HOOKS):
+        hook(co, statements)
+
+    return None
@@ -1,17 +1,27 @@
-from forex_python.converter import CurrencyRates
 from definitions import ASSET_PATH
 from modules.files import save_json
+from modules.scheduler import get_scheduler, TRANSIENT_ERRORS
 from datetime import datetime
 
-from bs4 import BeautifulSoup
-import requests as r
+# forex_python and bs4 are imported inside the functions that hit
+# the web. Importing them up here slowed down every import of company().
 
 import numpy as np
 
 from datetime import datetime, timedelta
+import logging
 
 import csv
 
+logger = logging.getLogger(__name__)
+
+def forex_file(currency_a, currency_b):
+    """
+    Path of the conversion table saved for currency_a to currency_b, as read
+    by company.convert_currency().
+    """
+    return ASSET_PATH + currency_a.lower() + '_to_' + currency_b.lower() + '.json'
+
 def scrape_conversion_rates(currency_a, currency_b, save = False):
     """
     Alternative to get_conversion_rates(). get calls forex-python api. It's quick,
@@ -21,12 +31,14 @@ def scrape_conversion_rates(currency_a, currency_b, save = False):
     This method can be used to maintain 40-year analysis time frames in
     non-USD financial statements.
     """
+    from bs4 import BeautifulSoup
+
     url = 'https://fxtop.com/en/historical-exchange-rates.php?A=1&C1={}&C2={}&YA=1&DD1=&MM1=&YYYY1=&B=1&P=&I=1&DD2=07&MM2=01&YYYY2=2022&btnOK=Go!'.format(currency_a.upper(), currency_b.upper())
 
-    print('Getting webpage...')
-    response = r.get(url)
+    logger.info('Getting fxtop.com forex table for %s to %s...', currency_a, currency_b)
+    response = get_scheduler().get(url)
     soup = BeautifulSoup(response.text, 'html.parser')
-    print('Done! parsing dom...')
+    logger.info('Done! parsing dom...')
     # forex table is nested two tables down. but it's only table with border of 1
     forex_table = soup.find('table', {'border':1}).find_all('tr')[1:] # skip the header row
 
@@ -40,7 +52,7 @@ def scrape_conversion_rates(currency_a, currency_b, save = False):
         filename = currency_a.lower() + '_to_' + currency_b.lower() + '.json'
         save_json(conversion_rates, ASSET_PATH + filename)
 
-        print('Saving to {}'.format(ASSET_PATH + filename))
+        logger.info('Saving to %s', ASSET_PATH + filename)
 
     return conversion_rates
 
@@ -56,6 +68,9 @@ def get_conversion_rates(currency_a, currency_b, year, granularity = 15):
     currency_a and currency_b are strings. currency codes. Yen is 'JPY'. US
     Dollar is 'USD'.
     """
+    from forex_python.converter import CurrencyRates
+    import requests
+
     c = CurrencyRates()
 
     # Get a list of the dates at which points the forex rates should be collected
@@ -64,8 +79,10 @@ def get_conversion_rates(currency_a, currency_b, year, granularity = 15):
 
     rate_list = np.asarray([])
     for date in date_list:
-        print(date)
-        rate = c.get_rate(currency_a, currency_b, date)
+        logger.debug('Getting %s to %s rate for %s', currency_a, currency_b, date)
+        # Only network errors are retried. RatesNotAvailableError won't go away by asking again.
+        rate = get_scheduler().call('forex_python', c.get_rate, currency_a, currency_b, date,
+                                    retry_on = (requests.ConnectionError, requests.Timeout) + TRANSIENT_ERRORS)
         rate_list = np.append(rate_list, rate)
 
     return rate_list
@@ -147,7 +164,7 @@ def parse_bls_report(report_url):
     Helper function that takes reports at bureau of labor stats site (CPI-U)
     and converts them to a list of rows from the dataset.
     """
-    response = r.get(report_url)
+    response = get_scheduler().get(report_url)
     data = response.text.splitlines()
 
     dataset = []
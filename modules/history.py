@@ -0,0 +1,393 @@
+"""
+Versioned, append-only history of saved statements.
+
+Saving a statement overwrites its file in the output folder, which loses
+restatements. Here every save also appends a version to
+<ticker>_<statement>.ndjson in the history folder. A version only holds the
+cells (row, column, value) that changed since the previous version, plus the
+column and row lists when those changed, stamped with the time it was saved
+and the statement's scraped_at time. A statement loaded, edited and saved
+again is stamped when the edit was saved, not when it was scraped. Columns are identified by report date (or ttm), so a
+restated year is a changed cell and a new year is a new column.
+
+Any statement can be rebuilt as it was saved at a date by replaying versions
+up to it. Every version with changes is also listed in changes.ndjson, one
+line per version, so "what changed since X" across the universe reads one
+small file instead of every statement.
+
+Scrapes that change nothing append a short line with no cells (so the
+statement's last check time is kept), and save_versioned() leaves the output
+file alone.
+
+The state after the newest version is also kept in
+<ticker>_<statement>.snapshot.json, so a save diffs against it instead of
+replaying every version. Only as-of queries replay the log. A snapshot that
+doesn't match the log's size (the log was written without it) is ignored
+and rebuilt by replaying.
+
+Example:
+    changed_since('2022-01-01') # every statement changed this year
+    statement_as_of('AAPL', 'is', '2021-06-30')
+    cell_changes('AAPL', 'is', since = '2021-01-01') # restated values, old and new
+"""
+
+from definitions import OUTPUT_PATH, HISTORY_PATH
+from modules.files import save_json, import_statement_json, get_available_tickers
+from modules.instrumentation import increment
+
+from datetime import datetime, date
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Statement dict keys that describe columns rather than rows
+YEAR_KEYS = ['year', 'year_adjusted']
+
+def history_file(ticker, statement, path = HISTORY_PATH):
+    return path + ticker + '_' + statement + '.ndjson'
+
+def snapshot_file(ticker, statement, path = HISTORY_PATH):
+    return path + ticker + '_' + statement + '.snapshot.json'
+
+def index_file(path = HISTORY_PATH):
+    return path + 'changes.ndjson'
+
+def to_timestamp(when):
+    """
+    ISO format string of a datetime, date or date string, for comparing with
+    version times. None means now.
+    """
+    if when == None:
+        return datetime.now().isoformat(timespec = 'seconds')
+    if isinstance(when, datetime):
+        return when.isoformat(timespec = 'seconds')
+    if isinstance(when, date):
+        return datetime(when.year, when.month, when.day).isoformat(timespec = 'seconds')
+
+    return datetime.fromisoformat(when).isoformat(timespec = 'seconds')
+
+def same_value(a, b):
+    """
+    Cell equality where missing (None or NaN) equals missing.
+    """
+    a_missing = a == None or (isinstance(a, float) and np.isnan(a))
+    b_missing = b == None or (isinstance(b, float) and np.isnan(b))
+    if a_missing or b_missing:
+        return a_missing and b_missing
+
+    return a == b
+
+def empty_state():
+    return dict(at = None, scraped_at = None, company = None, currency = None, columns = [], year_adjusted = [], rows = [], cells = dict())
+
+def apply_version(state, version):
+    """
+    Apply one version line to a replay state. Updates state in place.
+    """
+    state['at'] = version['at']
+    state['scraped_at'] = version.get('scraped_at', version['at'])
+    for key in ['company', 'currency', 'columns', 'year_adjusted', 'rows']:
+        if key in version.keys():
+            state[key] = version[key]
+    for row, column, value in version.get('cells', []):
+        state['cells'][(row, column)] = np.nan if value == None else value
+
+    return state
+
+def read_versions(ticker, statement, path = HISTORY_PATH):
+    """
+    Every version of a statement, oldest first. Empty when there's no history.
+    """
+    if not os.path.exists(history_file(ticker, statement, path)):
+        return []
+
+    with open(history_file(ticker, statement, path)) as f:
+        return [json.loads(x) for x in f if x.strip() != '']
+
+def replay(ticker, statement, as_of = None, path = HISTORY_PATH):
+    """
+    Replay versions up to and including as_of (default is every version).
+
+    returns: replay state dict with at, company, currency, columns,
+    year_adjusted, rows and cells ((row, column) -> value).
+    """
+    as_of = None if as_of == None else to_timestamp(as_of)
+    state = empty_state()
+    for version in read_versions(ticker, statement, path):
+        if as_of != None and version['at'] > as_of:
+            break
+        apply_version(state, version)
+
+    return state
+
+def write_snapshot(ticker, statement, state, path = HISTORY_PATH):
+    """
+    Save a replay state as the statement's snapshot, stamped with the size of
+    the history file it matches. Written to a temporary file and moved into
+    place, so readers never see half a snapshot.
+    """
+    snapshot = {k:v for k, v in state.items() if k != 'cells'}
+    snapshot['cells'] = [[row, column, None if np.isnan(value) else value] for (row, column), value in state['cells'].items()]
+    snapshot['log_size'] = os.path.getsize(history_file(ticker, statement, path))
+
+    filepath = snapshot_file(ticker, statement, path)
+    with open(filepath + '.tmp', 'w') as f:
+        f.write(json.dumps(snapshot))
+    os.replace(filepath + '.tmp', filepath)
+
+    return None
+
+def latest_state(ticker, statement, path = HISTORY_PATH):
+    """
+    Replay state after the newest version. Read from the snapshot when it
+    matches the history file, otherwise replayed from every version.
+    """
+    if not os.path.exists(history_file(ticker, statement, path)):
+        return empty_state()
+
+    if os.path.exists(snapshot_file(ticker, statement, path)):
+        with open(snapshot_file(ticker, statement, path)) as f:
+            snapshot = json.load(f)
+        if snapshot.pop('log_size') == os.path.getsize(history_file(ticker, statement, path)):
+            snapshot['cells'] = {(row, column):np.nan if value == None else value for row, column, value in snapshot['cells']}
+            return snapshot
+
+    logger.debug('No current snapshot of %s %s. Replaying its history.', ticker, statement)
+    increment('history_replays')
+
+    return replay(ticker, statement, path = path)
+
+def state_statement(state):
+    """
+    Turn a replay state into a statement dict, like import_statement_json() returns.
+    """
+    rows = dict(year = list(state['columns']), year_adjusted = list(state['year_adjusted']))
+    for row in state['rows']:
+        rows[row] = np.array([state['cells'].get((row, x), np.nan) for x in state['columns']], dtype = float)
+
+    return dict(company = state['company'], statement = rows, currency = state['currency'], scraped_at = state['scraped_at'])
+
+def diff_statement(state, statement_dict):
+    """
+    Work out the version that takes a replay state to statement_dict.
+
+    returns: version dict without 'at', holding only what changed. Has no
+    keys at all when nothing changed.
+    """
+    rows = statement_dict['statement']
+    columns = list(rows['year'])
+    names = [k for k, v in rows.items() if k not in YEAR_KEYS and isinstance(v, (np.ndarray, list))]
+
+    version = dict()
+    if statement_dict.get('company') != state['company']:
+        version['company'] = statement_dict.get('company')
+    if statement_dict.get('currency') != state['currency']:
+        version['currency'] = statement_dict.get('currency')
+    if columns != state['columns'] or list(rows['year_adjusted']) != state['year_adjusted']:
+        version['columns'] = columns
+        version['year_adjusted'] = list(rows['year_adjusted'])
+    if names != state['rows']:
+        version['rows'] = names
+
+    cells = []
+    for name in names:
+        for column, value in zip(columns, np.asarray(rows[name], dtype = float).tolist()):
+            if not same_value(state['cells'].get((name, column)), value):
+                cells.append([name, column, None if np.isnan(value) else value])
+    if len(cells) > 0:
+        version['cells'] = cells
+
+    return version
+
+def append_line(filepath, record):
+    """
+    Append one JSON line in a single write, so processes appending to the
+    same file don't interleave lines.
+    """
+    with open(filepath, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+    return None
+
+def record_version(ticker, statement, statement_dict, path = HISTORY_PATH, at = None):
+    """
+    Append whatever changed in statement_dict since the last version.
+
+    args:
+        statement_dict: statement dict about to be saved, like
+        company.statements['is']. Its scraped_at is kept on the version.
+        at: the version's time. Default is now. Never earlier than the
+        previous version, so replay() can stop at the first version past as_of.
+
+    returns: the version appended. It has no 'cells' and no column or row
+    lists when nothing changed.
+    """
+    os.makedirs(path, exist_ok = True)
+
+    state = latest_state(ticker, statement, path)
+    version = diff_statement(state, statement_dict)
+    changed = len(version) > 0
+    at = to_timestamp(at)
+    version['at'] = at if state['at'] == None else max(at, state['at'])
+    version['scraped_at'] = statement_dict.get('scraped_at')
+
+    append_line(history_file(ticker, statement, path), version)
+    write_snapshot(ticker, statement, apply_version(state, version), path)
+    if changed:
+        append_line(index_file(path), dict(at = version['at'], ticker = ticker, statement = statement,
+                                            cells = len(version.get('cells', [])), structure = 'columns' in version.keys() or 'rows' in version.keys()))
+        increment('history_cells_written', len(version.get('cells', [])))
+    else:
+        increment('history_unchanged')
+
+    return version
+
+def save_versioned(ticker, statement, statement_dict, path = OUTPUT_PATH, history_path = HISTORY_PATH, force = False):
+    """
+    Record a statement's version, then save it to the output folder only if
+    it changed.
+
+    Metrics aren't versioned, so statements holding metrics are always written.
+
+    args:
+        force: write the output file even when nothing changed.
+
+    returns: True when the output file was written.
+    """
+    filepath = path + ticker + '_' + statement + '.json'
+    version = record_version(ticker, statement, statement_dict, history_path)
+
+    changed = any(x not in ['at', 'scraped_at'] for x in version.keys())
+    if force or changed or 'metrics' in statement_dict.keys() or not os.path.exists(filepath):
+        save_json(statement_dict, filepath)
+        return True
+
+    logger.info('%s %s unchanged since last save. Kept the saved file.', ticker, statement)
+
+    return False
+
+def last_checked(ticker, statement, path = HISTORY_PATH):
+    """
+    Newest scraped_at of any version of a statement, changed or not, as a
+    datetime. Saves of edited statements keep their scrape time, so they
+    don't count as checks. None when there's no history.
+    """
+    versions = read_versions(ticker, statement, path)
+    checked = [x.get('scraped_at') or x['at'] for x in versions]
+    if len(checked) == 0:
+        return None
+
+    return datetime.fromisoformat(max(to_timestamp(x) for x in checked))
+
+def statement_as_of(ticker, statement, as_of, path = HISTORY_PATH):
+    """
+    Rebuild a statement as it was saved at a date.
+
+    returns: statement dict like import_statement_json() returns, or None when
+    there's no version as old as as_of.
+    """
+    state = replay(ticker, statement, as_of, path)
+    if state['at'] == None:
+        return None
+
+    return state_statement(state)
+
+def company_as_of(ticker, as_of, statements = ['is','bs','cfs'], path = HISTORY_PATH):
+    """
+    Rebuild a company object from its statements as they were saved at a date.
+    Statements with no version that old are left out.
+    """
+    from modules.classes import company
+
+    co = company(ticker, method = None)
+    for statement in statements:
+        rebuilt = statement_as_of(ticker, statement, as_of, path)
+        if rebuilt != None:
+            co.statements[statement] = rebuilt
+            co.currency = rebuilt['currency']
+    co.index_metrics()
+
+    return co
+
+def changed_since(since, until = None, tickers = None, path = HISTORY_PATH):
+    """
+    Every version with changes saved after since, across the universe.
+    Reads only the changes index.
+
+    args:
+        since, until: datetimes, dates or ISO date strings. until is inclusive.
+        tickers: optional list of tickers to keep.
+
+    returns: list of dicts with at, ticker, statement, cells (changed cell
+    count) and structure (True when columns or rows changed), oldest first.
+    """
+    if not os.path.exists(index_file(path)):
+        return []
+
+    since = to_timestamp(since)
+    until = None if until == None else to_timestamp(until)
+    tickers = None if tickers == None else set(tickers)
+
+    changes = []
+    with open(index_file(path)) as f:
+        for line in f:
+            # Index lines start with their time, so most lines are skipped without parsing
+            if line.strip() == '' or line[8:8 + len(since)] <= since:
+                continue
+            change = json.loads(line)
+            if (until == None or change['at'] <= until) and (tickers == None or change['ticker'] in tickers):
+                changes.append(change)
+
+    return sorted(changes, key = lambda x: x['at'])
+
+def cell_changes(ticker, statement, since = None, until = None, path = HISTORY_PATH):
+    """
+    Every changed cell of one statement, with its value before and after.
+    Restatements are cells whose column already had a value.
+
+    returns: list of dicts with at, row, column, old and new. old is None
+    for cells that didn't exist before.
+    """
+    since = None if since == None else to_timestamp(since)
+    until = None if until == None else to_timestamp(until)
+
+    changes = []
+    state = empty_state()
+    for version in read_versions(ticker, statement, path):
+        if until != None and version['at'] > until:
+            break
+        if since == None or version['at'] > since:
+            for row, column, value in version.get('cells', []):
+                old = state['cells'].get((row, column))
+                changes.append(dict(at = version['at'], row = row, column = column,
+                                    old = None if old == None or np.isnan(old) else old, new = value))
+        apply_version(state, version)
+
+    return changes
+
+def seed_history(path = OUTPUT_PATH, history_path = HISTORY_PATH):
+    """
+    Record every statement already in the output folder that has no history
+    yet, at its scraped_at time (or the file's modification time). Run once before relying on as-of queries.
+
+    returns: number of statements seeded.
+    """
+    seeded = 0
+    for ticker, statements in get_available_tickers(path).items():
+        for statement in statements:
+            if os.path.exists(history_file(ticker, statement, history_path)):
+                continue
+            filepath = path + ticker + '_' + statement + '.json'
+            saved = import_statement_json(filepath)
+            if 'scraped_at' not in saved.keys():
+                saved['scraped_at'] = datetime.fromtimestamp(os.path.getmtime(filepath)).isoformat(timespec = 'seconds')
+            record_version(ticker, statement, saved, history_path, at = saved['scraped_at'])
+            seeded += 1
+
+    logger.info('Seeded history for %s statements', seeded)
+
+    return seeded
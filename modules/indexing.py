@@ -0,0 +1,82 @@
+"""
+Plumbing shared by indexes kept over the saved universe, like
+modules.screening.screen_index and modules.similarity.trajectory_index.
+
+A universe_index can watch company.save_statements() and refresh only the
+ticker that was saved, and can save its arrays to the indexes folder so it
+doesn't have to be rebuilt from every saved statement on the next run.
+
+Subclasses implement:
+    update(co): replace (or add) one company in the index.
+    index_file(): default file save_index() and load_index() use.
+    index_arrays(): dict of name -> np array to save.
+    restore_index(data): rebuild the index from arrays load_index() read.
+"""
+
+from definitions import INDEX_PATH
+from modules.universe import load_companies
+from modules.files import register_save_hook, unregister_save_hook
+
+import os
+
+import numpy as np
+
+class universe_index():
+    """
+    Base class for indexes refreshed one ticker at a time on save.
+    """
+    def index_file(self):
+        return INDEX_PATH + 'index.npz'
+
+    def refresh_ticker(self, co, statements = None):
+        """
+        Save hook. Re-imports every saved statement of the company that was just
+        saved, calculates its metrics and updates the index with them.
+
+        Segments (companies with a list of tickers) are never saved to the
+        output folder, so they're ignored.
+        """
+        if not isinstance(co.ticker, str):
+            return None
+
+        refreshed = load_companies([co.ticker])
+        if len(refreshed) > 0:
+            self.update(refreshed[0])
+
+        return None
+
+    def watch(self):
+        """
+        Keep this index current by refreshing a ticker every time
+        company.save_statements() writes it.
+        """
+        register_save_hook(self.refresh_ticker)
+
+        return None
+
+    def unwatch(self):
+        """
+        Stop refreshing this index on save.
+        """
+        unregister_save_hook(self.refresh_ticker)
+
+        return None
+
+    def save_index(self, filepath = None):
+        """
+        Save the index to disk. Default file is index_file().
+        """
+        filepath = self.index_file() if filepath == None else filepath
+        os.makedirs(os.path.dirname(filepath), exist_ok = True)
+        np.savez(filepath, **self.index_arrays())
+
+        return None
+
+    def load_index(self, filepath = None):
+        """
+        Restore an index saved with save_index(). Default file is index_file().
+        """
+        filepath = self.index_file() if filepath == None else filepath
+        self.restore_index(np.load(filepath))
+
+        return None
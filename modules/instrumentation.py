@@ -0,0 +1,231 @@
+"""
+Timing spans and counters for the scrape pipeline.
+
+Wrap a function with @timed('name') or a block with `with span('name'):` and
+every call is recorded twice:
+    1. In RUN_METRICS, a plain dict summary of the current run that can be
+    written to JSON with write_run_summary().
+    2. In a prometheus_client registry, exposed in Prometheus text format by
+    prometheus_text(), write_prometheus_file() or start_metrics_server().
+
+prometheus_client is only imported the first time something is recorded.
+
+Work done in other processes (like modules.pipeline's parsers) records into
+that process's metrics. Wrap it in capture_metrics(), send what was captured
+back with the result and replay it in the parent with merge_metrics().
+
+Example:
+    reset_run_metrics()
+    co = company('AAPL', method = 'scrape')
+    write_run_summary('scrape_run.json')
+    write_prometheus_file('scrape.prom')
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+# Prefix of every metric name exposed to Prometheus
+METRIC_PREFIX = 'financial_reporting'
+
+# Summary of the current run. Reset with reset_run_metrics().
+RUN_METRICS = dict(started = datetime.now().isoformat(timespec = 'seconds'), spans = dict(), counters = dict())
+
+# prometheus_client objects, created on first use by get_prometheus_metrics()
+PROMETHEUS = dict()
+
+# Scrape workers may record from several threads at once
+LOCK = threading.Lock()
+
+# Spans and counters recorded inside capture_metrics(), per thread
+CAPTURED = threading.local()
+
+def get_prometheus_metrics():
+    """
+    Create (once) and return the prometheus_client registry and metrics this
+    module records to.
+
+    returns: dict with registry, span_seconds (Histogram), span_errors and
+    events (Counters).
+    """
+    with LOCK:
+        if len(PROMETHEUS) == 0:
+            from prometheus_client import CollectorRegistry, Counter, Histogram
+
+            registry = CollectorRegistry()
+            PROMETHEUS['registry'] = registry
+            PROMETHEUS['span_seconds'] = Histogram(METRIC_PREFIX + '_span_seconds', 'Time spent in each scrape pipeline stage.',
+                                                    ['span'], registry = registry,
+                                                    buckets = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+            PROMETHEUS['span_errors'] = Counter(METRIC_PREFIX + '_span_errors', 'Scrape pipeline stages that raised an exception.',
+                                                ['span'], registry = registry)
+            PROMETHEUS['events'] = Counter(METRIC_PREFIX + '_events', 'Counts of scrape pipeline events.',
+                                            ['event'], registry = registry)
+
+    return PROMETHEUS
+
+def record_span(name, seconds, error = False):
+    """
+    Record one timed call of a pipeline stage.
+    """
+    metrics = get_prometheus_metrics()
+    metrics['span_seconds'].labels(span = name).observe(seconds)
+    if error:
+        metrics['span_errors'].labels(span = name).inc()
+
+    with LOCK:
+        summary = RUN_METRICS['spans'].setdefault(name, dict(count = 0, errors = 0, total_seconds = 0.0, max_seconds = 0.0))
+        summary['count'] += 1
+        summary['errors'] += int(error)
+        summary['total_seconds'] += seconds
+        summary['max_seconds'] = max(summary['max_seconds'], seconds)
+
+    captured = getattr(CAPTURED, 'metrics', None)
+    if captured != None:
+        captured['spans'].append((name, seconds, error))
+
+    logger.debug('%s took %.3fs', name, seconds)
+
+    return None
+
+def increment(name, amount = 1):
+    """
+    Add amount to a named counter, like rows_parsed or bytes_written.
+    """
+    get_prometheus_metrics()['events'].labels(event = name).inc(amount)
+
+    with LOCK:
+        RUN_METRICS['counters'][name] = RUN_METRICS['counters'].get(name, 0) + amount
+
+    captured = getattr(CAPTURED, 'metrics', None)
+    if captured != None:
+        captured['counters'][name] = captured['counters'].get(name, 0) + amount
+
+    return None
+
+@contextmanager
+def capture_metrics():
+    """
+    Context manager that collects every span and counter recorded in the
+    block by this thread, besides recording them as usual.
+
+    yields: dict with spans (list of (name, seconds, error) tuples) and
+    counters (name -> amount). Plain data, so it can be pickled back from a
+    worker process and passed to merge_metrics().
+    """
+    captured = dict(spans = [], counters = dict())
+    CAPTURED.metrics = captured
+    try:
+        yield captured
+    finally:
+        CAPTURED.metrics = None
+
+def merge_metrics(captured):
+    """
+    Record spans and counters collected by capture_metrics(), usually in
+    another process, as if they had been recorded here.
+    """
+    for name, seconds, error in captured['spans']:
+        record_span(name, seconds, error = error)
+    for name, amount in captured['counters'].items():
+        increment(name, amount)
+
+    return None
+
+@contextmanager
+def span(name):
+    """
+    Context manager that times the block it wraps as a span called name.
+    Exceptions are counted against the span and then re-raised.
+    """
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        record_span(name, time.perf_counter() - start, error = error)
+
+def timed(name):
+    """
+    Decorator version of span(). Times every call of the wrapped function.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+def reset_run_metrics():
+    """
+    Start a fresh run summary. Prometheus metrics keep accumulating, since
+    scrapers of the metrics endpoint expect monotonic counters.
+    """
+    with LOCK:
+        RUN_METRICS['started'] = datetime.now().isoformat(timespec = 'seconds')
+        RUN_METRICS['spans'] = dict()
+        RUN_METRICS['counters'] = dict()
+
+    return None
+
+def get_run_summary():
+    """
+    Return the current run summary with mean span times filled in.
+    """
+    with LOCK:
+        spans = {k:dict(v, mean_seconds = v['total_seconds'] / v['count'] if v['count'] else 0.0) for k, v in RUN_METRICS['spans'].items()}
+        summary = dict(started = RUN_METRICS['started'],
+                        finished = datetime.now().isoformat(timespec = 'seconds'),
+                        spans = spans,
+                        counters = dict(RUN_METRICS['counters']))
+
+    return summary
+
+def write_run_summary(filepath):
+    """
+    Save the current run summary as JSON.
+    """
+    with open(filepath, 'w') as f:
+        json.dump(get_run_summary(), f, indent = 2)
+
+    return None
+
+def prometheus_text():
+    """
+    Return every recorded metric in Prometheus text exposition format.
+    """
+    from prometheus_client import generate_latest
+
+    return generate_latest(get_prometheus_metrics()['registry']).decode('utf-8')
+
+def write_prometheus_file(filepath):
+    """
+    Save metrics in Prometheus text format. Point node_exporter's textfile
+    collector at the folder to pick up metrics from nightly batch runs.
+    """
+    with open(filepath, 'w') as f:
+        f.write(prometheus_text())
+
+    return None
+
+def start_metrics_server(port = 8000):
+    """
+    Serve metrics over http for Prometheus to scrape while a long run is going.
+    """
+    from prometheus_client import start_http_server
+
+    start_http_server(port, registry = get_prometheus_metrics()['registry'])
+    logger.info('Serving Prometheus metrics on port %s', port)
+
+    return None
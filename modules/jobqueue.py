@@ -0,0 +1,366 @@
+"""
+Resumable scrape job queue.
+
+company(..., method = 'scrape') only saves once every statement is scraped,
+so a crash hours into a universe scrape loses everything. Here each
+(ticker, statement) is a job in a store that any number of workers pull from:
+    - A worker claims a job with a lease. While it works, a heartbeat thread
+    keeps extending the lease.
+    - Each finished statement is written through company.save_statements()
+    right away, so save hooks run and nothing finished is lost.
+    - A worker that crashes stops heartbeating. Its lease runs out and another
+    worker picks the job up. Jobs that keep failing are marked failed after
+    max_attempts.
+    - A slow worker whose lease was taken over drops its result instead of
+    saving over the new owner's, and never marks the job done.
+    - Rerunning workers against the same store resumes exactly where the last
+    run stopped. Adding workers scales a run out.
+
+sqlite_store keeps jobs in a SQLite file. It's safe for many processes on one
+machine, or machines sharing a filesystem with working file locks. Any object
+with the same methods (add_jobs, claim, heartbeat, complete, fail, counts,
+retry_failed) can be passed to run_worker() instead, e.g. one backed by a
+database server for machines without a shared filesystem.
+
+Example:
+    store = sqlite_store()
+    store.add_jobs([(ticker, statement) for ticker in tickers for statement in ['is','bs','cfs']])
+    run_worker(store) # in as many processes or machines as you like
+"""
+
+from definitions import JOB_PATH
+from modules.classes import company
+from modules.instrumentation import increment
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Job statuses
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    ticker TEXT NOT NULL,
+    statement TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    error TEXT,
+    updated REAL,
+    UNIQUE (ticker, statement)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires);
+"""
+
+class sqlite_store():
+    """
+    Job store backed by a SQLite file.
+    """
+    def __init__(self, filepath = JOB_PATH + 'jobs.sqlite', timeout = 30):
+        """
+        args:
+            filepath: SQLite file holding the jobs. Created if missing.
+            timeout: seconds to wait for another process's lock before failing.
+        """
+        self.filepath = filepath
+        self.timeout = timeout
+
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        connection = self.connect()
+        try:
+            # WAL lets readers (status checks, heartbeats) work while a claim writes
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+
+    def connect(self):
+        """
+        Open a new connection. Connections aren't shared between threads, so
+        every call gets its own.
+        """
+        return sqlite3.connect(self.filepath, timeout = self.timeout, isolation_level = None)
+
+    def execute(self, sql, params = ()):
+        """
+        Run one statement in its own transaction.
+
+        returns: number of rows changed.
+        """
+        connection = self.connect()
+        try:
+            return connection.execute(sql, params).rowcount
+        finally:
+            connection.close()
+
+    def add_jobs(self, jobs):
+        """
+        Queue (ticker, statement) jobs. Jobs already in the store, done or not,
+        are left alone, so adding the same universe twice is harmless.
+
+        returns: number of new jobs.
+        """
+        connection = self.connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            before = connection.total_changes
+            connection.executemany('INSERT OR IGNORE INTO jobs (ticker, statement, updated) VALUES (?, ?, ?)',
+                                    [(x[0], x[1], time.time()) for x in jobs])
+            added = connection.total_changes - before
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+        return added
+
+    def claim(self, worker, lease_seconds = 300, max_attempts = 3):
+        """
+        Lease the next pending job, or a leased job whose lease ran out.
+
+        returns: dict with id, ticker, statement and attempts, or None when no
+        job is available.
+        """
+        now = time.time()
+        connection = self.connect()
+        try:
+            # IMMEDIATE takes the write lock up front, so two workers can't claim the same row
+            connection.execute('BEGIN IMMEDIATE')
+            # Workers that crashed on a job's last attempt never call fail(). Fail those jobs here,
+            # or they'd sit leased forever and keep waiting workers polling.
+            connection.execute('UPDATE jobs SET status = ?, error = ?, updated = ? WHERE status = ? AND lease_expires < ? AND attempts >= ?',
+                                (FAILED, 'Lease expired on the last attempt', now, LEASED, now, max_attempts))
+            row = connection.execute('SELECT id, ticker, statement, attempts FROM jobs '
+                                    'WHERE (status = ? OR (status = ? AND lease_expires < ?)) AND attempts < ? '
+                                    'ORDER BY id LIMIT 1', (PENDING, LEASED, now, max_attempts)).fetchone()
+            if row != None:
+                connection.execute('UPDATE jobs SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1, updated = ? WHERE id = ?',
+                                    (LEASED, worker, now + lease_seconds, now, row[0]))
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+        if row == None:
+            return None
+
+        return dict(id = row[0], ticker = row[1], statement = row[2], attempts = row[3] + 1)
+
+    def heartbeat(self, job_id, worker, lease_seconds = 300):
+        """
+        Extend a lease. Returns False if the worker no longer holds it.
+        """
+        now = time.time()
+        changed = self.execute('UPDATE jobs SET lease_expires = ?, updated = ? WHERE id = ? AND worker = ? AND status = ?',
+                                (now + lease_seconds, now, job_id, worker, LEASED))
+
+        return changed == 1
+
+    def complete(self, job_id, worker):
+        """
+        Mark a job done. Returns False, and leaves the job alone, if the worker
+        no longer holds the lease. The worker that took it over completes it.
+        """
+        owned = self.execute('UPDATE jobs SET status = ?, error = NULL, updated = ? WHERE id = ? AND worker = ? AND status = ?',
+                            (DONE, time.time(), job_id, worker, LEASED))
+
+        return owned == 1
+
+    def fail(self, job_id, worker, error, max_attempts = 3):
+        """
+        Record a failed attempt. The job goes back to pending until it has
+        used up max_attempts, then it's marked failed.
+
+        returns: the job's new status.
+        """
+        connection = self.connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            attempts = connection.execute('SELECT attempts FROM jobs WHERE id = ?', (job_id,)).fetchone()[0]
+            status = FAILED if attempts >= max_attempts else PENDING
+            connection.execute('UPDATE jobs SET status = ?, worker = NULL, lease_expires = NULL, error = ?, updated = ? WHERE id = ? AND worker = ?',
+                                (status, error, time.time(), job_id, worker))
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+        return status
+
+    def counts(self):
+        """
+        Count jobs in each status. Leased jobs whose lease ran out are counted
+        as 'expired', since they'll be picked up again.
+        """
+        connection = self.connect()
+        try:
+            rows = connection.execute('SELECT CASE WHEN status = ? AND lease_expires < ? THEN ? ELSE status END, COUNT(*) FROM jobs GROUP BY 1',
+                                        (LEASED, time.time(), 'expired')).fetchall()
+        finally:
+            connection.close()
+
+        counts = {x:0 for x in [PENDING, LEASED, 'expired', DONE, FAILED]}
+        counts.update(dict(rows))
+
+        return counts
+
+    def failures(self):
+        """
+        List failed jobs as (ticker, statement, attempts, error) tuples.
+        """
+        connection = self.connect()
+        try:
+            return connection.execute('SELECT ticker, statement, attempts, error FROM jobs WHERE status = ? ORDER BY id', (FAILED,)).fetchall()
+        finally:
+            connection.close()
+
+    def retry_failed(self):
+        """
+        Put failed jobs back in the queue with their attempts reset.
+
+        returns: number of jobs requeued.
+        """
+        return self.execute('UPDATE jobs SET status = ?, attempts = 0, updated = ? WHERE status = ?', (PENDING, time.time(), FAILED))
+
+def default_worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+def keep_leased(store, job, worker, lease_seconds, heartbeat_seconds, stop, lost):
+    """
+    Heartbeat thread. Extends a job's lease every heartbeat_seconds until
+    stop is set. Sets lost if another worker took the job over.
+    """
+    while not stop.wait(heartbeat_seconds):
+        if not store.heartbeat(job['id'], worker, lease_seconds):
+            logger.warning('Lost the lease on %s %s', job['ticker'], job['statement'])
+            lost.set()
+            return None
+
+    return None
+
+def scrape_job(driver, job, skip_rows):
+    """
+    Scrape one statement with an open web driver.
+
+    returns: the statement dict, like scrape_statement() returns.
+    """
+    # Imported here so importing the queue doesn't pull in the scraping stack twice over
+    from modules.scraping import load_statement_page, parse_statement_page, dictify_statement
+
+    page_source = load_statement_page(driver, job['ticker'], job['statement'])
+    statement_heading, statement_rows = parse_statement_page(page_source)
+
+    return dictify_statement(statement_heading, statement_rows, job['ticker'], skip_rows)
+
+def save_job(job, statement_dict, merge = False):
+    """
+    Save a scraped job through company.save_statements(), so save hooks run.
+
+    args:
+        merge: merge into the saved statement with
+        modules.refresh.save_merged_statement() instead of replacing it.
+    """
+    if merge:
+        from modules.refresh import save_merged_statement
+        save_merged_statement(job['ticker'], job['statement'], statement_dict)
+    else:
+        co = company(job['ticker'], method = None)
+        co.statements[job['statement']] = statement_dict
+        co.save_statements([job['statement']])
+
+    return None
+
+def run_worker(store, worker = None, lease_seconds = 300, heartbeat_seconds = 60, max_attempts = 3, merge = False,
+                wait_for_leases = True, poll_seconds = 10, max_jobs = None, scrape = scrape_job, create_driver = None):
+    """
+    Pull jobs from a store and scrape them until none are left.
+
+    args:
+        store: sqlite_store or any object with the same methods.
+        worker: name recorded on leases. Default is hostname:pid.
+        lease_seconds: how long a job stays claimed without a heartbeat.
+        heartbeat_seconds: how often the lease is extended while scraping.
+        max_attempts: attempts before a job is marked failed.
+        merge: merge results into saved statements instead of replacing them.
+        wait_for_leases: when the queue is empty but other workers hold
+        leases, wait in case their leases run out. False exits right away.
+        poll_seconds: wait between checks while waiting on leases.
+        max_jobs: stop after this many jobs. Default runs until the queue is empty.
+        scrape: function taking (driver, job, skip_rows) that scrapes one job
+        and returns its statement dict. Default is scrape_job(). Results are
+        saved with save_job() only while this worker still holds the lease.
+        create_driver: function returning a web driver. Default is
+        modules.scraping.create_webdriver().
+
+    returns: dict counting jobs completed and failed by this worker.
+    """
+    if create_driver == None:
+        from modules.scraping import create_webdriver as create_driver
+
+    worker = default_worker_name() if worker == None else worker
+    skip_rows = company(method = None).metrics_rows
+    summary = dict(completed = 0, failed = 0)
+
+    driver = None
+    try:
+        while max_jobs == None or summary['completed'] + summary['failed'] < max_jobs:
+            job = store.claim(worker, lease_seconds, max_attempts)
+            if job == None:
+                counts = store.counts()
+                if wait_for_leases and counts[LEASED] + counts['expired'] > 0:
+                    time.sleep(poll_seconds)
+                    continue
+                break
+
+            logger.info('%s claimed %s %s (attempt %s)', worker, job['ticker'], job['statement'], job['attempts'])
+            stop = threading.Event()
+            lost = threading.Event()
+            heartbeat = threading.Thread(target = keep_leased, args = (store, job, worker, lease_seconds, heartbeat_seconds, stop, lost), daemon = True)
+            heartbeat.start()
+            try:
+                if driver == None:
+                    driver = create_driver()
+                statement_dict = scrape(driver, job, skip_rows)
+
+                # Another worker took the job over while this one scraped. Its result wins, so drop this one.
+                if lost.is_set() or not store.heartbeat(job['id'], worker, lease_seconds):
+                    logger.warning('%s dropped its result for %s %s after losing the lease', worker, job['ticker'], job['statement'])
+                    increment('queue_results_dropped')
+                    continue
+
+                save_job(job, statement_dict, merge)
+                if store.complete(job['id'], worker):
+                    summary['completed'] += 1
+                    increment('queue_jobs_completed')
+            except Exception as e:
+                logger.exception('%s failed %s %s', worker, job['ticker'], job['statement'])
+                status = store.fail(job['id'], worker, repr(e), max_attempts)
+                summary['failed'] += int(status == FAILED)
+                increment('queue_jobs_failed')
+                # A broken browser fails every later job, so start a fresh one
+                if driver != None:
+                    try:
+                        driver.quit()
+                    except Exception:
+                        pass
+                    driver = None
+            finally:
+                stop.set()
+                heartbeat.join()
+    finally:
+        if driver != None:
+            driver.quit()
+
+    logger.info('%s finished. %s completed, %s failed.', worker, summary['completed'], summary['failed'])
+
+    return summary
@@ -0,0 +1,148 @@
+"""
+Peer benchmarking. Ranks every company against its segment on every metric,
+for every year, in one batched operation over a cube (see modules.universe).
+
+Replaces looping through plot_companies() output by hand to see where a
+company sits among its peers.
+
+Example:
+    segment = load_companies(['AAPL','MSFT','GOOG'])
+    ranks = peer_percentiles(segment, segment_name = 'big_tech')
+    company_percentiles(ranks, 'AAPL')['net_margin']
+"""
+
+from modules.universe import load_companies, stack_companies, cube_names, company_label
+from modules.files import register_save_hook
+
+import numpy as np
+
+# Results of peer_percentiles(), keyed by segment definition.
+# Entries are dropped when any member of the segment is saved again.
+RANK_CACHE = dict()
+
+def rank_values(values, axis = 0):
+    """
+    Rank values along one axis of an array of any shape, ignoring NaN.
+
+    Ties get the average of the ranks they span, like the 'average' method of
+    pandas' rank(). Ranks start at 1 for the lowest value.
+
+    args:
+        values: np array. Usually a cube's values (tickers x keys x years).
+        axis: axis to rank along. Default ranks companies against each other.
+
+    returns: tuple of (ranks, percentiles, counts).
+        ranks: array shaped like values. NaN where values are NaN.
+        percentiles: 0 for the lowest valid value, 100 for the highest.
+        A company with no peers in a year gets 100.
+        counts: number of valid values ranked in each slot of the other axes.
+    """
+    v = np.moveaxis(np.asarray(values, dtype = float), axis, 0)
+    n = v.shape[0]
+    missing = np.isnan(v)
+
+    # STEP 1: Sort along the ranked axis. NaN sorts to the end of every slot.
+    order = np.argsort(v, axis = 0, kind = 'stable')
+    sorted_values = np.take_along_axis(v, order, axis = 0)
+    positions = np.broadcast_to(np.arange(n).reshape((n,) + (1,) * (v.ndim - 1)), v.shape)
+
+    # STEP 2: Find the first and last sorted position of each run of tied values
+    starts = np.ones(v.shape, dtype = bool)
+    starts[1:] = sorted_values[1:] != sorted_values[:-1]
+    ends = np.ones(v.shape, dtype = bool)
+    ends[:-1] = sorted_values[1:] != sorted_values[:-1]
+
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis = 0)
+    last = np.flip(np.minimum.accumulate(np.flip(np.where(ends, positions, n - 1), axis = 0), axis = 0), axis = 0)
+
+    # STEP 3: Average rank of each tie run, scattered back to the unsorted order
+    ranks = np.empty(v.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2 + 1, axis = 0)
+    ranks[missing] = np.nan
+
+    counts = np.count_nonzero(~missing, axis = 0)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        percentiles = np.where(counts > 1, (ranks - 1) / (counts - 1) * 100, 100.0)
+    percentiles[missing] = np.nan
+
+    return np.moveaxis(ranks, 0, axis), np.moveaxis(percentiles, 0, axis), counts
+
+def peer_percentiles(companies, segment_name = None, locations = ['metrics'], names = None, use_cache = True):
+    """
+    Rank every company in a segment on every metric and year at once.
+
+    args:
+        companies: list of company objects with metrics calculated.
+        segment_name: optional label for the segment. Cache entries are keyed by
+        this name plus the member tickers, so two segments with the same
+        members but different names are cached separately.
+        locations: statement dicts to rank. Add 'statement' to rank raw rows.
+        names: optional list of metric names to rank. Default ranks all.
+        use_cache: return a cached result for the same segment definition when
+        one exists.
+
+    returns: dict with the cube's tickers, keys and years, plus values, ranks,
+    percentiles (all tickers x keys x years) and counts (keys x years).
+    """
+    segment_key = (segment_name, tuple(sorted(company_label(x) for x in companies)),
+                    tuple(locations), None if names == None else tuple(names))
+
+    if use_cache and segment_key in RANK_CACHE.keys():
+        return RANK_CACHE[segment_key]
+
+    cube = stack_companies(companies, locations = locations, names = names)
+    ranks, percentiles, counts = rank_values(cube['values'], axis = 0)
+
+    result = dict(segment = segment_name,
+                    tickers = cube['tickers'],
+                    keys = cube['keys'],
+                    years = cube['years'],
+                    values = cube['values'],
+                    ranks = ranks,
+                    percentiles = percentiles,
+                    counts = counts)
+
+    RANK_CACHE[segment_key] = result
+
+    return result
+
+def segment_percentiles(tickers, segment_name = None, locations = ['metrics'], names = None):
+    """
+    Same as peer_percentiles(), but imports the segment's members from the
+    output folder first.
+    """
+    segment_key = (segment_name, tuple(sorted(tickers)), tuple(locations), None if names == None else tuple(names))
+    if segment_key in RANK_CACHE.keys():
+        return RANK_CACHE[segment_key]
+
+    return peer_percentiles(load_companies(tickers), segment_name = segment_name, locations = locations, names = names)
+
+def company_percentiles(result, ticker, measure = 'percentiles'):
+    """
+    Pull one company's results out of a peer_percentiles() result.
+
+    args:
+        result: dict returned by peer_percentiles().
+        ticker: ticker to pull.
+        measure: 'percentiles' or 'ranks'.
+
+    returns: dict mapping metric name to an np array aligned with result['years']
+    (newest first, like statements).
+    """
+    i = result['tickers'].index(ticker)
+
+    return {name:result[measure][i, j, :] for j, name in enumerate(cube_names(result))}
+
+def invalidate_cached_ranks(co, statements = None):
+    """
+    Save hook. Drops cached results for every segment the saved company is a
+    member of, so the next peer_percentiles() call re-ranks with new data.
+    """
+    label = company_label(co)
+    stale = [k for k in RANK_CACHE.keys() if label in k[1]]
+    for k in stale:
+        RANK_CACHE.pop(k)
+
+    return None
+
+register_save_hook(invalidate_cached_ranks)
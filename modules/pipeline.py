@@ -0,0 +1,186 @@
+"""
+Staged scrape pipeline for large universes.
+
+scrape_statement() drives the browser and parses the DOM in the same thread,
+so the browser sits idle while BeautifulSoup and clean_numeric() churn, and
+vice versa. This module splits those stages:
+
+    browser threads -> page queue -> parser process pool -> statement files
+
+Each browser thread owns one web driver and only loads and expands pages
+(load_statement_page()). Page sources go onto a bounded queue. A process pool
+parses them (parse_statement_page() + dictify_statement()) and writes the
+statement JSON. When parsers fall behind, the page queue fills up and
+browsers wait. When browsers fall behind, parsers simply idle.
+
+NOTE: On Windows, call run_pipeline() from under an if __name__ == '__main__':
+guard, since parser processes re-import the calling script.
+
+Example:
+    run_pipeline([('AAPL','is'), ('AAPL','bs'), ('MSFT','is')], browsers = 2)
+"""
+
+from modules.classes import company
+from modules.scraping import create_webdriver, load_statement_page, parse_statement_page, dictify_statement
+from modules.files import run_save_hooks
+from modules.history import save_versioned
+from modules.validation import log_problems
+from modules.instrumentation import span, increment, capture_metrics, merge_metrics
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Put on the page queue by each browser thread when it runs out of jobs
+BROWSER_DONE = 'BROWSER_DONE'
+
+def parse_and_save(ticker, statement, page_source, skip_rows, currency = '[Unspecified Currency]', save = True):
+    """
+    Parser stage. Runs in a worker process.
+
+    Parses a page source into a statement dict and saves it to the output
+    folder the same way company.save_statements() does.
+
+    returns: tuple of (statement dict, True when the output file was
+    written, spans and counters recorded in this process). Statements that
+    didn't change since the last save aren't written. The parent passes the
+    spans and counters to merge_metrics(), since this process's metrics
+    never reach it otherwise.
+    """
+    with capture_metrics() as metrics:
+        with span('pipeline_parse'):
+            statement_heading, statement_rows = parse_statement_page(page_source)
+            statement_dict = dictify_statement(statement_heading, statement_rows, ticker, skip_rows)
+            statement_dict['currency'] = currency
+
+            written = save_versioned(ticker, statement, statement_dict) if save else False
+
+    return statement_dict, written, metrics
+
+def browser_worker(job_queue, page_queue, failures):
+    """
+    Browser stage. Runs in a thread with its own web driver.
+
+    Pulls (ticker, statement) jobs until it finds a None, loading each page
+    and putting (job, page_source) on the page queue. put() blocks while the
+    queue is full, which is what keeps browsers from outrunning parsers.
+    """
+    driver = None
+    try:
+        driver = create_webdriver()
+        while True:
+            job = job_queue.get()
+            if job == None:
+                break
+            try:
+                page_source = load_statement_page(driver, job[0], job[1])
+                page_queue.put((job, page_source))
+            except Exception as e:
+                logger.exception('Failed to load %s %s', job[0], job[1])
+                failures[job] = repr(e)
+                increment('pipeline_load_failures')
+    except Exception:
+        # Jobs this browser would have loaded stay queued for the other browsers
+        logger.exception('Browser failed to start')
+        increment('pipeline_browser_failures')
+    finally:
+        # Always signal done, even when the driver couldn't start, or run_pipeline() waits forever
+        try:
+            if driver != None:
+                driver.quit()
+        finally:
+            page_queue.put(BROWSER_DONE)
+
+    return None
+
+def run_pipeline(jobs, browsers = 2, parsers = None, queue_size = 8, skip_rows = None, save = True):
+    """
+    Scrape many statements with browsers and parsers running side by side.
+
+    args:
+        jobs: list of (ticker, statement) tuples. statement is is, bs or cfs.
+        browsers: number of browser threads (web drivers) loading pages.
+        parsers: number of parser processes. Default is one per cpu.
+        queue_size: most page sources waiting to be parsed, and most parse jobs
+        in flight, at any time. Bounds memory and provides backpressure.
+        skip_rows: rows to leave out of statements, like company.metrics_rows.
+        Default is company.metrics_rows.
+        save: write each parsed statement to the output folder.
+
+    returns: dict with 'statements', mapping (ticker, statement) to the
+    statement dict, and 'failures', mapping (ticker, statement) to an error.
+    """
+    skip_rows = company(method = None).metrics_rows if skip_rows == None else skip_rows
+
+    job_queue = queue.Queue()
+    for job in jobs:
+        job_queue.put(tuple(job))
+    # One stop signal per browser
+    for i in range(browsers):
+        job_queue.put(None)
+
+    page_queue = queue.Queue(maxsize = queue_size)
+    statements = dict()
+    failures = dict()
+
+    threads = [threading.Thread(target = browser_worker, args = (job_queue, page_queue, failures), daemon = True) for i in range(browsers)]
+    for thread in threads:
+        thread.start()
+
+    def collect(done):
+        for future in done:
+            job = futures.pop(future)
+            try:
+                statement_dict, written, metrics = future.result()
+            except Exception as e:
+                logger.exception('Failed to parse %s %s', job[0], job[1])
+                failures[job] = repr(e)
+                increment('pipeline_parse_failures')
+                continue
+            merge_metrics(metrics)
+            statements[job] = statement_dict
+            logger.info('Parsed %s %s (%s done)', job[0], job[1], len(statements))
+
+            # Log integrity problems of every scraped statement, then let indexes
+            # over the saved universe pick up the ones that were written
+            co = company(job[0], method = None)
+            co.statements[job[1]] = statement_dict
+            log_problems([co], statements = [job[1]])
+            if written:
+                run_save_hooks(co, [job[1]])
+
+    futures = dict()
+    finished_browsers = 0
+    with ProcessPoolExecutor(max_workers = parsers) as pool:
+        while finished_browsers < browsers:
+            item = page_queue.get()
+            if item == BROWSER_DONE:
+                finished_browsers += 1
+                continue
+
+            # Cap parse jobs in flight, so page sources don't pile up in the pool's queue
+            if len(futures) >= queue_size:
+                done, pending = wait(list(futures.keys()), return_when = FIRST_COMPLETED)
+                collect(done)
+
+            job, page_source = item
+            futures[pool.submit(parse_and_save, job[0], job[1], page_source, skip_rows, save = save)] = job
+
+        done, pending = wait(list(futures.keys()))
+        collect(done)
+
+    for thread in threads:
+        thread.join()
+
+    # Jobs left queued when every browser failed to start were never loaded
+    while not job_queue.empty():
+        job = job_queue.get()
+        if job != None:
+            failures[job] = 'No browser available to load the page'
+
+    logger.info('Pipeline finished. %s statements scraped, %s failed.', len(statements), len(failures))
+
+    return dict(statements = statements, failures = failures)
@@ -0,0 +1,224 @@
+"""
+Lazy, fused version of the company() transformations.
+
+A typical analysis runs align_statements(), convert_currency(),
+normalize_statements() and calculate_metrics() one after another. Each of
+them loops over every row and allocates new arrays, and convert_currency()
+aligns rows to forex years on its own. A plan records those steps instead,
+then runs them in one pass per statement:
+    1. Work out, from year lists alone, which years survive every step.
+    2. Combine the forex rate and CPI-U factor of each surviving year into
+    one factor vector.
+    3. Stack the statement's rows into a matrix, select the surviving year
+    columns and multiply by the factor vector once.
+
+Forex rates and CPI-U values are looked up by year, so a statement's years
+don't need to be in the same order as the rates table.
+
+convert_currency() rounds converted values to whole units before
+normalize_statements() inflates them. A fused plan rounds once, and only when
+conversion is its last value step, so values can differ from the step by step
+methods by under one unit.
+
+Results are cached on the company by plan signature and a hash of the
+company's statements, so rows edited in place (by fill_ttm_rows() or by hand)
+are never served a stale result. Methods that change the company's statements
+also clear the cache.
+
+Example:
+    co.plan().align().convert('EUR', 'USD').normalize(cpiu = cpiu).metrics().execute()
+"""
+
+from modules.files import import_json
+from modules.forex import get_cpiu, forex_file
+
+import copy
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+def dict_signature(values):
+    """
+    Short hash of a dict, so plans given the same CPI-U table share a signature.
+    """
+    return hashlib.sha1(json.dumps(values, sort_keys = True).encode()).hexdigest()[:12]
+
+def content_stamp(co):
+    """
+    Short hash of a company's currency, years and row values. Changes
+    whenever any value changes, including edits made in place.
+    """
+    stamp = hashlib.sha1(str(co.currency).encode())
+    for key_statement, statement in co.statements.items():
+        rows = statement.get('statement', dict())
+        for name, value in rows.items():
+            stamp.update('{}:{}:'.format(key_statement, name).encode())
+            if isinstance(value, np.ndarray):
+                stamp.update(np.ascontiguousarray(value, dtype = float).tobytes())
+            else:
+                stamp.update(str(list(value)).encode())
+
+    return stamp.hexdigest()[:12]
+
+class transform_plan():
+    """
+    Records transformation steps on a company and runs them fused. Every
+    recording method returns the plan, so steps chain.
+    """
+    def __init__(self, co):
+        self.company = co
+        self.steps = []
+
+    def align(self):
+        """
+        Keep only years every statement has. See company.align_statements().
+        """
+        self.steps.append(('align', dict()))
+
+        return self
+
+    def convert(self, currency_a, currency_b):
+        """
+        Convert from currency_a to currency_b. See company.convert_currency().
+        """
+        filepath = forex_file(currency_a, currency_b)
+        # The file's modification time is part of the signature, so updated rates aren't served from cache
+        self.steps.append(('convert', dict(currency_a = currency_a, currency_b = currency_b,
+                                            modified = os.path.getmtime(filepath) if os.path.exists(filepath) else None)))
+
+        return self
+
+    def normalize(self, reference_year = 0, origin_currency = 'USD', cpiu = None):
+        """
+        Inflate values to reference_year dollars. See company.normalize_statements().
+
+        cpiu is downloaded now, when not given, so the plan's signature covers it.
+        """
+        if origin_currency != 'USD':
+            self.convert(origin_currency, 'USD')
+
+        cpiu = get_cpiu() if cpiu == None else cpiu
+        self.steps.append(('normalize', dict(reference_year = reference_year, cpiu = cpiu)))
+
+        return self
+
+    def metrics(self):
+        """
+        Calculate metrics on the result. See company.calculate_metrics().
+        """
+        self.steps.append(('metrics', dict()))
+
+        return self
+
+    def signature(self):
+        """
+        Hashable description of the steps, used as the cache key.
+        """
+        steps = []
+        for name, options in self.steps:
+            options = {k:dict_signature(v) if isinstance(v, dict) else v for k, v in options.items()}
+            steps.append((name, tuple(sorted(options.items()))))
+
+        return tuple(steps)
+
+    def resolve(self):
+        """
+        Work out the plan's effect from year lists alone, without touching rows.
+
+        returns: tuple of (years, factors, currency, round_values). years maps
+        each statement to the year_adjusted values that survive every step.
+        factors maps each statement to a np array aligned with those years.
+        """
+        statements = {k:v['statement'] for k, v in self.company.statements.items() if 'statement' in v.keys()}
+        years = {k:list(v['year_adjusted']) for k, v in statements.items()}
+        factors = {k:{x:1.0 for x in v} for k, v in years.items()}
+        currency = self.company.currency
+        round_values = False
+
+        for name, options in self.steps:
+            if name == 'align':
+                common = set.intersection(*[set(x) for x in years.values()]) if len(years) > 0 else set()
+                years = {k:[x for x in v if x in common] for k, v in years.items()}
+            elif name == 'convert':
+                rates = import_json(forex_file(options['currency_a'], options['currency_b']))
+                for k in years.keys():
+                    # Like convert_currency(), years without a rate are dropped
+                    years[k] = [x for x in years[k] if x in rates.keys()]
+                    for x in years[k]:
+                        factors[k][x] *= rates[x]
+                currency = options['currency_b']
+                round_values = True
+            elif name == 'normalize':
+                cpiu = options['cpiu']
+                reference_year = options['reference_year']
+                for k in years.keys():
+                    ref_year = str(reference_year) if reference_year and (str(reference_year) in years[k]) else max(years[k])
+                    for x in years[k]:
+                        factors[k][x] *= 1 + ((cpiu[ref_year] - cpiu[x]) / cpiu[x])
+                round_values = False
+
+        factors = {k:np.asarray([factors[k][x] for x in v], dtype = float) for k, v in years.items()}
+
+        return years, factors, currency, round_values
+
+    def execute(self, cache = True):
+        """
+        Run the plan.
+
+        args:
+            cache: reuse the result of an identical plan run on the same
+            statement contents, and keep this result for reuse.
+
+        returns: a new company object. The original isn't modified. Cached
+        results are shared, so copy one before changing it.
+        """
+        co = self.company
+        key = (content_stamp(co), self.signature()) if cache else None
+        if cache and key in co.plan_cache.keys():
+            logger.debug('Plan cache hit for %s', co.ticker)
+            return co.plan_cache[key]
+
+        years, factors, currency, round_values = self.resolve()
+
+        result = copy.copy(co)
+        result.currency = currency
+        result.plan_cache = dict()
+        result.statements = dict()
+        for key_statement, statement in co.statements.items():
+            # Keep everything that isn't rows, like company and scraped_at. Metrics are stale, so drop them.
+            result.statements[key_statement] = {k:v for k, v in statement.items() if k not in ['statement', 'metrics', 'projections']}
+            if 'statement' not in statement.keys():
+                continue
+
+            # STEP 1: Columns of the original rows that survive every step
+            rows = statement['statement']
+            position = {x:i for i, x in enumerate(rows['year_adjusted'])}
+            cols = [position[x] for x in years[key_statement]]
+
+            # STEP 2: One matrix, one column selection and one multiply per statement
+            names = [k for k, v in rows.items() if isinstance(v, np.ndarray)]
+            new_rows = {k:[v[i] for i in cols] for k, v in rows.items() if k in ['year', 'year_adjusted']}
+            if len(names) > 0:
+                matrix = np.stack([np.asarray(rows[x], dtype = float) for x in names])[:, cols] * factors[key_statement]
+                if round_values:
+                    matrix = np.rint(matrix)
+                new_rows.update({x:matrix[i] for i, x in enumerate(names)})
+            result.statements[key_statement]['statement'] = new_rows
+
+        if 'metrics' in [x[0] for x in self.steps]:
+            result.calculate_metrics()
+        else:
+            result.index_metrics()
+
+        if cache:
+            # Results for older contents can't be hit again
+            for stale in [x for x in co.plan_cache.keys() if x[0] != key[0]]:
+                del co.plan_cache[stale]
+            co.plan_cache[key] = result
+
+        return result
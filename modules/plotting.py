@@ -1,72 +1,39 @@
 import plotly.graph_objects as go
+import plotly.colors
 from modules.cleaning import unclean_statement_heading
 import numpy as np
+import hashlib
 import re
+import os
+from concurrent.futures import ProcessPoolExecutor
 
-def plot_companies(companies, metric, colors = ['blue','orange','green','red','black','purple']):
-    """
-    Takes a list of company statements (dicts from company class) and a string
-    that corresponds to an item in the dictionaries to plot.
-
-    Pass statement['metrics'] or statement['statement'], for example.
-
-    args:
-        companies: a list of company objects from the
-        company class.
-
-        metric: string corresponding to a key in the statement dict that houses
-        the metric you want to plot. 'rnd_percent' would find the item at
-        company.income_statement['metrics']['rnd_percent'].
+# Charts with more series than this are drawn with WebGL (go.Scattergl) traces.
+# SVG traces get slow to build and to render well before this many lines.
+WEBGL_THRESHOLD = 20
 
-        colors: list of colors, matched to companies in index order. each
-        company plotted will take one of the colors. throws error if list of
-        companies is greater than list of colors. default allows for up to
-        4 segments. 4 companies to be plotted.
-
-        TO DO: auto-adjust chart x axis (year_adjusted) for years common to all companies provided
+# Longest chart filename plot_batch() writes, extension excluded. Most file
+# systems cap names at 255 bytes, which a chart of many tickers passes easily.
+MAX_FILENAME_LENGTH = 120
 
-    returns: Plotly fig.
+def series_colors(n, colors = ['blue','orange','green','red','black','purple']):
     """
-    # Choose currency of first company provided for use in plot labeling.
-    currency = companies[0].currency
-    print('Using reporting currency of {}: {}'.format(companies[0].ticker, currency))
+    Return a color for each of n series.
 
-    data = []
-    # Identify and gather metric from the company statement dict
-    for i, co in enumerate(companies):
-        # Look through each statement for the metric
-        for statement_key in co.statements.keys():
-            # Look through each value in the statement dict for the one that contains the metric specified
-            for data_key in co.statements[statement_key].keys():
-                # Get data from the value that contains the metric as a key.
-                # Skip the value if it's not a dict (statement values are aleays in a dict)
-                if isinstance(co.statements[statement_key][data_key], dict) and metric in co.statements[statement_key][data_key].keys():
-                    metric_location = data_key
-                    metric_statement = statement_key
-                    co_metric = co.statements[statement_key][data_key][metric]
-
-        try:
-            test = co_metric
-        except:
-            print('{} not found in statement. Double check the statement objects in companies argument.'.format(metric))
-
-        x_var = co.statements[metric_statement]['statement']['year_adjusted']
-        co_name = co.statements[metric_statement]['company'] if isinstance(co.statements[metric_statement]['company'], str) else ' + '.join(co.statements[metric_statement]['company'])
+    Uses colors first. When there are more series than colors, continues with
+    plotly's 26-color Alphabet palette and then cycles, instead of running out.
+    """
+    palette = list(colors) + [x for x in plotly.colors.qualitative.Alphabet if x not in colors]
 
-        plot = go.Scatter(
-            mode = 'lines+markers',
-            line = dict(color = colors[i], width = 4),
-            marker = dict(color = 'black', size = 10, symbol = 'line-ns-open'),
-            x = x_var[::-1],
-            # need to reverse x and y bc default is present - past order
-            y = np.flip(co_metric) / 1000000 if metric_location == 'statement' else np.flip(co_metric),
-            name = co_name
-        )
+    return [palette[i % len(palette)] for i in range(n)]
 
-        data.append(plot)
+def get_layout_template():
+    """
+    Layout settings shared by every comparison chart in this module.
 
+    Built once per batch in plot_batch() and copied for each chart, rather than
+    rebuilding the whole layout dict per figure.
+    """
     layout = dict(
-        title = 'Contrasting {}'.format(unclean_statement_heading(metric)),
         plot_bgcolor = 'white',
         height = 700,
         width = 1050,
@@ -82,7 +49,6 @@ def plot_companies(companies, metric, colors = ['blue','orange','green','red','b
             categoryorder = 'category ascending'
             ),
         yaxis = dict(
-            title = metric + ' ' + currency + ' (B)' if metric_location == 'statement' else currency + ' USD',
             showgrid = False,
             showline = True,
             linecolor = 'black',
@@ -91,6 +57,184 @@ def plot_companies(companies, metric, colors = ['blue','orange','green','red','b
             )
     )
 
+    return layout
+
+def gather_series(companies, metric):
+    """
+    Helper function of plot_companies() and plot_batch().
+
+    Pulls the metric out of each company object as plain lists that are cheap
+    to hand to another process.
+
+    returns: tuple of (series, metric_location).
+        series: list of dicts with name, x and y. x and y are oldest first.
+        metric_location: 'statement' or 'metrics'. None if no company has the metric.
+    """
+    series = []
+    # Stays None if no company has the metric, so the axis labels still render
+    metric_location = None
+    # Identify and gather metric from the company statement dict
+    for co in companies:
+        # Look up which statement and section hold the metric in the company's metric index
+        try:
+            metric_statement, metric_location = co.locate_metric(metric)
+        except KeyError:
+            print('{} not found in statement. Double check the statement objects in companies argument.'.format(metric))
+            continue
+
+        co_metric = co.statements[metric_statement][metric_location][metric]
+
+        x_var = co.statements[metric_statement]['statement']['year_adjusted']
+        co_name = co.statements[metric_statement]['company'] if isinstance(co.statements[metric_statement]['company'], str) else ' + '.join(co.statements[metric_statement]['company'])
+
+        series.append(dict(
+            name = co_name,
+            # need to reverse x and y bc default is present - past order
+            x = list(x_var[::-1]),
+            y = (np.flip(co_metric) / 1000000 if metric_location == 'statement' else np.flip(co_metric)).tolist()
+        ))
+
+    return series, metric_location
+
+def build_figure(series, metric, metric_location, currency, colors = ['blue','orange','green','red','black','purple'], layout_template = None, webgl_threshold = WEBGL_THRESHOLD):
+    """
+    Helper function of plot_companies() and plot_batch(). Turns gathered series
+    into a plotly figure.
+
+    Uses go.Scattergl traces when there are more than webgl_threshold series.
+    """
+    layout_template = get_layout_template() if layout_template == None else layout_template
+    trace = go.Scattergl if len(series) > webgl_threshold else go.Scatter
+
+    data = []
+    for s, color in zip(series, series_colors(len(series), colors)):
+        plot = trace(
+            mode = 'lines+markers',
+            line = dict(color = color, width = 4),
+            marker = dict(color = 'black', size = 10, symbol = 'line-ns-open'),
+            x = s['x'],
+            y = s['y'],
+            name = s['name']
+        )
+
+        data.append(plot)
+
+    layout = dict(layout_template)
+    layout['title'] = 'Contrasting {}'.format(unclean_statement_heading(metric))
+    layout['yaxis'] = dict(layout_template['yaxis'])
+    layout['yaxis']['title'] = metric + ' ' + currency + ' (B)' if metric_location == 'statement' else currency + ' USD'
+
     fig = go.Figure(data = data, layout = layout)
 
     return fig
+
+def plot_companies(companies, metric, colors = ['blue','orange','green','red','black','purple']):
+    """
+    Takes a list of company statements (dicts from company class) and a string
+    that corresponds to an item in the dictionaries to plot.
+
+    Pass statement['metrics'] or statement['statement'], for example.
+
+    args:
+        companies: a list of company objects from the
+        company class.
+
+        metric: string corresponding to a key in the statement dict that houses
+        the metric you want to plot. 'rnd_percent' would find the item at
+        company.income_statement['metrics']['rnd_percent'].
+
+        colors: list of colors, matched to companies in index order. each
+        company plotted will take one of the colors. When there are more
+        companies than colors, series_colors() fills in the rest.
+
+        TO DO: auto-adjust chart x axis (year_adjusted) for years common to all companies provided
+
+    returns: Plotly fig.
+    """
+    # Choose currency of first company provided for use in plot labeling.
+    currency = companies[0].currency
+    print('Using reporting currency of {}: {}'.format(companies[0].ticker, currency))
+
+    series, metric_location = gather_series(companies, metric)
+
+    return build_figure(series, metric, metric_location, currency, colors = colors)
+
+def render_chart(job):
+    """
+    Helper function of plot_batch(). Runs in a worker process.
+
+    Builds one figure from gathered series and writes it to disk as html or
+    a static image. Static images need the kaleido package.
+
+    returns: path of the written file.
+    """
+    fig = build_figure(job['series'], job['metric'], job['metric_location'], job['currency'],
+                        colors = job['colors'], layout_template = job['layout'], webgl_threshold = job['webgl_threshold'])
+
+    if job['file_format'] == 'html':
+        # Point at plotly.js on a CDN rather than embedding 3MB of js in every chart
+        fig.write_html(job['filepath'], include_plotlyjs = 'cdn')
+    else:
+        fig.write_image(job['filepath'], format = job['file_format'])
+
+    return job['filepath']
+
+def plot_batch(specs, output_dir, file_format = 'html', processes = None, colors = ['blue','orange','green','red','black','purple'], webgl_threshold = WEBGL_THRESHOLD):
+    """
+    Render a whole chart pack to disk at once.
+
+    Metric values are gathered from the company objects in this process, then
+    figures are built and written by a pool of worker processes. The layout
+    template is built once and shared by every chart.
+
+    NOTE: On Windows, call this from under an if __name__ == '__main__': guard,
+    since worker processes re-import the calling script.
+
+    args:
+        specs: list of dicts, each with 'companies' (list of company objects)
+        and 'metric' (string). Optional 'filename' (without extension). Default
+        filename is the metric plus the tickers plotted. Filenames longer than
+        MAX_FILENAME_LENGTH are cut short and end in a hash of the full name.
+        output_dir: folder to write charts to. Created if it doesn't exist.
+        file_format: 'html' or an image format like 'png' or 'svg'.
+        processes: number of worker processes. Default is one per cpu. 1 renders
+        in this process.
+        colors: see plot_companies().
+        webgl_threshold: charts with more series than this use WebGL traces.
+
+    returns: list of written file paths, in the order of specs.
+    """
+    os.makedirs(output_dir, exist_ok = True)
+    layout_template = get_layout_template()
+
+    # STEP 1: Gather series in this process. Workers only get plain lists.
+    jobs = []
+    for spec in specs:
+        companies = spec['companies']
+        series, metric_location = gather_series(companies, spec['metric'])
+        tickers = [co.ticker if isinstance(co.ticker, str) else '+'.join(co.ticker) for co in companies]
+        filename = spec.get('filename', spec['metric'] + '_' + '_'.join(tickers))
+        # Keep filenames safe across operating systems
+        filename = re.sub('[^A-Za-z0-9_+.-]', '_', filename)
+        if len(filename) > MAX_FILENAME_LENGTH:
+            digest = hashlib.sha1(filename.encode('utf-8')).hexdigest()[:12]
+            filename = filename[:MAX_FILENAME_LENGTH - len(digest) - 1] + '_' + digest
+
+        jobs.append(dict(series = series,
+                        metric = spec['metric'],
+                        metric_location = metric_location,
+                        currency = companies[0].currency,
+                        colors = colors,
+                        layout = layout_template,
+                        webgl_threshold = webgl_threshold,
+                        file_format = file_format,
+                        filepath = os.path.join(output_dir, filename + '.' + file_format)))
+
+    # STEP 2: Build and write figures
+    if processes == 1:
+        return [render_chart(job) for job in jobs]
+
+    with ProcessPoolExecutor(max_workers = processes) as pool:
+        filepaths = list(pool.map(render_chart, jobs))
+
+    return filepaths
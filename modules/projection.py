@@ -0,0 +1,232 @@
+"""
+Trend projections of statement rows and metrics, for the whole universe at once.
+
+Every row of every company is fit in one batch. Rows are stacked into a cube
+(see modules.universe), and missing years are masked out, so companies with
+different year coverage share one set of array operations:
+    linear: least squares line through each series. The fit is closed-form
+    from masked sums, so no per-series solver runs.
+    loglinear: the same fit on log values, for rows that grow by a rate.
+    Series with values <= 0 are fit on their positive years only.
+    ses: simple exponential smoothing. Projects the last smoothed level flat.
+
+Each company's statement is projected from its own newest year, not the
+newest year in the universe, so a company that hasn't reported its latest
+year yet (or a balance sheet a year behind its income statement) gets
+projections that continue right where its history ends.
+
+Projections are attached to each company as statements[x]['projections'],
+which company.plot() draws as dashed extensions of the historical lines.
+
+Example:
+    companies = load_companies()
+    project_universe(companies, horizon = 3, method = 'loglinear')
+    companies[0].plot(['total_revenue'])
+"""
+
+from modules.universe import stack_companies, cube_names
+
+import numpy as np
+
+# Projection methods project_values() knows
+PROJECTION_METHODS = ['linear', 'loglinear', 'ses']
+
+def fit_trends(values, x, min_points = 3):
+    """
+    Least squares line through every series at once, skipping NaN.
+
+    args:
+        values: np array of shape (..., years).
+        x: np array of shape (years,). Year of each column.
+        min_points: series with fewer observed years get NaN fits.
+
+    returns: tuple of (slope, intercept) np arrays of shape values.shape[:-1].
+    """
+    mask = ~np.isnan(values)
+    y = np.where(mask, values, 0.0)
+    xs = np.where(mask, x, 0.0)
+
+    n = mask.sum(axis = -1)
+    sum_x = xs.sum(axis = -1)
+    sum_y = y.sum(axis = -1)
+    sum_xx = (xs * xs).sum(axis = -1)
+    sum_xy = (xs * y).sum(axis = -1)
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        slope = (n * sum_xy - sum_x * sum_y) / (n * sum_xx - sum_x ** 2)
+        intercept = (sum_y - slope * sum_x) / n
+
+    too_few = n < max(min_points, 2)
+
+    return np.where(too_few, np.nan, slope), np.where(too_few, np.nan, intercept)
+
+def smooth_levels(values, alpha = 0.5, min_points = 3):
+    """
+    Last simple exponential smoothing level of every series at once.
+
+    args:
+        values: np array of shape (..., years), oldest year first. NaN years
+        are skipped.
+        alpha: smoothing weight on each new observation, between 0 and 1.
+        min_points: series with fewer observed years get NaN.
+
+    returns: np array of shape values.shape[:-1].
+    """
+    level = np.full(values.shape[:-1], np.nan)
+    for t in range(values.shape[-1]):
+        y = values[..., t]
+        seen = ~np.isnan(y)
+        # The first observation starts the level
+        level = np.where(seen & np.isnan(level), y, level)
+        level = np.where(seen, alpha * y + (1 - alpha) * level, level)
+
+    return np.where((~np.isnan(values)).sum(axis = -1) < min_points, np.nan, level)
+
+def latest_years(values, years):
+    """
+    Newest year with a value in every series at once.
+
+    args:
+        values: np array of shape (..., years).
+        years: np array of shape (years,) of int years.
+
+    returns: np array of shape values.shape[:-1]. Series without any values
+    get the newest of years.
+    """
+    observed = ~np.isnan(values)
+    latest = np.where(observed, years, years.min()).max(axis = -1)
+
+    return np.where(observed.any(axis = -1), latest, years.max())
+
+def project_values(values, years, horizon = 3, method = 'linear', alpha = 0.5, min_points = 3, origins = None):
+    """
+    Project every series in an array forward.
+
+    args:
+        values: np array of shape (..., years), newest year first like statements.
+        years: year_adjusted values of the columns, newest first.
+        horizon: number of future years to project.
+        method: linear, loglinear or ses.
+        alpha: smoothing weight for ses.
+        min_points: series with fewer observed years get NaN projections.
+        origins: optional np array of shape values.shape[:-1]. Year each
+        series is projected from. Default is each series' newest year with a
+        value.
+
+    returns: tuple of (projections, future_years), both of shape
+    (..., horizon) and newest first. future_years are year_adjusted strings.
+    """
+    if method not in PROJECTION_METHODS:
+        raise ValueError('Invalid method provided. Should be one of {}. Is {}'.format(', '.join(PROJECTION_METHODS), method))
+
+    values = np.asarray(values, dtype = float)
+    years = np.asarray([int(x) for x in years])
+    origins = latest_years(values, years) if origins is None else np.asarray(origins, dtype = int)
+    future = origins[..., None] + np.arange(horizon, 0, -1)
+    # Center on the newest year, so squared years don't cost precision
+    x = (years - years.max()).astype(float)
+    future_x = (future - years.max()).astype(float)
+
+    if method == 'linear':
+        slope, intercept = fit_trends(values, x, min_points)
+        projections = intercept[..., None] + slope[..., None] * future_x
+    elif method == 'loglinear':
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            logs = np.where(values > 0, np.log(values), np.nan)
+        slope, intercept = fit_trends(logs, x, min_points)
+        projections = np.exp(intercept[..., None] + slope[..., None] * future_x)
+    else:
+        level = smooth_levels(np.flip(values, axis = -1), alpha, min_points)
+        projections = np.repeat(level[..., None], horizon, axis = -1)
+
+    return projections, future.astype(str)
+
+def project_cube(cube, horizon = 3, method = 'linear', alpha = 0.5, min_points = 3):
+    """
+    Project every ticker and key of a cube (see modules.universe) forward.
+
+    Each ticker's statement is projected from the newest year any of its
+    keys in the cube has a value for, so every key of a statement shares
+    future years.
+
+    returns: cube dict whose values are the projections, plus the method
+    used. years is an np array of shape (tickers, keys, horizon), since
+    future years differ by ticker and statement.
+    """
+    years = np.asarray([int(x) for x in cube['years']])
+    origins = np.empty(cube['values'].shape[:2], dtype = int)
+    statements = np.array([x[0] for x in cube['keys']])
+    for statement in set(statements):
+        columns = statements == statement
+        # A year counts once any key of the statement has a value in it
+        observed = np.where((~np.isnan(cube['values'][:, columns])).any(axis = 1), 0.0, np.nan)
+        origins[:, columns] = latest_years(observed, years)[:, None]
+
+    projections, future_years = project_values(cube['values'], cube['years'], horizon, method, alpha, min_points, origins)
+
+    return dict(tickers = cube['tickers'],
+                keys = cube['keys'],
+                years = future_years,
+                values = projections,
+                currencies = cube['currencies'],
+                method = method)
+
+def attach_projections(companies, projected):
+    """
+    Store a projected cube's values on the companies it was built from, as
+    statements[x]['projections'] = dict(year_adjusted, method, values), with
+    values mapping row or metric name to an np array of future years.
+
+    companies must be in the same order as the cube's tickers.
+    """
+    statements = set(x[0] for x in projected['keys'])
+    for i, co in enumerate(companies):
+        # Replace, rather than mix with, projections from an earlier run
+        for statement in statements:
+            co.statements.get(statement, dict()).pop('projections', None)
+        for j, (statement, location, name) in enumerate(projected['keys']):
+            series = projected['values'][i, j]
+            if statement not in co.statements.keys() or np.all(np.isnan(series)):
+                continue
+            projections = co.statements[statement].setdefault('projections', dict(values = dict()))
+            projections['year_adjusted'] = projected['years'][i, j].tolist()
+            projections['method'] = projected['method']
+            projections['values'][name] = series
+
+    return None
+
+def project_universe(companies, horizon = 3, method = 'linear', locations = ['statement', 'metrics'], names = None, alpha = 0.5, min_points = 3, attach = True):
+    """
+    Project rows and metrics of many companies in one batch.
+
+    args:
+        companies: list of company objects. Calculate metrics first to project them.
+        horizon: number of future years to project.
+        method: linear, loglinear or ses. See module docstring.
+        locations: 'statement', 'metrics' or both.
+        names: optional list of row or metric names to project. Default is all.
+        alpha: smoothing weight for ses.
+        min_points: series with fewer observed years get no projection.
+        attach: store projections on each company for plot().
+
+    returns: projected cube dict. See project_cube().
+    """
+    cube = stack_companies(companies, locations = locations, names = names)
+    projected = project_cube(cube, horizon, method, alpha, min_points)
+
+    if attach:
+        attach_projections(companies, projected)
+
+    return projected
+
+def company_projections(projected, ticker):
+    """
+    Pull one company's projections out of a projected cube.
+
+    returns: tuple of dicts mapping row or metric name to an np array of
+    projections and to the year_adjusted strings they're for (newest first).
+    """
+    i = projected['tickers'].index(ticker)
+    names = cube_names(projected)
+
+    return {name:projected['values'][i, j] for j, name in enumerate(names)}, {name:projected['years'][i, j].tolist() for j, name in enumerate(names)}
@@ -0,0 +1,277 @@
+"""
+Quarterly statements stored next to the annual ones, with TTM figures
+computed locally.
+
+Annual pages leave some rows empty in their ttm column (basic_average_shares,
+for example). company.fill_ttm() used to load a live quarterly page to fill
+each one. Here quarterly statements are scraped like annual statements and
+saved to the quarterly folder. Each save merges new quarters into the saved
+ones, so history keeps growing past the quarters Yahoo shows. Trailing
+figures for every row and quarter are then computed in one batch:
+    sum: flows (income and cash flow rows) add up the last window quarters.
+    last: stocks (balance sheet rows) and share counts take the newest quarter.
+    mean: average of the last window quarters.
+
+A trailing figure is NaN unless the window covers consecutive quarters with
+no missing values. Trailing figures are computed when quarters are saved and
+stored in the file, so filling TTM values afterwards only reads files.
+
+Example:
+    scrape_quarterly('AAPL')
+    co = company('AAPL')
+    fill_ttm_rows(co, 'is') # every empty ttm value in the income statement
+"""
+
+from definitions import QUARTERLY_PATH
+from modules.scraping import scrape_statement
+from modules.cleaning import merge_statements
+from modules.files import save_json, import_statement_json
+from modules.taxonomy import resolve_row_name
+
+from datetime import datetime
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Default trailing rule of each statement's rows
+TTM_RULES = {'is':'sum', 'bs':'last', 'cfs':'sum'}
+
+# Rows that take the newest quarter no matter what statement they're in.
+# Share counts are averages over a period, so summing quarters overstates them.
+LAST_VALUE_ROWS = ['basic_average_shares', 'diluted_average_shares']
+
+# Rules trailing_window() knows
+TRAILING_RULES = ['sum', 'last', 'mean']
+
+# Days between the ends of consecutive quarters can drift this far from 365.25 / 4
+QUARTER_TOLERANCE_DAYS = 20
+
+def quarterly_file(ticker, statement, path = QUARTERLY_PATH):
+    return path + ticker + '_' + statement + '.json'
+
+def row_rule(statement, row, rules = None):
+    """
+    Trailing rule for one row. rules can override the defaults by row name.
+    """
+    rules = dict() if rules == None else rules
+    if row in rules.keys():
+        return rules[row]
+    if row in LAST_VALUE_ROWS:
+        return 'last'
+
+    return TTM_RULES[statement]
+
+def period_days(years):
+    """
+    Days since the epoch of each period end date (%m/%d/%Y), as a float np array.
+    """
+    epoch = datetime(1970, 1, 1)
+
+    return np.array([(datetime.strptime(x, '%m/%d/%Y') - epoch).days for x in years], dtype = float)
+
+def trailing_window(values, days, window = 4, rule = 'sum'):
+    """
+    Trailing figure of every series at every quarter, in one batch.
+
+    args:
+        values: np array of shape (..., quarters), newest quarter first.
+        days: np array of shape (quarters,). period_days() of each quarter.
+        window: quarters in each trailing figure.
+        rule: sum, last or mean.
+
+    returns: np array shaped like values. For sum and mean, NaN where the
+    window runs past the oldest quarter, skips a quarter or has a missing value.
+    """
+    if rule not in TRAILING_RULES:
+        raise ValueError('Invalid rule provided. Should be one of {}. Is {}'.format(', '.join(TRAILING_RULES), rule))
+
+    values = np.asarray(values, dtype = float)
+    # The newest quarter needs no window
+    if rule == 'last':
+        return values.copy()
+
+    trailing = np.full(values.shape, np.nan)
+    n = values.shape[-1] - window + 1
+    if n <= 0:
+        return trailing
+
+    # STEP 1: Windows ending at each quarter must span window - 1 quarter gaps
+    span = days[:n] - days[window - 1:]
+    consecutive = np.abs(span - (window - 1) * 365.25 / 4) <= QUARTER_TOLERANCE_DAYS * (window - 1)
+
+    # STEP 2: Every window of every series at once. Shape (..., n, window).
+    windows = np.lib.stride_tricks.sliding_window_view(values, window, axis = -1)
+    complete = ~np.isnan(windows).any(axis = -1)
+    if rule == 'sum':
+        figures = windows.sum(axis = -1)
+    else:
+        figures = windows.mean(axis = -1)
+
+    trailing[..., :n] = np.where(complete & consecutive, figures, np.nan)
+
+    return trailing
+
+def trailing_statement(statement_dict, statement, window = 4, rules = None):
+    """
+    Trailing figures of every row of a quarterly statement.
+
+    args:
+        statement_dict: quarterly statement dict, like scrape_statement()
+        returns with quarterly = True.
+        statement: is, bs or cfs. Picks default rules.
+        window: quarters in each trailing figure.
+        rules: optional dict of row name -> rule, overriding defaults.
+
+    returns: dict with year (period ends, newest first), window, rules
+    (row -> rule used) and rows (row -> np array aligned with year).
+    """
+    rows = statement_dict['statement']
+    years = rows['year']
+    days = period_days(years)
+    names = [k for k, v in rows.items() if isinstance(v, np.ndarray)]
+    used_rules = {x:row_rule(statement, x, rules) for x in names}
+
+    trailing = dict()
+    # Stack rows sharing a rule, so each rule is one batch of array math
+    for rule in set(used_rules.values()):
+        group = [x for x in names if used_rules[x] == rule]
+        figures = trailing_window(np.stack([rows[x] for x in group]), days, window, rule)
+        trailing.update({x:figures[i] for i, x in enumerate(group)})
+
+    return dict(year = list(years), window = window, rules = used_rules, rows = trailing)
+
+def drop_ttm_column(statement_dict):
+    """
+    Remove the ttm column Yahoo shows on some quarterly pages. Trailing
+    figures are computed locally instead.
+    """
+    rows = statement_dict['statement']
+    if 'ttm' not in rows['year']:
+        return statement_dict
+
+    keep = [i for i, x in enumerate(rows['year']) if x != 'ttm']
+    for key, value in rows.items():
+        if isinstance(value, np.ndarray):
+            rows[key] = value[keep]
+        elif key in ['year', 'year_adjusted']:
+            rows[key] = [value[i] for i in keep]
+
+    return statement_dict
+
+def save_quarterly(ticker, statement, statement_dict, merge = True, window = 4, rules = None, path = QUARTERLY_PATH):
+    """
+    Save a scraped quarterly statement and recompute its trailing figures.
+
+    args:
+        statement_dict: scrape_statement(..., quarterly = True) output.
+        merge: keep saved quarters the new scrape no longer shows.
+        window, rules: see trailing_statement().
+
+    returns: the statement dict as saved, with trailing figures.
+    """
+    os.makedirs(path, exist_ok = True)
+    statement_dict = drop_ttm_column(statement_dict)
+
+    if merge and os.path.exists(quarterly_file(ticker, statement, path)):
+        saved = import_statement_json(quarterly_file(ticker, statement, path))
+        statement_dict['statement'] = merge_statements(saved['statement'], statement_dict['statement'])
+
+    statement_dict['trailing'] = trailing_statement(statement_dict, statement, window, rules)
+    save_json(statement_dict, quarterly_file(ticker, statement, path))
+    logger.info('Saved %s quarters of %s %s', len(statement_dict['statement']['year']), ticker, statement)
+
+    return statement_dict
+
+def load_quarterly(ticker, statement, path = QUARTERLY_PATH):
+    """
+    Load a saved quarterly statement with its trailing figures as np arrays.
+    Returns None when nothing is saved.
+    """
+    if not os.path.exists(quarterly_file(ticker, statement, path)):
+        return None
+
+    data = import_statement_json(quarterly_file(ticker, statement, path))
+    if 'trailing' in data.keys():
+        data['trailing']['rows'] = {k:np.array([np.nan if x == None else x for x in v], dtype = float) for k, v in data['trailing']['rows'].items()}
+
+    return data
+
+def scrape_quarterly(ticker, statements = ['is','bs','cfs'], skip_rows = None, merge = True, window = 4, path = QUARTERLY_PATH):
+    """
+    Scrape and save quarterly statements for one ticker.
+
+    skip_rows defaults to the rows company() leaves out of annual statements.
+
+    returns: dict of statement -> saved statement dict.
+    """
+    if skip_rows == None:
+        from modules.classes import company
+        skip_rows = company(method = None).metrics_rows
+
+    saved = dict()
+    for statement in statements:
+        scraped = scrape_statement(ticker, statement, skip_rows, quarterly = True)
+        saved[statement] = save_quarterly(ticker, statement, scraped, merge = merge, window = window, path = path)
+
+    return saved
+
+def get_ttm(ticker, statement, rows = None, path = QUARTERLY_PATH):
+    """
+    Newest trailing figures of a saved quarterly statement.
+
+    args:
+        rows: optional list of row names. Default is every row.
+
+    returns: tuple of (period end of the newest quarter, dict of row -> value).
+    Rows whose newest window is incomplete get NaN. (None, {}) when no
+    quarterly statement is saved.
+    """
+    data = load_quarterly(ticker, statement, path)
+    if data == None or 'trailing' not in data.keys() or len(data['trailing']['year']) == 0:
+        return None, dict()
+
+    trailing = data['trailing']
+    names = trailing['rows'].keys() if rows == None else [x for x in rows if x in trailing['rows'].keys()]
+
+    return trailing['year'][0], {x:trailing['rows'][x][0] for x in names}
+
+def fill_ttm_rows(co, statement, rows = None, overwrite = False, path = QUARTERLY_PATH):
+    """
+    Fill a company's annual ttm column from its saved quarterly statement.
+    No pages are loaded.
+
+    args:
+        co: company object with statement in its statements.
+        statement: is, bs or cfs.
+        rows: optional list of row names (row names, synonyms or as shown on
+        Yahoo Finance). Default is every row.
+        overwrite: also replace ttm values that aren't empty. Empty means 0 or
+        NaN, since Yahoo shows '-' for rows it doesn't report.
+
+    returns: dict of row -> value filled.
+    """
+    statement_rows = co.statements[statement]['statement']
+    if 'ttm' not in statement_rows['year']:
+        logger.info('%s %s has no ttm column to fill', co.ticker, statement)
+        return dict()
+
+    ttm_index = statement_rows['year'].index('ttm')
+    names = None if rows == None else [resolve_row_name(x, statement_rows) for x in rows]
+    period_end, figures = get_ttm(co.ticker, statement, names, path)
+
+    filled = dict()
+    for name, value in figures.items():
+        if name not in statement_rows.keys() or np.isnan(value):
+            continue
+        current = statement_rows[name][ttm_index]
+        if overwrite or current == 0 or np.isnan(current):
+            statement_rows[name][ttm_index] = value
+            filled[name] = value
+
+    if len(filled) > 0:
+        logger.info('Filled %s ttm values of %s %s from quarters through %s', len(filled), co.ticker, statement, period_end)
+
+    return filled
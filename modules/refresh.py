@@ -0,0 +1,180 @@
+"""
+Staleness-aware refresh of the saved universe.
+
+Instead of rescraping everything, work out which saved statements could have
+new data on Yahoo Finance and scrape only those:
+    - A new fiscal year is due once the latest saved fiscal year end plus one
+    year plus a filing lag has passed, and we haven't scraped since then.
+    - The ttm column changes every quarter, so statements with one are also
+    due once their last scrape is older than ttm_max_age_days.
+
+New scrapes are merged into the saved statements with merge_statements(),
+so years that have dropped off Yahoo's four-year window are kept.
+
+Example:
+    get_due_statements() # see what a refresh would scrape
+    refresh_universe()
+"""
+
+from definitions import OUTPUT_PATH
+from modules.classes import company
+from modules.files import get_available_tickers, import_statement_json
+from modules.cleaning import merge_statements
+from modules.scraping import scrape_statement
+from modules.history import last_checked
+from modules.taxonomy import canonicalize_rows
+
+from datetime import datetime, timedelta
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+def get_statement_status(ticker, statement):
+    """
+    Read what's known about one saved statement's freshness.
+
+    Statements saved before scrape timestamps existed fall back to the
+    file's modified time. Scrapes that changed nothing don't rewrite the
+    file, so the statement's history is checked for a later scrape too.
+
+    returns: dict with latest_fiscal_end (datetime or None), has_ttm (bool)
+    and scraped_at (datetime).
+    """
+    filepath = OUTPUT_PATH + ticker + '_' + statement + '.json'
+    saved = import_statement_json(filepath)
+
+    fiscal_ends = [datetime.strptime(x, '%m/%d/%Y') for x in saved['statement']['year'] if x != 'ttm']
+    if 'scraped_at' in saved.keys():
+        scraped_at = datetime.fromisoformat(saved['scraped_at'])
+    else:
+        scraped_at = datetime.fromtimestamp(os.path.getmtime(filepath))
+
+    checked_at = last_checked(ticker, statement)
+    if checked_at != None and checked_at > scraped_at:
+        scraped_at = checked_at
+
+    return dict(latest_fiscal_end = max(fiscal_ends) if len(fiscal_ends) > 0 else None,
+                has_ttm = 'ttm' in saved['statement']['year'],
+                scraped_at = scraped_at)
+
+def due_reason(status, now, filing_lag_days = 90, ttm_max_age_days = 100):
+    """
+    Decide whether a statement is due for a rescrape.
+
+    args:
+        status: dict from get_statement_status().
+        now: datetime to judge against.
+        filing_lag_days: days after fiscal year end that annual reports are
+        usually on Yahoo Finance. 10-Ks are due 60-90 days after year end.
+        ttm_max_age_days: rescrape statements with a ttm column when the last
+        scrape is older than this. None turns ttm refreshes off.
+
+    returns: string explaining why the statement is due, or None if it isn't.
+    """
+    if status['latest_fiscal_end'] == None:
+        return 'no fiscal years saved'
+
+    # Add a year by calendar date, falling back a day for Feb 29 year ends
+    try:
+        next_fiscal_end = status['latest_fiscal_end'].replace(year = status['latest_fiscal_end'].year + 1)
+    except ValueError:
+        next_fiscal_end = status['latest_fiscal_end'].replace(year = status['latest_fiscal_end'].year + 1, day = 28)
+    next_filing = next_fiscal_end + timedelta(days = filing_lag_days)
+
+    if now >= next_filing and status['scraped_at'] < next_filing:
+        return 'fiscal year ending {} should be filed'.format(next_fiscal_end.strftime('%m/%d/%Y'))
+
+    if ttm_max_age_days != None and status['has_ttm'] and now - status['scraped_at'] > timedelta(days = ttm_max_age_days):
+        return 'ttm last scraped {}'.format(status['scraped_at'].strftime('%m/%d/%Y'))
+
+    return None
+
+def get_due_statements(tickers = None, now = None, filing_lag_days = 90, ttm_max_age_days = 100):
+    """
+    List saved statements that are due for a rescrape.
+
+    args:
+        tickers: list of tickers to check. Default is every saved ticker.
+        now: datetime to judge against. Default is now.
+        filing_lag_days, ttm_max_age_days: see due_reason().
+
+    returns: list of (ticker, statement, reason) tuples.
+    """
+    now = datetime.now() if now == None else now
+    available = get_available_tickers()
+    tickers = sorted(available.keys()) if tickers == None else tickers
+
+    due = []
+    for ticker in tickers:
+        for statement in available.get(ticker, []):
+            reason = due_reason(get_statement_status(ticker, statement), now, filing_lag_days, ttm_max_age_days)
+            if reason != None:
+                due.append((ticker, statement, reason))
+
+    return due
+
+def save_merged_statement(ticker, statement, scraped):
+    """
+    Merge a freshly scraped statement dict into the saved one and save it
+    through company.save_statements(), so save hooks see the update.
+
+    The saved statement's currency is kept. Any saved metrics are dropped,
+    since they no longer match the merged years. Merged rows are canonicalized
+    and row_ids rebuilt, since saved rows may predate canonical names.
+    """
+    filepath = OUTPUT_PATH + ticker + '_' + statement + '.json'
+    co = company(ticker, method = None)
+
+    if os.path.exists(filepath):
+        saved = import_statement_json(filepath)
+        scraped['statement'] = merge_statements(saved['statement'], scraped['statement'])
+        co.currency = saved.get('currency', co.currency)
+
+    # Saved rows may predate canonical names, so canonicalize the merged rows and rebuild row_ids
+    rows, row_ids, unmapped = canonicalize_rows(scraped['statement'])
+    co.statements[statement] = dict(company = ticker, statement = rows, row_ids = row_ids, scraped_at = scraped['scraped_at'])
+    co.save_statements([statement])
+
+    return co
+
+def refresh_universe(tickers = None, now = None, filing_lag_days = 90, ttm_max_age_days = 100, dry_run = False, browsers = None):
+    """
+    Rescrape only the saved statements that are due and merge the new years
+    into the saved files.
+
+    args:
+        tickers, now, filing_lag_days, ttm_max_age_days: see get_due_statements().
+        dry_run: only log what would be scraped.
+        browsers: scrape with modules.pipeline using this many browsers.
+        Default scrapes one statement at a time.
+
+    returns: list of (ticker, statement, reason) tuples that were due.
+    """
+    due = get_due_statements(tickers, now, filing_lag_days, ttm_max_age_days)
+    checked = len(tickers) if tickers != None else len(get_available_tickers())
+    logger.info('%s statements across %s tickers are due for a refresh.', len(due), checked)
+
+    for ticker, statement, reason in due:
+        logger.info('%s %s: %s', ticker, statement, reason)
+
+    if dry_run or len(due) == 0:
+        return due
+
+    skip_rows = company(method = None).metrics_rows
+
+    if browsers == None:
+        for ticker, statement, reason in due:
+            try:
+                save_merged_statement(ticker, statement, scrape_statement(ticker, statement, skip_rows))
+            except Exception:
+                logger.exception('Failed to refresh %s %s', ticker, statement)
+    else:
+        # Imported here so plain refreshes don't pay for the pipeline
+        from modules.pipeline import run_pipeline
+
+        result = run_pipeline([(x[0], x[1]) for x in due], browsers = browsers, skip_rows = skip_rows, save = False)
+        for (ticker, statement), scraped in result['statements'].items():
+            save_merged_statement(ticker, statement, scraped)
+
+    return due
@@ -0,0 +1,232 @@
+"""
+Monte Carlo stress tests of companies and segments.
+
+Shocks are drawn for three drivers:
+    revenue_growth: added to revenue growth each year. Compounds from the
+    oldest year forward, so a shock early on carries into every later year.
+    cogs_percent: added to cost of revenue as a share of revenue.
+    opex_percent: added to operating expense as a share of revenue.
+
+Everything below gross profit follows from those: operating income moves with
+gross profit and opex, pretax income moves with operating income, taxes are
+held at each year's effective rate and the change in net income flows through
+to operating cash flow. Balance sheet rows aren't shocked.
+
+Draws aren't simulated one at a time. Each chunk of draws becomes a scenario
+company whose shocked rows are years x draws arrays (other rows are years x 1),
+and calculate_metrics() runs once on it, so every draw in the chunk goes
+through the same formulas as the real company in one batch of numpy math.
+chunk_size bounds the memory those intermediate arrays take. Percentiles
+come from a uniform random sample of at most sample_size draws, kept as a
+reservoir as chunks finish, so memory doesn't grow with draws either.
+
+Example:
+    shocks = {'revenue_growth':('normal', 0, 0.05), 'cogs_percent':('normal', 0, 0.02)}
+    result = run_scenarios(co, shocks, draws = 10000)
+    result['bands']['net_margin'] # percentiles x years
+"""
+
+from modules.classes import company
+from modules.universe import company_label
+
+import copy
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Drivers shocks can be applied to
+SHOCK_DRIVERS = ['revenue_growth', 'cogs_percent', 'opex_percent']
+
+# Income statement rows the scenario model reads
+REQUIRED_IS_ROWS = ['total_revenue', 'cost_of_revenue', 'gross_profit', 'operating_expense', 'operating_income',
+                    'pretax_income', 'tax_provision', 'net_income']
+
+def draw_shocks(rng, spec, shape, per_year = True):
+    """
+    Draw one driver's shocks.
+
+    args:
+        rng: np.random.Generator.
+        spec: tuple naming a np.random.Generator distribution followed by its
+        parameters, like ('normal', mean, sd), ('uniform', low, high) or
+        ('triangular', left, mode, right). Or a function taking (rng, shape)
+        and returning an array of that shape.
+        shape: (years, draws).
+        per_year: draw a new shock every year. False draws one shock per draw
+        and applies it to every year.
+
+    returns: np array of shape (years, draws).
+    """
+    draw_shape = shape if per_year else (1, shape[1])
+
+    if callable(spec):
+        shocks = spec(rng, draw_shape)
+    else:
+        shocks = getattr(rng, spec[0])(*spec[1:], size = draw_shape)
+
+    return np.broadcast_to(shocks, shape)
+
+def shocked_statements(co, shocks):
+    """
+    Apply one chunk of shocks to a company's rows.
+
+    args:
+        co: company object with aligned statements.
+        shocks: dict mapping driver to a (years, draws) array of shocks.
+        Missing drivers aren't shocked.
+
+    returns: dict of statements shaped like co.statements, with shocked rows
+    as (years, draws) arrays and every other row as a (years, 1) array.
+    """
+    statements = dict()
+    for key, statement in co.statements.items():
+        rows = {k:v[:, None] if isinstance(v, np.ndarray) else v for k, v in statement['statement'].items()}
+        statements[key] = dict(company = statement.get('company'), statement = rows)
+
+    base = statements['is']['statement']
+    n_years = len(base['year_adjusted'])
+    zero = np.zeros((n_years, 1))
+
+    # STEP 1: Compound revenue growth shocks from the oldest year (last column) forward
+    growth = np.array(shocks.get('revenue_growth', zero), dtype = float)
+    growth[-1] = 0
+    growth_factors = np.flip(np.cumprod(np.flip(1 + growth, axis = 0), axis = 0), axis = 0)
+    revenue = base['total_revenue'] * growth_factors
+
+    # STEP 2: Shift cost shares of revenue
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        cogs_share = np.divide(base['cost_of_revenue'], base['total_revenue'], out = np.zeros_like(base['total_revenue'], dtype = float),
+                                where = base['total_revenue'] != 0)
+        opex_share = np.divide(base['operating_expense'], base['total_revenue'], out = np.zeros_like(base['total_revenue'], dtype = float),
+                                where = base['total_revenue'] != 0)
+        tax_rate = np.divide(base['tax_provision'], base['pretax_income'], out = np.zeros_like(base['pretax_income'], dtype = float),
+                                where = base['pretax_income'] != 0)
+    cost_of_revenue = revenue * (cogs_share + shocks.get('cogs_percent', zero))
+    operating_expense = revenue * (opex_share + shocks.get('opex_percent', zero))
+
+    # STEP 3: Flow the changes down the income statement. Items between the
+    # lines (other operating items, non-operating income, rounding) are held
+    # as reported, so unshocked scenarios match the company exactly.
+    other_gross = base['gross_profit'] - (base['total_revenue'] - base['cost_of_revenue'])
+    gross_profit = revenue - cost_of_revenue + other_gross
+    other_operating = base['operating_income'] - (base['gross_profit'] - base['operating_expense'])
+    operating_income = gross_profit - operating_expense + other_operating
+    pretax_income = base['pretax_income'] + (operating_income - base['operating_income'])
+    tax_provision = pretax_income * tax_rate
+    net_income = base['net_income'] + (pretax_income - base['pretax_income']) - (tax_provision - base['tax_provision'])
+
+    net_income_change = net_income - base['net_income']
+    base.update(total_revenue = revenue, cost_of_revenue = cost_of_revenue, operating_expense = operating_expense,
+                gross_profit = gross_profit, operating_income = operating_income, pretax_income = pretax_income,
+                tax_provision = tax_provision, net_income = net_income)
+
+    # STEP 4: The change in net income is a change in operating cash
+    if 'cfs' in statements.keys() and 'operating_cash_flow' in statements['cfs']['statement'].keys():
+        statements['cfs']['statement']['operating_cash_flow'] = statements['cfs']['statement']['operating_cash_flow'] + net_income_change
+
+    return statements
+
+def run_scenarios(co, shocks, draws = 10000, chunk_size = 1000, percentiles = [5, 25, 50, 75, 95], metrics = None, per_year = True, seed = None,
+                    sample_size = 10000):
+    """
+    Stress test one company or segment.
+
+    args:
+        co: company object with an income statement. Not modified.
+        shocks: dict mapping drivers in SHOCK_DRIVERS to distribution specs.
+        See draw_shocks().
+        draws: number of scenarios to simulate.
+        chunk_size: scenarios calculated at once. Bounds memory.
+        percentiles: percentiles to report for each metric and year.
+        metrics: optional list of metric names to report. Default is every metric.
+        per_year: draw new shocks every year, rather than one per scenario.
+        seed: random seed, for reproducible results.
+        sample_size: most draws kept to compute percentiles from. Percentiles
+        are exact when draws is no larger, and estimated from a uniform sample
+        of draws otherwise.
+
+    returns: dict with ticker, years (newest first), draws, percentiles,
+    baseline (metric -> np array of years) and bands (metric -> np array of
+    percentiles x years).
+    """
+    unknown = [x for x in shocks.keys() if x not in SHOCK_DRIVERS]
+    if len(unknown) > 0:
+        raise ValueError('Unknown shock drivers: {}. Should be among {}'.format(', '.join(unknown), ', '.join(SHOCK_DRIVERS)))
+    if 'is' not in co.statements.keys():
+        raise KeyError('Scenarios need an income statement. {} has none.'.format(company_label(co)))
+    missing = [x for x in REQUIRED_IS_ROWS if x not in co.statements['is']['statement'].keys()]
+    if len(missing) > 0:
+        raise KeyError('Scenarios need these income statement rows: {}'.format(', '.join(missing)))
+
+    # STEP 1: Baseline metrics on aligned statements, from a copy so co isn't touched
+    baseline = copy.deepcopy(co)
+    baseline.statements = {k:dict(company = v.get('company'), statement = dict(v['statement'])) for k, v in baseline.statements.items() if 'statement' in v.keys()}
+    baseline.calculate_metrics()
+    years = baseline.statements['is']['statement']['year_adjusted']
+
+    names = [(key, name) for key, statement in baseline.statements.items() for name, value in statement.get('metrics', dict()).items()
+                if isinstance(value, np.ndarray) and value.dtype.kind in 'fiu' and (metrics == None or name in metrics)]
+
+    # STEP 2: Simulate in chunks, keeping the metric values of a uniform sample
+    # of at most sample_size draws (reservoir sampling)
+    shock_seed, sample_seed = np.random.SeedSequence(seed).spawn(2)
+    rng = np.random.default_rng(shock_seed)
+    sample_rng = np.random.default_rng(sample_seed)
+    kept = min(draws, sample_size)
+    results = np.empty((kept, len(names), len(years)), dtype = np.float32)
+    scenario = company(baseline.ticker, method = None)
+    for start in range(0, draws, chunk_size):
+        size = min(chunk_size, draws - start)
+        chunk_shocks = {k:draw_shocks(rng, v, (len(years), size), per_year) for k, v in shocks.items()}
+        scenario.statements = shocked_statements(baseline, chunk_shocks)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            scenario.calculate_metrics()
+
+        values = np.empty((size, len(names), len(years)), dtype = np.float32)
+        for j, (key, name) in enumerate(names):
+            values[:, j, :] = np.broadcast_to(scenario.statements[key]['metrics'][name], (len(years), size)).T
+
+        # Fill the sample first, then draw n replaces a random kept draw with
+        # probability sample_size / n. Within a chunk, a later draw landing on
+        # the same slot wins, like it would one draw at a time.
+        fill = max(0, min(size, kept - start))
+        results[start:start + fill] = values[:fill]
+        if fill < size:
+            slots = sample_rng.integers(0, np.arange(start + fill, start + size) + 1)
+            replace = slots < kept
+            results[slots[replace]] = values[fill:][replace]
+
+    # STEP 3: Summarize every metric and year at once
+    bands = np.nanpercentile(results, percentiles, axis = 0)
+
+    return dict(ticker = company_label(co),
+                years = years,
+                draws = draws,
+                percentiles = percentiles,
+                baseline = {name:baseline.statements[key]['metrics'][name] for key, name in names},
+                bands = {name:bands[:, j, :] for j, (key, name) in enumerate(names)})
+
+def run_universe_scenarios(companies, shocks, draws = 10000, chunk_size = 1000, percentiles = [5, 25, 50, 75, 95], metrics = None, per_year = True, seed = None,
+                            sample_size = 10000):
+    """
+    run_scenarios() on every company in a list. Only percentile bands are kept
+    per company, so memory doesn't grow with draws x companies.
+
+    Companies missing rows the scenario model needs are skipped with a warning.
+
+    returns: dict mapping ticker to run_scenarios() results.
+    """
+    rng = np.random.default_rng(seed)
+
+    results = dict()
+    for co in companies:
+        try:
+            results[company_label(co)] = run_scenarios(co, shocks, draws = draws, chunk_size = chunk_size, percentiles = percentiles,
+                                                        metrics = metrics, per_year = per_year, seed = rng.integers(2 ** 32),
+                                                        sample_size = sample_size)
+        except KeyError as e:
+            logger.warning('Skipping %s. %s', company_label(co), e)
+
+    return results
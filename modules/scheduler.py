@@ -0,0 +1,298 @@
+"""
+Shared scheduler for every request this project sends to a remote host.
+
+forex, BLS and Yahoo Finance requests all go through one request_scheduler:
+    - Per-host token buckets keep us under each site's rate limit, even with
+    several scrape threads running.
+    - Transient failures (connection errors, timeouts, 429 and 5xx responses)
+    are retried with exponential backoff instead of aborting a whole run.
+    - One requests.Session per host per thread reuses connections.
+    - Successful GET responses are cached on disk, so reruns don't refetch
+    pages that haven't had time to change.
+
+get_scheduler() returns the process-wide scheduler. Build your own
+request_scheduler (pointing at any url, including a local stub server) to
+test rate limits and retries in isolation. benchmarks.scheduler_stub does
+that against a local server that fails on purpose.
+
+Example:
+    response = get_scheduler().get('https://download.bls.gov/pub/time.series/cu/cu.item')
+    response.text
+"""
+
+from definitions import CACHE_PATH
+from modules.instrumentation import increment
+
+from urllib.parse import urlparse
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Requests per second allowed to each host, and how many can burst at once
+DEFAULT_RATES = {
+    'finance.yahoo.com':(0.5, 2),
+    'fxtop.com':(0.5, 1),
+    'download.bls.gov':(1, 2),
+    'forex_python':(2, 4)
+}
+
+# Used for hosts not listed in DEFAULT_RATES
+FALLBACK_RATE = (1, 2)
+
+# Response statuses worth retrying. Anything else is returned as is.
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# Exceptions call() retries by default. Anything else (bad arguments,
+# programming errors, a rate that doesn't exist) is raised on the first attempt.
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError)
+
+# BLS rejects requests without a browser-like user agent
+DEFAULT_HEADERS = {'User-Agent':'Mozilla/5.0 (financial-reporting research script)'}
+
+class token_bucket():
+    """
+    Classic token bucket. Holds up to capacity tokens and refills at rate
+    tokens per second. acquire() takes one token, waiting if none are left.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available.
+
+        returns: seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            # Sleep outside the lock so other threads can check the bucket
+            time.sleep(wait)
+            waited += wait
+
+class scheduled_response():
+    """
+    The parts of a response callers in this project use. Same shape whether
+    it came from the network or the disk cache.
+    """
+    def __init__(self, url, status_code, text, from_cache = False):
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+        self.from_cache = from_cache
+
+    def json(self):
+        return json.loads(self.text)
+
+class request_scheduler():
+    """
+    Rate-limited, retrying http client shared by forex, BLS and scraping code.
+    """
+    def __init__(self, rates = DEFAULT_RATES, retries = 3, backoff = 1.0, timeout = 30, cache_path = CACHE_PATH, cache_seconds = 24 * 60 * 60, headers = DEFAULT_HEADERS):
+        """
+        args:
+            rates: dict mapping host to (requests per second, burst size).
+            retries: attempts after the first one before giving up.
+            backoff: seconds to wait before the first retry. Doubles each retry.
+            timeout: seconds before a single request attempt gives up.
+            cache_path: folder for cached responses. None turns the cache off.
+            cache_seconds: how long cached responses are served for by default.
+            headers: headers sent with every request.
+        """
+        self.rates = dict(rates)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache_path = cache_path
+        self.cache_seconds = cache_seconds
+        self.headers = dict(headers)
+
+        self.buckets = dict()
+        self.buckets_lock = threading.Lock()
+        # requests.Session isn't guaranteed thread safe, so each thread gets its own per host
+        self.local = threading.local()
+
+    def bucket(self, host):
+        """
+        Return (creating once) the token bucket for a host.
+        """
+        with self.buckets_lock:
+            if host not in self.buckets.keys():
+                rate, capacity = self.rates.get(host, FALLBACK_RATE)
+                self.buckets[host] = token_bucket(rate, capacity)
+
+        return self.buckets[host]
+
+    def session(self, host):
+        """
+        Return this thread's pooled requests.Session for a host.
+        """
+        import requests
+
+        sessions = self.local.__dict__.setdefault('sessions', dict())
+        if host not in sessions.keys():
+            session = requests.Session()
+            session.headers.update(self.headers)
+            sessions[host] = session
+
+        return sessions[host]
+
+    def retry_wait(self, attempt, retry_after = None):
+        """
+        Seconds to wait before retry number attempt (0 based). Honors a
+        Retry-After header given in seconds, and adds jitter so parallel
+        workers don't retry in lockstep.
+        """
+        if retry_after != None and str(retry_after).isdigit():
+            return float(retry_after)
+
+        return self.backoff * (2 ** attempt) * random.uniform(0.8, 1.2)
+
+    def cache_file(self, url):
+        """
+        Path of the cache file for a url.
+        """
+        return self.cache_path + hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json'
+
+    def read_cache(self, url, max_age):
+        """
+        Return a cached response for url if one is younger than max_age seconds.
+        """
+        if self.cache_path == None or not os.path.exists(self.cache_file(url)):
+            return None
+
+        with open(self.cache_file(url)) as f:
+            cached = json.load(f)
+
+        if time.time() - cached['fetched_at'] > max_age:
+            return None
+
+        increment('http_cache_hits')
+
+        return scheduled_response(cached['url'], cached['status_code'], cached['text'], from_cache = True)
+
+    def write_cache(self, response):
+        """
+        Save a successful response to the disk cache.
+        """
+        if self.cache_path == None:
+            return None
+
+        os.makedirs(self.cache_path, exist_ok = True)
+        cached = dict(url = response.url, status_code = response.status_code, text = response.text, fetched_at = time.time())
+        # Write then rename, so a reader never sees a half-written file
+        temp_file = self.cache_file(response.url) + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(cached, f)
+        os.replace(temp_file, self.cache_file(response.url))
+
+        return None
+
+    def get(self, url, params = None, use_cache = True, max_age = None):
+        """
+        GET a url through the host's rate limit, retrying transient failures.
+
+        args:
+            url: url to request.
+            params: optional dict of query parameters.
+            use_cache: serve from and save to the disk cache.
+            max_age: seconds a cached response stays valid. Default is cache_seconds.
+
+        returns: scheduled_response.
+        """
+        import requests
+
+        if params:
+            url = requests.Request('GET', url, params = params).prepare().url
+
+        max_age = self.cache_seconds if max_age == None else max_age
+        if use_cache:
+            cached = self.read_cache(url, max_age)
+            if cached != None:
+                logger.debug('Cache hit for %s', url)
+                return cached
+
+        host = urlparse(url).netloc
+        for attempt in range(self.retries + 1):
+            self.bucket(host).acquire()
+            increment('http_requests')
+            try:
+                raw = self.session(host).get(url, timeout = self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries:
+                    raise
+                wait = self.retry_wait(attempt)
+                logger.warning('%s on %s. Retrying in %.1fs (%s/%s).', type(e).__name__, url, wait, attempt + 1, self.retries)
+                increment('http_retries')
+                time.sleep(wait)
+                continue
+
+            if raw.status_code in RETRY_STATUSES and attempt < self.retries:
+                wait = self.retry_wait(attempt, raw.headers.get('Retry-After'))
+                logger.warning('HTTP %s from %s. Retrying in %.1fs (%s/%s).', raw.status_code, url, wait, attempt + 1, self.retries)
+                increment('http_retries')
+                time.sleep(wait)
+                continue
+
+            response = scheduled_response(url, raw.status_code, raw.text)
+            if use_cache and raw.status_code == 200:
+                self.write_cache(response)
+
+            return response
+
+    def call(self, host, func, *args, retry_on = TRANSIENT_ERRORS, **kwargs):
+        """
+        Run a function that makes its own remote request (forex_python's
+        get_rate(), a selenium driver's get(), etc.) under a host's rate limit,
+        retrying it with backoff when it raises a transient error.
+
+        args:
+            host: key for the rate limit. Doesn't have to be a real hostname.
+            func: function to call with *args and **kwargs.
+            retry_on: tuple of exception types worth retrying, like
+            get() retries requests.ConnectionError and requests.Timeout.
+            Anything else is raised right away.
+
+        returns: whatever func returns.
+        """
+        for attempt in range(self.retries + 1):
+            self.bucket(host).acquire()
+            increment('http_requests')
+            try:
+                return func(*args, **kwargs)
+            except retry_on as e:
+                if attempt == self.retries:
+                    raise
+                wait = self.retry_wait(attempt)
+                logger.warning('%s calling %s for %s. Retrying in %.1fs (%s/%s).', type(e).__name__, getattr(func, '__name__', func), host, wait, attempt + 1, self.retries)
+                increment('http_retries')
+                time.sleep(wait)
+
+# Process-wide scheduler, created on first use
+SCHEDULER = dict()
+
+def get_scheduler():
+    """
+    Return the scheduler shared by everything in this process.
+    """
+    if 'default' not in SCHEDULER.keys():
+        SCHEDULER['default'] = request_scheduler()
+
+    return SCHEDULER['default']
@@ -6,7 +6,15 @@ except:
     CHROME_SETTINGS_PATH = False
 
 from modules.cleaning import rewrite_value, clean_numeric, clean_statement_heading, unclean_statement_heading, adjust_date
+from modules.instrumentation import timed, increment
+from modules.scheduler import get_scheduler, TRANSIENT_ERRORS
+from modules.taxonomy import canonicalize_rows
 from time import sleep
+from datetime import datetime
+import sys
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Analysis packages
 import numpy as np
@@ -15,11 +23,9 @@ import statistics as stat
 # Text parsing packages
 import re
 
-# Web crawling packages
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from bs4 import BeautifulSoup
+# Web crawling packages (selenium, bs4) are imported inside the functions that
+# use them. They're slow to import, and most uses of this package only load
+# saved statements without ever scraping.
 
 # DEFINE FUNCTIONS
 def extract_row_name(row_text):
@@ -42,6 +48,7 @@ def extract_row_name(row_text):
 
     return step_two
 
+@timed('create_webdriver')
 def create_webdriver():
     """
     Create and return a Chrome web driver for use in this app's scraping functions.
@@ -49,7 +56,14 @@ def create_webdriver():
     We're using a webdriver instead of just raw requests, because yahoo finance income statement rows
     sometimes need to be expanded with an HTML button (like OpEx).
     """
-    print("Creating web driver...")
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service
+
+    # Selenium breaks if the driver folder isn't on the path
+    if WEBDRIVER_PATH not in sys.path:
+        sys.path.append(WEBDRIVER_PATH)
+
+    logger.info('Creating web driver...')
     # Specify the file of the driver to be used
     driver_name = 'chromedriver.exe'
 
@@ -72,6 +86,7 @@ def create_webdriver():
 
     return driver
 
+@timed('expand_statement_rows')
 def expand_statement_rows(webdriver, levels = 1):
     """
     Get all rows of a financial statement in expansion order.
@@ -79,6 +94,9 @@ def expand_statement_rows(webdriver, levels = 1):
 
     Intended as a helper function of get_statement_rows() in this module.
     """
+    from selenium.webdriver.common.by import By
+    from bs4 import BeautifulSoup
+
     statement_rows = list()
 
     for i in range(levels):
@@ -92,43 +110,49 @@ def expand_statement_rows(webdriver, levels = 1):
         if i < levels - 1:
             for button in buttons:
                 button.click()
+            increment('rows_expanded', len(buttons))
 
     return statement_rows, soup
 
-def get_statement_rows(webdriver, ticker_symbol, statement_name):
+# Statement name -> page name on Yahoo Finance
+STATEMENT_PAGES = {
+'is':'financials',
+'bs':'balance-sheet',
+'cfs':'cash-flow'
+}
+
+# Specify how many levels to expand on each statement.
+STATEMENT_LEVELS = {
+'is':2,
+'bs':3,
+'cfs':3
+}
+
+def open_statement_page(webdriver, ticker_symbol, statement_name, quarterly = False):
     """
-    Get income statement for company = ticker_symbol from yahoo finance.
+    Open a statement page in webdriver and wait until it has loaded.
 
-    Only returns the set of divs on the page corresponding to income statement rows and its header.
+    quarterly switches the page to its quarterly table before returning.
 
-    Recommended use case is passing the output to the following dictify_income() function to get a proper
-    income statement dict with many more use cases.
+    Helper function of get_statement_rows() and load_statement_page() in this module.
 
-    Statement name takes one of 3 values: is, bs, cfs. Determines how button clicking/row expansion will work.
+    returns: number of levels of rows to expand on the statement.
     """
-    statement_pages = {
-    'is':'financials',
-    'bs':'balance-sheet',
-    'cfs':'cash-flow'
-    }
-
-    print("Requesting statement DOM from Yahoo Finance...")
-    url = 'https://finance.yahoo.com/quote/{}/{}'.format(ticker_symbol,statement_pages[statement_name])
-    # Open the page in webdriver
-    webdriver.get(url)
-
-    # Specify how many levels to expand on each statement.
-    desired_levels = {
-    'is':2,
-    'bs':3,
-    'cfs':3
-    }
+    from selenium.webdriver.common.by import By
+    from selenium.common.exceptions import TimeoutException
 
     # Throw an error when statement name is invalid to call out the reason
-    # expand_statement_rows() will break, below.
-    if statement_name not in desired_levels.keys():
+    # row expansion will break, later.
+    if statement_name not in STATEMENT_LEVELS.keys():
         raise ValueError('Invalid statement name provided. Should be is, bs or cfs. Is {}'.format(statement_name))
 
+    logger.info('Requesting %s statement DOM for %s from Yahoo Finance...', statement_name, ticker_symbol)
+    url = 'https://finance.yahoo.com/quote/{}/{}'.format(ticker_symbol,STATEMENT_PAGES[statement_name])
+    # Open the page in webdriver. The scheduler keeps browsers under Yahoo's rate limit
+    # and retries page loads that time out.
+    get_scheduler().call('finance.yahoo.com', webdriver.get, url, retry_on = (TimeoutException,) + TRANSIENT_ERRORS)
+    increment('pages_loaded')
+
     while len(webdriver.find_elements(By.XPATH, '//button')) == 0:
         # building in a second of pause to let the page load before attempting the click
         # assumption is that statement will always have at least one expandable row in it
@@ -136,7 +160,48 @@ def get_statement_rows(webdriver, ticker_symbol, statement_name):
         sleep(1)
     sleep(1) # pause an extra second, because this is still failing to work
 
-    statement_rows, soup = expand_statement_rows(webdriver, levels = desired_levels[statement_name])
+    if quarterly:
+        show_quarterly(webdriver)
+
+    return STATEMENT_LEVELS[statement_name]
+
+def show_quarterly(webdriver):
+    """
+    Click the Quarterly button of an open statement page, turning its table
+    into the quarterly version.
+
+    Helper function of open_statement_page() and get_recent_quarter().
+    """
+    from selenium.webdriver.common.by import By
+
+    while len(webdriver.find_elements(By.XPATH, '//button[contains(.,"Quarterly")]')) == 0:
+        sleep(1)
+
+    quarter_button = webdriver.find_element(By.XPATH, '//button[contains(.,"Quarterly")]')
+    quarter_button.click()
+    # pause 1 second to allow the click operation to complete, turning
+    # the statement table into the quarterly version
+    sleep(1)
+
+    return None
+
+@timed('get_statement_rows')
+def get_statement_rows(webdriver, ticker_symbol, statement_name, quarterly = False):
+    """
+    Get income statement for company = ticker_symbol from yahoo finance.
+
+    Only returns the set of divs on the page corresponding to income statement rows and its header.
+
+    Recommended use case is passing the output to the following dictify_income() function to get a proper
+    income statement dict with many more use cases.
+
+    Statement name takes one of 3 values: is, bs, cfs. Determines how button clicking/row expansion will work.
+
+    quarterly gets the quarterly table instead of the annual one.
+    """
+    levels = open_statement_page(webdriver, ticker_symbol, statement_name, quarterly)
+
+    statement_rows, soup = expand_statement_rows(webdriver, levels = levels)
 
     # Get the income statement's heading
     statement_heading = soup.find('div',{'class':'D(tbhg)'}).select_one('div:first-child').find_all('div')
@@ -144,7 +209,48 @@ def get_statement_rows(webdriver, ticker_symbol, statement_name):
     # Prevent user from having to populate a dummy currency variable, every time
     return statement_heading, statement_rows
 
+@timed('load_statement_page')
+def load_statement_page(webdriver, ticker_symbol, statement_name, quarterly = False):
+    """
+    Browser half of get_statement_rows(). Opens a statement page and expands
+    its rows, but does no parsing. Returns the fully expanded page source.
+
+    Used by modules.pipeline, where browsers only load pages and a separate
+    process pool parses them with parse_statement_page().
+
+    quarterly loads the quarterly table instead of the annual one.
+    """
+    from selenium.webdriver.common.by import By
+
+    levels = open_statement_page(webdriver, ticker_symbol, statement_name, quarterly)
+
+    for i in range(levels - 1):
+        # Same expansion as expand_statement_rows(), minus parsing the DOM at each level.
+        # Expanded rows stay on the page, so the last page source holds every row.
+        buttons = webdriver.find_elements(By.XPATH, '//div[@data-test="fin-row"]//*[local-name()="svg" and @data-icon="caret-right"]')
+        for button in buttons:
+            button.click()
+        increment('rows_expanded', len(buttons))
+
+    return webdriver.page_source
+
+@timed('parse_statement_page')
+def parse_statement_page(page_source):
+    """
+    Parsing half of get_statement_rows(). Takes a page source from
+    load_statement_page() and returns (statement_heading, statement_rows),
+    ready for dictify_statement().
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(page_source, 'lxml')
+    statement_rows = soup.find_all('div',{'data-test':'fin-row'})
+    statement_heading = soup.find('div',{'class':'D(tbhg)'}).select_one('div:first-child').find_all('div')
+
+    return statement_heading, statement_rows
+
 
+@timed('dictify_statement')
 def dictify_statement(statement_heading, statement_rows, ticker_symbol, skip_rows = None):
     """
     Takes a statement heading and a list of statement rows as returned by get_statement().
@@ -156,7 +262,7 @@ def dictify_statement(statement_heading, statement_rows, ticker_symbol, skip_row
     name of the company. This will help functions that operate on multiple company
     objects understand which company the object belongs to.
     """
-    print("Parsing statement DOM...")
+    logger.info('Parsing statement DOM for %s...', ticker_symbol)
     # Instantiate the income_dict
     statement_dict = dict()
     # Instantiate a subtotal row component lookup dict for later
@@ -183,6 +289,14 @@ def dictify_statement(statement_heading, statement_rows, ticker_symbol, skip_row
         col_counts.append(len(row.find_all('div',{'data-test':'fin-col'})))
     col_mode = stat.mode(col_counts)
 
+    # Rows whose column count doesn't match the mode are dropped below.
+    # Count them, since unexpected drops are a common source of bad statements.
+    dropped_rows = len([x for x in col_counts if x != col_mode])
+    increment('rows_parsed', len(col_counts) - dropped_rows)
+    increment('rows_dropped_col_mode', dropped_rows)
+    if dropped_rows > 0:
+        logger.debug('%s: dropped %s rows with a column count other than %s', ticker_symbol, dropped_rows, col_mode)
+
     ## STEP 2: Iterate through income statement rows and pull out the values into the dict
     for row in statement_rows:
         # Get a list of the columns in the row
@@ -208,10 +322,18 @@ def dictify_statement(statement_heading, statement_rows, ticker_symbol, skip_row
                 if rowname not in [clean_statement_heading(x) for x in skip_vals]:
                     statement_dict[rowname] = rowvals
 
-    dictified_statement = dict(company = ticker_symbol, statement = statement_dict)
+    ## STEP 3: Rename synonym rows to their canonical names (see modules.taxonomy)
+    statement_dict, row_ids, unmapped = canonicalize_rows(statement_dict)
+    increment('rows_unmapped', len(unmapped))
+    if len(unmapped) > 0:
+        logger.debug('%s: rows outside the taxonomy: %s', ticker_symbol, ', '.join(unmapped))
+
+    # Record when the statement was scraped, so modules.refresh can tell when it's due again
+    dictified_statement = dict(company = ticker_symbol, statement = statement_dict, row_ids = row_ids, scraped_at = datetime.now().isoformat(timespec = 'seconds'))
 
     return dictified_statement
 
+@timed('get_recent_quarter')
 def get_recent_quarter(statement_url, fill_row):
     """
     Some rows in financial statements are unpopulated in ttm period.
@@ -219,7 +341,8 @@ def get_recent_quarter(statement_url, fill_row):
     For some analyses, it's useful and practical to use the value from the
     most recent completed quarter.
 
-    This is a helper function of the fill_ttm() method of company() class.
+    This is a helper function of the fill_ttm() method of company() class,
+    used when no quarterly statement is saved (see modules.quarterly).
 
     This function does that. Gets most recent completed quarter from Yahoo Finance
     and fills the ttm column in the row specified by fill_row.
@@ -230,22 +353,16 @@ def get_recent_quarter(statement_url, fill_row):
 
     returns: value at recent quarter of fill_row.
     """
+    from bs4 import BeautifulSoup
+    from selenium.common.exceptions import TimeoutException
+
     driver = create_webdriver()
-    print('Requesting {}...'.format(statement_url))
-    driver.get(statement_url)
+    logger.info('Requesting %s...', statement_url)
+    get_scheduler().call('finance.yahoo.com', driver.get, statement_url, retry_on = (TimeoutException,) + TRANSIENT_ERRORS)
+    increment('pages_loaded')
 
-    while len(driver.find_elements(By.XPATH, '//button[contains(.,"Quarterly")]')) == 0:
-        # building in a second of pause to let the page load before attempting the click
-        # assumption is that statement will always have at least one expandable row in it
-        # if no expandable rows visible, assume page hasn't loaded
-        sleep(1)
     sleep(1) # pause an extra second, because this is still failing to work
-
-    quarter_button = driver.find_element(By.XPATH, '//button[contains(.,"Quarterly")]')
-    quarter_button.click()
-    # pause 1 second to allow the click operation to complete, turning
-    # the statement table into the quarterly version
-    sleep(1)
+    show_quarterly(driver)
 
     soup = BeautifulSoup(driver.page_source, 'lxml')
     row = soup.find('div',{'title':fill_row}).parent.parent.findChildren('div')
@@ -259,15 +376,16 @@ def get_recent_quarter(statement_url, fill_row):
 
     return clean_numeric(row_val), statement_row
 
-def scrape_statement(ticker, statement, skip_rows):
+def scrape_statement(ticker, statement, skip_rows, quarterly = False):
     """
     Run all necessary functions above to get an income statement dict at once.
 
     statement argument: is, bs or cfs. (income, balance, cash flow)
+    quarterly argument: scrape the quarterly table instead of the annual one.
     """
-    print('Getting {} statement for {}...'.format(statement, ticker))
+    logger.info('Getting %s%s statement for %s...', 'quarterly ' if quarterly else '', statement, ticker)
     driver = create_webdriver()
-    statement_heading, statement_rows = get_statement_rows(driver, ticker, statement)
+    statement_heading, statement_rows = get_statement_rows(driver, ticker, statement, quarterly)
     statement_dict = dictify_statement(statement_heading, statement_rows, ticker, skip_rows)
-    print('\n')
+    increment('statements_scraped')
     return statement_dict
@@ -0,0 +1,278 @@
+"""
+Screening engine for the saved universe of companies.
+
+Answers questions like "which tickers had net_margin > 0.2 and current_ratio > 1.5
+in each of the last 5 years" without loading every company and looping in python.
+
+A screen_index keeps one tickers x years array per metric, plus the sort order
+of every year column. Predicates are evaluated with np.searchsorted against the
+sorted columns and combined as boolean masks.
+
+Example:
+    index = screen_index(load_companies())
+    index.watch() # keep index current as company.save_statements() runs
+    index.query([('net_margin', '>', 0.2), ('current_ratio', '>', 1.5)], last_years = 5)
+"""
+
+from definitions import INDEX_PATH
+from modules.universe import load_companies, stack_companies, cube_names
+from modules.indexing import universe_index
+
+import numpy as np
+
+class screen_index(universe_index):
+    """
+    Sorted per-metric, per-year index over a universe of company objects.
+
+    Built from companies whose metrics have been calculated. Rebuilds only the
+    changed ticker when statements are saved after watch() is called.
+    """
+    def __init__(self, companies = None, metrics = None, locations = ['metrics']):
+        """
+        args:
+            companies: list of company objects. Leave empty and call load_index()
+            to restore a saved index instead.
+            metrics: optional list of metric names to index. Default is every metric.
+            locations: statement dicts to index. Add 'statement' to screen on
+            raw rows like total_revenue.
+        """
+        self.metrics = metrics
+        self.locations = locations
+
+        self.tickers = []
+        self.years = []
+        # metric -> tickers x years array of values
+        self.values = dict()
+        # metric -> tickers x years array of ticker positions, sorted ascending
+        # within each year column. NaN values sort to the end of each column.
+        self.order = dict()
+        # metric -> values reordered by self.order. What np.searchsorted runs against.
+        self.sorted_values = dict()
+
+        if companies != None:
+            self.build(companies)
+
+    def build(self, companies):
+        """
+        Build the index from scratch from a list of company objects.
+        """
+        cube = stack_companies(companies, locations = self.locations, names = self.metrics)
+
+        self.tickers = cube['tickers']
+        self.years = cube['years']
+        self.values = {name:cube['values'][:, i, :] for i, name in enumerate(cube_names(cube))}
+
+        for metric in self.values.keys():
+            self.sort_metric(metric)
+
+        return None
+
+    def sort_metric(self, metric):
+        """
+        Recompute the sorted order of every year column of one metric.
+        """
+        values = self.values[metric]
+        # argsort puts NaN at the end, which keeps them out of every range query
+        self.order[metric] = np.argsort(values, axis = 0, kind = 'stable')
+        self.sorted_values[metric] = np.take_along_axis(values, self.order[metric], axis = 0)
+
+        return None
+
+    def update(self, co):
+        """
+        Replace (or add) a single company's values in the index and re-sort only
+        the metrics whose values changed.
+
+        Indexed metrics the company no longer has are cleared to NaN, so
+        screens never match on its old values.
+
+        This is the incremental path. No other company is reloaded.
+        """
+        cube = stack_companies([co], locations = self.locations, names = self.metrics)
+        ticker = cube['tickers'][0]
+
+        # STEP 1: Grow the year axis if this company reports a year nobody else does
+        new_years = [x for x in cube['years'] if x not in self.years]
+        if len(new_years) > 0:
+            years = sorted(self.years + new_years, reverse = True)
+            positions = [years.index(x) for x in self.years]
+            for metric, values in self.values.items():
+                grown = np.full((values.shape[0], len(years)), np.nan)
+                grown[:, positions] = values
+                self.values[metric] = grown
+            self.years = years
+
+        # STEP 2: Find or add the ticker's row
+        new_ticker = ticker not in self.tickers
+        if new_ticker:
+            self.tickers.append(ticker)
+            for metric, values in self.values.items():
+                self.values[metric] = np.vstack([values, np.full((1, len(self.years)), np.nan)])
+        row = self.tickers.index(ticker)
+
+        # STEP 3: Overwrite the row of every indexed metric. Metrics the company doesn't have become NaN.
+        positions = [self.years.index(x) for x in cube['years']]
+        company_values = {x:cube['values'][0, i, :] for i, x in enumerate(cube_names(cube))}
+        changed = []
+        for metric in list(self.values.keys()) + [x for x in company_values.keys() if x not in self.values.keys()]:
+            if metric not in self.values.keys():
+                self.values[metric] = np.full((len(self.tickers), len(self.years)), np.nan)
+            values = np.full(len(self.years), np.nan)
+            if metric in company_values.keys():
+                values[positions] = company_values[metric]
+            if not np.array_equal(self.values[metric][row], values, equal_nan = True):
+                self.values[metric][row] = values
+                changed.append(metric)
+
+        # STEP 4: Re-sort changed metrics. A new year column means every metric's columns moved.
+        for metric in self.values.keys():
+            if len(new_years) > 0 or metric in changed or metric not in self.order.keys():
+                self.sort_metric(metric)
+            elif new_ticker:
+                # The new row is all NaN, which belongs at the end of every sorted column
+                self.order[metric] = np.vstack([self.order[metric], np.full((1, len(self.years)), row)])
+                self.sorted_values[metric] = np.vstack([self.sorted_values[metric], np.full((1, len(self.years)), np.nan)])
+
+        return None
+
+    def remove(self, ticker):
+        """
+        Drop a ticker from the index.
+        """
+        if ticker not in self.tickers:
+            return None
+
+        row = self.tickers.index(ticker)
+        self.tickers.pop(row)
+        for metric in self.values.keys():
+            self.values[metric] = np.delete(self.values[metric], row, axis = 0)
+            self.sort_metric(metric)
+
+        return None
+
+    def match(self, metric, operator, threshold, years):
+        """
+        Evaluate one predicate on one metric.
+
+        args:
+            metric: metric name.
+            operator: one of '>', '>=', '<', '<=', '=='.
+            threshold: number to compare against.
+            years: list of year_adjusted values to evaluate.
+
+        returns: boolean np array. Shape is tickers x len(years).
+        """
+        if metric not in self.values.keys():
+            raise KeyError('{} is not indexed. Indexed metrics: {}'.format(metric, ', '.join(self.values.keys())))
+
+        mask = np.zeros((len(self.tickers), len(years)), dtype = bool)
+        for j, year in enumerate(years):
+            if year not in self.years:
+                continue
+            col = self.years.index(year)
+            sorted_col = self.sorted_values[metric][:, col]
+            order_col = self.order[metric][:, col]
+            # NaN values sit at the end of the column. Leave them out of every match.
+            valid = np.count_nonzero(~np.isnan(sorted_col))
+
+            if operator == '>':
+                matched = order_col[np.searchsorted(sorted_col[:valid], threshold, side = 'right'):valid]
+            elif operator == '>=':
+                matched = order_col[np.searchsorted(sorted_col[:valid], threshold, side = 'left'):valid]
+            elif operator == '<':
+                matched = order_col[:np.searchsorted(sorted_col[:valid], threshold, side = 'left')]
+            elif operator == '<=':
+                matched = order_col[:np.searchsorted(sorted_col[:valid], threshold, side = 'right')]
+            elif operator == '==':
+                matched = order_col[np.searchsorted(sorted_col[:valid], threshold, side = 'left'):np.searchsorted(sorted_col[:valid], threshold, side = 'right')]
+            else:
+                raise ValueError('Invalid operator provided. Should be >, >=, <, <= or ==. Is {}'.format(operator))
+
+            mask[matched, j] = True
+
+        return mask
+
+    def query(self, conditions, years = None, last_years = None, how = 'all'):
+        """
+        Return tickers that satisfy every condition.
+
+        args:
+            conditions: list of (metric, operator, threshold) tuples. All must hold.
+            Example: [('net_margin', '>', 0.2), ('current_ratio', '>', 1.5)]
+            years: list of year_adjusted values to screen. Default is all years.
+            last_years: int. Screen only the most recent n years instead. Note that
+            the ttm column counts as the most recent year.
+            how: 'all' requires conditions to hold in every screened year.
+            'any' requires them to hold (together) in at least one year.
+
+        returns: list of matching tickers.
+        """
+        if last_years != None:
+            years = self.years[:last_years]
+        elif years == None:
+            years = self.years
+        years = [str(x) for x in years]
+
+        mask = np.ones((len(self.tickers), len(years)), dtype = bool)
+        for metric, operator, threshold in conditions:
+            mask &= self.match(metric, operator, threshold, years)
+
+        if how == 'all':
+            matches = mask.all(axis = 1)
+        elif how == 'any':
+            matches = mask.any(axis = 1)
+        else:
+            raise ValueError('Invalid how provided. Should be all or any. Is {}'.format(how))
+
+        return [self.tickers[i] for i in np.flatnonzero(matches)]
+
+    def top(self, metric, year, n = 10, ascending = False):
+        """
+        Return the n tickers with the highest (or lowest) value of a metric in a year,
+        read straight from the sorted index.
+        """
+        col = self.years.index(str(year))
+        order_col = self.order[metric][:, col]
+        valid = np.count_nonzero(~np.isnan(self.sorted_values[metric][:, col]))
+
+        ranked = order_col[:valid] if ascending else order_col[:valid][::-1]
+
+        return [self.tickers[i] for i in ranked[:n]]
+
+    def index_file(self):
+        return INDEX_PATH + 'screen_index.npz'
+
+    def index_arrays(self):
+        """
+        Arrays save_index() writes. Sort orders are left out, since they're
+        cheap to recompute relative to reading the statements.
+        """
+        metrics = list(self.values.keys())
+        values = np.stack([self.values[x] for x in metrics]) if len(metrics) > 0 else np.zeros((0, 0, 0))
+
+        return dict(tickers = np.array(self.tickers), years = np.array(self.years), metrics = np.array(metrics), values = values)
+
+    def restore_index(self, data):
+        """
+        Restore arrays written by save_index() and recompute sort orders.
+        """
+        self.tickers = data['tickers'].tolist()
+        self.years = data['years'].tolist()
+        self.values = {x:data['values'][i] for i, x in enumerate(data['metrics'].tolist())}
+        self.order = dict()
+        self.sorted_values = dict()
+        for metric in self.values.keys():
+            self.sort_metric(metric)
+
+        return None
+
+def screen_universe(conditions, years = None, last_years = None, how = 'all'):
+    """
+    One-off screen of every ticker saved to the output folder.
+
+    Builds a throwaway screen_index. Keep a screen_index around instead when
+    screening more than once.
+    """
+    index = screen_index(load_companies())
+
+    return index.query(conditions, years = years, last_years = last_years, how = how)
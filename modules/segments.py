@@ -0,0 +1,327 @@
+"""
+Named segments whose summed statements and metrics are saved and kept
+current one member at a time.
+
+Adding companies with company.__add__() rebuilds a segment from every
+member. Here a segment is built once with define_segment(). After that, every
+time a member's statements are saved, its old contribution is subtracted
+from the segment's sums and the new one added. Updates cost one member, not
+the whole segment.
+
+Each segment statement keeps, per row and year, a sum and a count of the
+members that reported a value, plus how many members cover each year. The
+segment view follows company.__add__() rules: only years every member
+covers, only rows every member reports, and NaN where any member's value is
+missing.
+
+Each segment's file also keeps the contribution it last added for each
+member, so it can be subtracted exactly later, however the member's file was
+rewritten and whichever other segments were defined since.
+
+Members' currencies aren't converted, same as company.__add__().
+
+Example:
+    define_segment('megacap_tech', ['AAPL','MSFT','GOOG'])
+    segment = load_segment('megacap_tech') # company object
+    segment.plot(['net_margin'])
+"""
+
+from definitions import OUTPUT_PATH, SEGMENT_PATH
+from modules.classes import company
+from modules.files import save_json, import_json, import_statement_json, register_save_hook
+
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Statement dict keys that aren't rows
+YEAR_KEYS = ['year', 'year_adjusted']
+
+def segment_file(name, path = SEGMENT_PATH):
+    return path + name + '.json'
+
+def registry_file(path = SEGMENT_PATH):
+    return path + 'segments.json'
+
+def list_segments(path = SEGMENT_PATH):
+    """
+    Return a dict mapping each segment name to its member tickers.
+    """
+    if not os.path.exists(registry_file(path)):
+        return dict()
+
+    return import_json(registry_file(path))
+
+def empty_aggregate():
+    """
+    Running sums for one segment statement.
+        years: year_adjusted values, newest first.
+        year_members: members covering each year.
+        members: members with this statement.
+        rows: row name -> dict(sum, count, members). sum and count are aligned
+        to years. members is how many members report the row at all.
+    """
+    return dict(years = [], year_members = np.zeros(0), members = 0, rows = dict())
+
+def add_contribution(aggregate, statement, sign = 1):
+    """
+    Add (sign = 1) or subtract (sign = -1) one member's statement rows.
+
+    args:
+        aggregate: dict from empty_aggregate(). Updated in place.
+        statement: a member's statement dict, like co.statements['is']['statement'].
+    """
+    # STEP 1: Grow the year axis to cover the member's years, newest first
+    new_years = [x for x in statement['year_adjusted'] if x not in aggregate['years']]
+    if len(new_years) > 0:
+        years = sorted(aggregate['years'] + new_years, reverse = True)
+        old_cols = [years.index(x) for x in aggregate['years']]
+        year_members = np.zeros(len(years))
+        year_members[old_cols] = aggregate['year_members']
+        aggregate['year_members'] = year_members
+        for row in aggregate['rows'].values():
+            for measure in ['sum', 'count']:
+                grown = np.zeros(len(years))
+                grown[old_cols] = row[measure]
+                row[measure] = grown
+        aggregate['years'] = years
+
+    cols = [aggregate['years'].index(x) for x in statement['year_adjusted']]
+
+    # STEP 2: Add or remove the member's values. NaN adds nothing but isn't counted.
+    aggregate['members'] += sign
+    aggregate['year_members'][cols] += sign
+    for name, values in statement.items():
+        if name in YEAR_KEYS or not isinstance(values, np.ndarray):
+            continue
+        row = aggregate['rows'].setdefault(name, dict(sum = np.zeros(len(aggregate['years'])), count = np.zeros(len(aggregate['years'])), members = 0))
+        seen = ~np.isnan(values)
+        row['sum'][cols] += sign * np.where(seen, values, 0)
+        row['count'][cols] += sign * seen
+        row['members'] += sign
+
+    # STEP 3: Drop rows and years nobody contributes to anymore. Zeroing sums
+    # where nothing is counted keeps float error from lingering.
+    aggregate['rows'] = {k:v for k, v in aggregate['rows'].items() if v['members'] > 0}
+    for row in aggregate['rows'].values():
+        row['sum'][row['count'] == 0] = 0
+    keep = aggregate['year_members'] > 0
+    if not np.all(keep):
+        aggregate['years'] = [x for x, k in zip(aggregate['years'], keep) if k]
+        aggregate['year_members'] = aggregate['year_members'][keep]
+        for row in aggregate['rows'].values():
+            row['sum'] = row['sum'][keep]
+            row['count'] = row['count'][keep]
+
+    return aggregate
+
+def aggregate_view(aggregate):
+    """
+    Build the segment's statement from running sums, following
+    company.__add__() rules.
+
+    returns: statement dict with year_adjusted and one np array per row.
+    """
+    full_years = aggregate['year_members'] == aggregate['members']
+    view = dict(year_adjusted = [x for x, k in zip(aggregate['years'], full_years) if k])
+    for name, row in aggregate['rows'].items():
+        if row['members'] != aggregate['members']:
+            continue
+        values = np.where(row['count'] == aggregate['members'], row['sum'], np.nan)
+        view[name] = values[full_years]
+
+    return view
+
+def build_view(name, tickers, aggregates):
+    """
+    Turn a segment's aggregates into a company object with metrics calculated.
+    """
+    segment = company(method = None)
+    segment.ticker = list(tickers)
+    for statement, aggregate in aggregates.items():
+        if aggregate['members'] > 0:
+            segment.statements[statement] = dict(company = list(tickers), segment = name, statement = aggregate_view(aggregate))
+
+    try:
+        segment.calculate_metrics()
+    except KeyError as e:
+        logger.warning('Could not calculate metrics for segment %s. Missing row %s.', name, e)
+    segment.index_metrics()
+
+    return segment
+
+def save_segment(name, tickers, aggregates, ledger, path = SEGMENT_PATH):
+    """
+    Save a segment's running sums, the contribution it holds for each member
+    and its current view (statements and metrics).
+
+    args:
+        ledger: dict of ticker -> statement -> contribution last added to the
+        segment, or None when the member had no saved statement.
+    """
+    view = build_view(name, tickers, aggregates)
+    saved = dict(name = name,
+                tickers = list(tickers),
+                aggregates = aggregates,
+                ledger = ledger,
+                view = {k:dict(statement = v['statement'], metrics = v.get('metrics', dict())) for k, v in view.statements.items()})
+    save_json(saved, segment_file(name, path))
+
+    return view
+
+def read_segment(name, path = SEGMENT_PATH):
+    """
+    Load a saved segment, with lists converted back to np arrays.
+
+    returns: dict with name, tickers, aggregates, ledger and view.
+    """
+    saved = import_json(segment_file(name, path))
+    saved['ledger'] = {ticker:{k:read_contribution(v) for k, v in contributions.items()} for ticker, contributions in saved.get('ledger', dict()).items()}
+    for aggregate in saved['aggregates'].values():
+        aggregate['year_members'] = np.asarray(aggregate['year_members'], dtype = float)
+        for row in aggregate['rows'].values():
+            row['sum'] = np.asarray(row['sum'], dtype = float)
+            row['count'] = np.asarray(row['count'], dtype = float)
+    for statement in saved['view'].values():
+        for section in ['statement', 'metrics']:
+            for key, values in statement[section].items():
+                if key not in YEAR_KEYS and isinstance(values, list):
+                    statement[section][key] = np.array([np.nan if x == None else x for x in values], dtype = float)
+
+    return saved
+
+def load_segment(name, path = SEGMENT_PATH):
+    """
+    Return a saved segment as a company object, like the one
+    company.__add__() would build, with metrics already calculated.
+    """
+    saved = read_segment(name, path)
+
+    segment = company(method = None)
+    segment.ticker = saved['tickers']
+    for statement, view in saved['view'].items():
+        segment.statements[statement] = dict(company = saved['tickers'], segment = name, statement = view['statement'], metrics = view['metrics'])
+    segment.index_metrics()
+
+    return segment
+
+def member_statement(ticker, statement, output_path = OUTPUT_PATH):
+    """
+    Read a member's saved statement rows, or None when it isn't saved.
+    """
+    filepath = output_path + ticker + '_' + statement + '.json'
+    if not os.path.exists(filepath):
+        return None
+
+    return import_statement_json(filepath)['statement']
+
+def read_contribution(saved):
+    """
+    Convert a contribution read from a segment file back to np arrays.
+    """
+    if saved == None:
+        return None
+
+    return {k:np.array([np.nan if x == None else x for x in v], dtype = float) if k not in YEAR_KEYS else v for k, v in saved.items()}
+
+def ledger_entry(contribution):
+    """
+    The part of a member's statement a segment keeps to subtract it later.
+    """
+    if contribution == None:
+        return None
+
+    return {k:v for k, v in contribution.items() if k != 'year'}
+
+def define_segment(name, tickers, statements = ['is','bs','cfs'], path = SEGMENT_PATH, output_path = OUTPUT_PATH):
+    """
+    Build a segment from members' saved statements and save it. Redefining
+    an existing name rebuilds it from scratch.
+
+    Members without saved statements are included, and are added as soon as
+    their statements are saved.
+
+    returns: the segment as a company object.
+    """
+    os.makedirs(path, exist_ok = True)
+
+    aggregates = {x:empty_aggregate() for x in statements}
+    ledger = {x:dict() for x in tickers}
+    for ticker in tickers:
+        for statement in statements:
+            contribution = member_statement(ticker, statement, output_path)
+            if contribution == None:
+                logger.warning('%s has no saved %s statement. It will be added once saved.', ticker, statement)
+            else:
+                add_contribution(aggregates[statement], contribution)
+            ledger[ticker][statement] = ledger_entry(contribution)
+
+    registry = list_segments(path)
+    registry[name] = list(tickers)
+    save_json(registry, registry_file(path))
+
+    return save_segment(name, tickers, aggregates, ledger, path)
+
+def delete_segment(name, path = SEGMENT_PATH):
+    """
+    Remove a segment.
+    """
+    registry = list_segments(path)
+    registry.pop(name, None)
+    save_json(registry, registry_file(path))
+
+    if os.path.exists(segment_file(name, path)):
+        os.remove(segment_file(name, path))
+
+    return None
+
+def update_member(ticker, statements = ['is','bs','cfs'], path = SEGMENT_PATH, output_path = OUTPUT_PATH):
+    """
+    Swap a member's old contribution for its newly saved statements in every
+    segment it belongs to.
+
+    returns: list of segment names updated.
+    """
+    segments = [k for k, v in list_segments(path).items() if ticker in v]
+    if len(segments) == 0:
+        return []
+
+    new = {x:member_statement(ticker, x, output_path) for x in statements}
+
+    # Each segment subtracts the contribution it added itself, since members
+    # can be saved between one segment's definition and another's
+    for name in segments:
+        saved = read_segment(name, path)
+        ledger = saved['ledger'].setdefault(ticker, dict())
+        for statement, contribution in new.items():
+            if statement not in saved['aggregates'].keys():
+                continue
+            aggregate = saved['aggregates'][statement]
+            if ledger.get(statement) != None:
+                add_contribution(aggregate, ledger[statement], sign = -1)
+            if contribution != None:
+                add_contribution(aggregate, contribution)
+            ledger[statement] = ledger_entry(contribution)
+        save_segment(name, saved['tickers'], saved['aggregates'], saved['ledger'], path)
+        logger.info('Updated segment %s with new %s statements for %s', name, ', '.join(statements), ticker)
+
+    return segments
+
+def update_segments_on_save(co, statements = None):
+    """
+    Save hook. Updates every segment the saved company belongs to.
+
+    Segments themselves (companies with a list of tickers) are never saved to
+    the output folder, so they're ignored.
+    """
+    if not isinstance(co.ticker, str) or not os.path.exists(registry_file()):
+        return None
+
+    update_member(co.ticker, ['is','bs','cfs'] if statements == None else list(statements))
+
+    return None
+
+register_save_hook(update_segments_on_save)
@@ -0,0 +1,218 @@
+"""
+Publish the saved universe once into memory-mapped files and let any number
+of worker processes attach to it without copying.
+
+Every worker that calls load_companies() holds its own copy of every
+statement and metric array, so RAM grows with worker count. Instead:
+    1. One process calls publish_universe(). Every row and metric of every
+    company is packed into one flat float64 .npy file, and a JSON manifest
+    records where each row starts and ends. Optionally, a stacked cube (see
+    modules.universe) is written next to it.
+    2. Workers call attach_universe() or attach_company(). The .npy files are
+    opened with np.load(mmap_mode = 'r'), so every process shares the same
+    page cache pages. Rows in the returned company objects are read-only
+    slices of that map. Nothing is copied.
+
+Point SHARED_PATH at a tmpfs like /dev/shm to keep the published files in
+memory rather than on disk.
+
+Each publish writes new versioned files and swaps the manifest last, so
+workers attached to an older version keep working until they reattach.
+
+Attached companies are read-only. Methods that write into rows in place,
+like convert_currency(), raise ValueError on them. Use copy.deepcopy(co) to
+get a writable company first.
+
+Example:
+    publish_universe() # in the parent, once
+    universe = attach_universe() # in each worker
+    universe['AAPL'].statements['is']['metrics']['net_margin']
+"""
+
+from definitions import SHARED_PATH
+from modules.classes import company
+from modules.universe import load_companies, get_company_keys, stack_companies, company_label
+
+from datetime import datetime
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Statement dict keys that are year labels rather than rows
+YEAR_KEYS = ['year', 'year_adjusted']
+
+# Memory maps opened by this process, by file path. Reused across attaches.
+ATTACHED = dict()
+
+def manifest_path(path = SHARED_PATH):
+    return path + 'manifest.json'
+
+def publish_universe(companies = None, path = SHARED_PATH, cube_locations = ['metrics']):
+    """
+    Pack every row and metric of many companies into one memory-mappable
+    file and write the manifest workers attach with.
+
+    args:
+        companies: list of company objects. Default is load_companies(), every
+        saved ticker with metrics calculated.
+        path: folder to publish into.
+        cube_locations: also publish a stacked cube of these locations
+        ('statement', 'metrics'). None skips the cube.
+
+    returns: the manifest dict.
+    """
+    companies = load_companies() if companies == None else companies
+    os.makedirs(path, exist_ok = True)
+    version = datetime.now().strftime('%Y%m%d%H%M%S%f')
+
+    # STEP 1: Lay out every row end to end and record its offset and length
+    rows = []
+    offset = 0
+    tickers = dict()
+    for co in companies:
+        statements = dict()
+        for statement, location, name in get_company_keys(co, ['statement', 'metrics']):
+            if name in YEAR_KEYS:
+                continue
+            statement_dict = co.statements[statement]
+            if statement not in statements.keys():
+                # Keep everything that isn't a row, like currency and scraped_at
+                statements[statement] = dict(
+                    info = {k:v for k, v in statement_dict.items() if not isinstance(v, dict)},
+                    year = list(statement_dict['statement']['year']),
+                    year_adjusted = list(statement_dict['statement']['year_adjusted']),
+                    rows = dict(statement = [], metrics = []))
+            row = np.asarray(statement_dict[location][name], dtype = float)
+            statements[statement]['rows'][location].append([name, offset, len(row)])
+            rows.append(row)
+            offset += len(row)
+        tickers[company_label(co)] = dict(currency = co.currency, statements = statements)
+
+    # STEP 2: Write the flat values file
+    values_file = 'values_{}.npy'.format(version)
+    values = np.lib.format.open_memmap(path + values_file, mode = 'w+', dtype = np.float64, shape = (offset,))
+    if offset > 0:
+        values[:] = np.concatenate(rows)
+    values.flush()
+    del values
+
+    manifest = dict(version = version, values_file = values_file, tickers = tickers)
+
+    # STEP 3: Optionally write the stacked cube for universe-wide array math
+    if cube_locations != None:
+        cube = stack_companies(companies, locations = cube_locations)
+        cube_file = 'cube_{}.npy'.format(version)
+        np.save(path + cube_file, cube['values'])
+        manifest['cube'] = dict(file = cube_file, tickers = cube['tickers'], keys = [list(x) for x in cube['keys']],
+                                years = list(cube['years']), currencies = cube['currencies'])
+
+    # STEP 4: Swap the manifest in last, so attachers never see a half-written publish
+    temp_file = manifest_path(path) + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_file, manifest_path(path))
+
+    logger.info('Published %s tickers (%s values) as version %s', len(tickers), offset, version)
+
+    return manifest
+
+def remove_stale_versions(path = SHARED_PATH):
+    """
+    Delete published files that the current manifest no longer points to.
+    Only call this once no worker is attached to an older version.
+    """
+    manifest = read_manifest(path)
+    keep = [manifest['values_file'], manifest.get('cube', dict()).get('file')]
+
+    for f in os.listdir(path):
+        if f.endswith('.npy') and f not in keep:
+            os.remove(path + f)
+
+    return None
+
+def read_manifest(path = SHARED_PATH):
+    with open(manifest_path(path)) as f:
+        return json.load(f)
+
+def open_values(filepath):
+    """
+    Memory map a published .npy file read-only, once per process.
+    """
+    if filepath not in ATTACHED.keys():
+        ATTACHED[filepath] = np.load(filepath, mmap_mode = 'r')
+
+    return ATTACHED[filepath]
+
+def build_company_view(ticker, entry, values):
+    """
+    Build a company object whose rows are read-only slices of values.
+    """
+    co = company(ticker, method = None)
+    co.currency = entry['currency']
+
+    for statement, published in entry['statements'].items():
+        statement_dict = dict(published['info'])
+        statement_dict['statement'] = dict(year = published['year'], year_adjusted = published['year_adjusted'])
+        for location in ['statement', 'metrics']:
+            section = statement_dict.setdefault(location, dict())
+            for name, offset, length in published['rows'][location]:
+                # view() drops the memmap subclass, so array math returns plain arrays
+                section[name] = values[offset:offset + length].view(np.ndarray)
+        co.statements[statement] = statement_dict
+
+    co.index_metrics()
+
+    return co
+
+def attach_company(ticker, path = SHARED_PATH, manifest = None):
+    """
+    Return a read-only company view of one published ticker.
+
+    args:
+        manifest: manifest dict from read_manifest(). Pass it when attaching many
+        tickers to avoid rereading it each time.
+    """
+    manifest = read_manifest(path) if manifest == None else manifest
+    if ticker not in manifest['tickers'].keys():
+        raise KeyError('{} is not in the published universe.'.format(ticker))
+
+    values = open_values(path + manifest['values_file'])
+
+    return build_company_view(ticker, manifest['tickers'][ticker], values)
+
+def attach_universe(tickers = None, path = SHARED_PATH):
+    """
+    Return read-only company views of published tickers.
+
+    args:
+        tickers: list of tickers. Default is every published ticker.
+
+    returns: dict mapping ticker to company object.
+    """
+    manifest = read_manifest(path)
+    tickers = list(manifest['tickers'].keys()) if tickers == None else tickers
+
+    return {x:attach_company(x, path, manifest) for x in tickers}
+
+def attach_cube(path = SHARED_PATH):
+    """
+    Return the published cube (see modules.universe) with values memory
+    mapped read-only. Works with screening, peers and similarity functions
+    that read cubes.
+    """
+    manifest = read_manifest(path)
+    if 'cube' not in manifest.keys():
+        raise KeyError('No cube was published. Pass cube_locations to publish_universe().')
+
+    published = manifest['cube']
+    values = open_values(path + published['file'])
+
+    return dict(tickers = published['tickers'],
+                keys = [tuple(x) for x in published['keys']],
+                years = published['years'],
+                values = values,
+                currencies = published['currencies'])
@@ -0,0 +1,272 @@
+"""
+Trajectory similarity search. Given a ticker's trend for a metric, like
+operating_margin, find the companies whose trend looks most like it over the
+years they share.
+
+A trajectory_index holds one tickers x years matrix for a metric, plus a
+mask of which years each ticker actually reports. Trajectories are compared
+on shape rather than scale, so each pair is normalized over the years both
+tickers cover, when it's compared. A ticker's distance to another never
+depends on years the other doesn't report.
+
+Distances between a query and every other ticker come out of matrix
+products over the masks:
+    zscore: counts, sums, sums of squares and sums of products over shared
+    years give each pair's means, variances and covariance. The distance
+    between z-scored trajectories is sqrt(2 - 2 * correlation).
+    minmax: shared-year minimums and maximums aren't sums, so each query is
+    compared with every ticker in one masked array operation instead.
+    none: raw values, from the same sums.
+
+Example:
+    index = trajectory_index('operating_margin', load_companies())
+    index.watch() # refresh tickers as company.save_statements() runs
+    index.nearest('AAPL', k = 5)
+"""
+
+from definitions import INDEX_PATH
+from modules.universe import stack_companies
+from modules.indexing import universe_index
+
+import numpy as np
+
+# Normalizations trajectory_index knows
+NORMALIZE_METHODS = ['zscore', 'minmax', 'none']
+
+# Variances below this share of a pair's mean square are treated as a flat
+# trajectory. Sums of squares leave rounding noise where a true variance is 0.
+FLAT_TOLERANCE = 1e-10
+
+def pair_sums(q, mq, x, mx):
+    """
+    Count and sums of every (query, ticker) pair over the years both report.
+
+    args:
+        q, mq: queries x years values (0 where missing) and 0/1 masks.
+        x, mx: tickers x years values (0 where missing) and 0/1 masks.
+
+    returns: dict of queries x tickers np arrays: n (shared years), q, x
+    (sums), qq, xx (sums of squares) and qx (sum of products).
+    """
+    return dict(n = mq @ mx.T,
+                q = (mq * q) @ mx.T,
+                x = mq @ (mx * x).T,
+                qq = (mq * q ** 2) @ mx.T,
+                xx = mq @ (mx * x ** 2).T,
+                qx = (mq * q) @ (mx * x).T)
+
+def zscore_squared_distance(sums):
+    """
+    Mean squared distance between each pair's trajectories, each z-scored
+    over the years the pair shares. Flat trajectories z-score to 0.
+    """
+    n = sums['n']
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean_q = sums['q'] / n
+        mean_x = sums['x'] / n
+        var_q = sums['qq'] / n - mean_q ** 2
+        var_x = sums['xx'] / n - mean_x ** 2
+        cov = sums['qx'] / n - mean_q * mean_x
+
+        flat_q = var_q <= FLAT_TOLERANCE * np.abs(sums['qq'] / n)
+        flat_x = var_x <= FLAT_TOLERANCE * np.abs(sums['xx'] / n)
+        correlation = np.where(flat_q | flat_x, 0, cov / np.sqrt(np.abs(var_q * var_x)))
+
+    # mean(z_q ^ 2) is 1, or 0 for a flat trajectory
+    return np.where(flat_q, 0, 1) + np.where(flat_x, 0, 1) - 2 * correlation
+
+def minmax_squared_distance(q, mq, x, mx):
+    """
+    Mean squared distance between each pair's trajectories, each scaled to
+    0-1 over the years the pair shares. Flat trajectories scale to 0.
+
+    Compares one query at a time against every ticker, so memory holds one
+    tickers x years array per query.
+    """
+    squared = np.full((q.shape[0], x.shape[0]), np.nan)
+    for i in range(q.shape[0]):
+        shared = (mq[i] * mx) > 0
+        n = shared.sum(axis = 1)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            scaled = []
+            for values in [np.broadcast_to(q[i], x.shape), x]:
+                low = np.where(shared, values, np.inf).min(axis = 1, keepdims = True)
+                high = np.where(shared, values, -np.inf).max(axis = 1, keepdims = True)
+                scaled.append(np.where(high > low, (values - low) / np.where(high > low, high - low, 1), 0))
+            squared[i] = np.where(shared, (scaled[0] - scaled[1]) ** 2, 0).sum(axis = 1) / n
+
+    return squared
+
+class trajectory_index(universe_index):
+    """
+    Reusable nearest-neighbour index over one metric's trajectories.
+    """
+    def __init__(self, metric, companies = None, normalize = 'zscore', location = 'metrics'):
+        """
+        args:
+            metric: name of the metric or statement row to compare.
+            companies: list of company objects. Leave empty and call load_index()
+            to restore a saved index instead.
+            normalize: 'zscore' (subtract mean, divide by std), 'minmax'
+            (scale to 0-1) or 'none'. Applied to each pair over the years
+            both tickers report.
+            location: 'metrics' or 'statement'. Where the metric lives.
+        """
+        if normalize not in NORMALIZE_METHODS:
+            raise ValueError('Invalid normalize provided. Should be one of {}. Is {}'.format(', '.join(NORMALIZE_METHODS), normalize))
+
+        self.metric = metric
+        self.normalize = normalize
+        self.location = location
+
+        self.tickers = []
+        self.years = []
+        # tickers x years. Raw values, NaN for years a ticker doesn't report.
+        self.values = np.zeros((0, 0))
+
+        if companies != None:
+            self.build(companies)
+
+    def build(self, companies):
+        """
+        Build the index from scratch from a list of company objects.
+        """
+        cube = stack_companies(companies, locations = [self.location], names = [self.metric])
+
+        self.tickers = cube['tickers']
+        self.years = cube['years']
+        self.values = cube['values'][:, 0, :] if len(cube['keys']) > 0 else np.full((len(self.tickers), len(self.years)), np.nan)
+        self.refresh_matrix()
+
+        return None
+
+    def refresh_matrix(self):
+        """
+        Recompute the value matrix and year masks from self.values.
+
+        Missing years are stored as 0 with a 0 mask so distances can be computed
+        with plain matrix products. zscore and minmax ignore a shift in
+        values, so each row is centered on its own mean first. That keeps
+        sums of squares small for large values like total_revenue.
+        """
+        values = np.asarray(self.values, dtype = float)
+        self.mask = (~np.isnan(values)).astype(float)
+        if self.normalize != 'none' and values.size > 0:
+            with np.errstate(invalid = 'ignore'):
+                values = values - np.nan_to_num(np.nanmean(np.where(self.mask > 0, values, np.nan), axis = 1, keepdims = True))
+        self.matrix = np.nan_to_num(values)
+
+        return None
+
+    def update(self, co):
+        """
+        Replace (or add) one company's trajectory without touching the others.
+        """
+        cube = stack_companies([co], locations = [self.location], names = [self.metric])
+        ticker = cube['tickers'][0]
+
+        # STEP 1: Grow the year axis if the company reports a new year
+        new_years = [x for x in cube['years'] if x not in self.years]
+        if len(new_years) > 0:
+            years = sorted(self.years + new_years, reverse = True)
+            grown = np.full((len(self.tickers), len(years)), np.nan)
+            grown[:, [years.index(x) for x in self.years]] = self.values
+            self.values = grown
+            self.years = years
+
+        # STEP 2: Overwrite or append the company's row
+        row = np.full(len(self.years), np.nan)
+        if len(cube['keys']) > 0:
+            row[[self.years.index(x) for x in cube['years']]] = cube['values'][0, 0, :]
+
+        if ticker in self.tickers:
+            self.values[self.tickers.index(ticker)] = row
+        else:
+            self.tickers.append(ticker)
+            self.values = np.vstack([self.values, row])
+
+        self.refresh_matrix()
+
+        return None
+
+    def distances(self, tickers, min_years = 3):
+        """
+        Root mean squared distance between each ticker in tickers and every
+        ticker in the index, over the years each pair has in common. Each
+        pair is normalized over those years only (see module docstring).
+
+        args:
+            tickers: list of tickers in the index to use as queries.
+            min_years: pairs sharing fewer years than this get a distance of inf.
+
+        returns: 2D np array. Shape is len(tickers) x number of indexed tickers.
+        """
+        rows = [self.tickers.index(x) for x in tickers]
+        q = self.matrix[rows]
+        mq = self.mask[rows]
+
+        if self.normalize == 'minmax':
+            shared = mq @ self.mask.T
+            squared = minmax_squared_distance(q, mq, self.matrix, self.mask)
+        else:
+            sums = pair_sums(q, mq, self.matrix, self.mask)
+            shared = sums['n']
+            if self.normalize == 'zscore':
+                squared = zscore_squared_distance(sums)
+            else:
+                with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                    squared = (sums['qq'] - 2 * sums['qx'] + sums['xx']) / shared
+
+        distance = np.sqrt(np.clip(squared, 0, None))
+        distance[(shared < min_years) | np.isnan(distance)] = np.inf
+
+        return distance
+
+    def nearest(self, ticker, k = 5, min_years = 3):
+        """
+        Return the k tickers most similar to ticker on this index's metric.
+
+        returns: list of (ticker, distance) tuples, closest first. The query
+        ticker itself is left out.
+        """
+        return self.nearest_many([ticker], k = k, min_years = min_years)[ticker]
+
+    def nearest_many(self, tickers, k = 5, min_years = 3):
+        """
+        nearest() for many query tickers at once.
+
+        returns: dict mapping each query ticker to its list of (ticker, distance).
+        """
+        distance = self.distances(tickers, min_years = min_years)
+        # Never match a ticker with itself
+        distance[np.arange(len(tickers)), [self.tickers.index(x) for x in tickers]] = np.inf
+
+        k = min(k, len(self.tickers))
+        candidates = np.argpartition(distance, k - 1, axis = 1)[:, :k] if k > 0 else np.zeros((len(tickers), 0), dtype = int)
+
+        neighbours = dict()
+        for i, ticker in enumerate(tickers):
+            ranked = candidates[i][np.argsort(distance[i, candidates[i]])]
+            neighbours[ticker] = [(self.tickers[j], distance[i, j]) for j in ranked if np.isfinite(distance[i, j])]
+
+        return neighbours
+
+    def index_file(self):
+        return INDEX_PATH + 'trajectory_' + self.metric + '.npz'
+
+    def index_arrays(self):
+        """
+        Raw trajectories save_index() writes.
+        """
+        return dict(tickers = np.array(self.tickers), years = np.array(self.years), values = self.values)
+
+    def restore_index(self, data):
+        """
+        Restore trajectories written by save_index() and rebuild the matrix.
+        """
+        self.tickers = data['tickers'].tolist()
+        self.years = data['years'].tolist()
+        self.values = data['values']
+        self.refresh_matrix()
+
+        return None
@@ -0,0 +1,247 @@
+"""
+Canonical taxonomy of statement rows.
+
+Row names come from clean_statement_heading() on Yahoo Finance labels, so
+the same concept can show up under different names across companies
+(total_revenue vs revenues, total_current_assets vs current_assets).
+company.__add__(), calculate_metrics() and plotting match names exactly, so
+those rows are silently dropped.
+
+Every canonical row here has a stable integer id that is never reused,
+plus a list of synonyms. dictify_statement() renames synonym rows to their
+canonical name when it parses a page, and stores each statement's
+name -> id map as statements[x]['row_ids']. Rows keep string names as keys,
+so saved statements and existing code keep working. modules.universe.stack_by_id()
+stacks companies by id with integer indexing.
+
+Labels matching no canonical row or synonym are left as they are.
+unmapped_report() lists them across the saved universe, with the closest
+canonical names, so the synonym table can be grown from real data.
+
+Example:
+    row_id('total_revenue') # 1001
+    canonical_name('Total Revenues') # 'total_revenue'
+    unmapped_report()[:10]
+"""
+
+from definitions import OUTPUT_PATH
+from modules.files import get_available_tickers, import_statement_json
+from modules.cleaning import clean_statement_heading
+from modules.instrumentation import increment
+
+import difflib
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# (row id, statement, canonical name, synonyms). Ids are stable: add rows with
+# new ids, never renumber or reuse one. Canonical names are the names
+# clean_statement_heading() gives Yahoo Finance's own labels.
+CANONICAL_ROWS = [
+    (1001, 'is', 'total_revenue', ['revenue', 'revenues', 'total_revenues', 'net_revenue', 'net_revenues', 'total_net_revenue']),
+    (1002, 'is', 'operating_revenue', []),
+    (1003, 'is', 'cost_of_revenue', ['cost_of_revenues', 'total_cost_of_revenue', 'cost_of_goods_sold', 'cost_of_sales']),
+    (1004, 'is', 'gross_profit', []),
+    (1005, 'is', 'operating_expense', ['operating_expenses', 'total_operating_expenses']),
+    (1006, 'is', 'selling_general_and_administrative', ['selling_general_administrative', 'selling_general_and_administrative_expense', 'sga']),
+    (1007, 'is', 'research_and_development', ['research_development', 'research_and_development_expense']),
+    (1008, 'is', 'operating_income', ['operating_income_loss', 'income_from_operations']),
+    (1009, 'is', 'net_non_operating_interest_income_expense', []),
+    (1010, 'is', 'other_income_expense', []),
+    (1011, 'is', 'pretax_income', ['pre_tax_income', 'income_before_tax', 'income_before_taxes', 'earnings_before_tax']),
+    (1012, 'is', 'tax_provision', ['income_tax_provision', 'income_tax_expense', 'provision_for_income_taxes']),
+    (1013, 'is', 'net_income_common_stockholders', []),
+    (1014, 'is', 'net_income', ['net_income_loss', 'net_earnings']),
+    (1015, 'is', 'basic_average_shares', ['basic_weighted_average_shares', 'weighted_average_shares_basic']),
+    (1016, 'is', 'diluted_average_shares', ['diluted_weighted_average_shares', 'weighted_average_shares_diluted']),
+    (1017, 'is', 'total_expenses', []),
+    (1018, 'is', 'interest_income', []),
+    (1019, 'is', 'interest_expense', []),
+    (1020, 'is', 'ebit', []),
+    (1021, 'is', 'ebitda', []),
+    (1022, 'is', 'normalized_ebitda', []),
+    (1023, 'is', 'normalized_income', []),
+    (1024, 'is', 'reconciled_cost_of_revenue', []),
+    (1025, 'is', 'reconciled_depreciation', []),
+    (1026, 'is', 'diluted_ni_availto_com_stockholders', []),
+    (1027, 'is', 'net_income_from_continuing_operation_net_minority_interest', []),
+    (1028, 'is', 'total_operating_income_as_reported', []),
+    (2001, 'bs', 'total_assets', []),
+    (2002, 'bs', 'current_assets', ['total_current_assets']),
+    (2003, 'bs', 'cash_cash_equivalents_and_short_term_investments', []),
+    (2004, 'bs', 'receivables', []),
+    (2005, 'bs', 'inventory', ['inventories', 'total_inventory', 'total_inventories']),
+    (2006, 'bs', 'total_non_current_assets', []),
+    (2007, 'bs', 'net_ppe', ['net_property_plant_and_equipment', 'property_plant_and_equipment_net']),
+    (2008, 'bs', 'goodwill_and_other_intangible_assets', []),
+    (2009, 'bs', 'total_liabilities_net_minority_interest', ['total_liabilities']),
+    (2010, 'bs', 'current_liabilities', ['total_current_liabilities']),
+    (2011, 'bs', 'total_non_current_liabilities_net_minority_interest', []),
+    (2012, 'bs', 'total_equity_gross_minority_interest', ['total_equity']),
+    (2013, 'bs', 'stockholders_equity', ['total_stockholders_equity', 'shareholders_equity', 'total_shareholders_equity']),
+    (2014, 'bs', 'common_stock_equity', []),
+    (2015, 'bs', 'total_capitalization', []),
+    (2016, 'bs', 'net_tangible_assets', []),
+    (2017, 'bs', 'working_capital', []),
+    (2018, 'bs', 'invested_capital', []),
+    (2019, 'bs', 'tangible_book_value', []),
+    (2020, 'bs', 'total_debt', []),
+    (2021, 'bs', 'net_debt', []),
+    (2022, 'bs', 'share_issued', []),
+    (2023, 'bs', 'ordinary_shares_number', []),
+    (3001, 'cfs', 'operating_cash_flow', ['cash_from_operating_activities', 'total_cash_from_operating_activities', 'net_cash_provided_by_operating_activities']),
+    (3002, 'cfs', 'investing_cash_flow', ['cash_from_investing_activities', 'net_cash_used_for_investing_activities']),
+    (3003, 'cfs', 'financing_cash_flow', ['cash_from_financing_activities', 'net_cash_used_provided_by_financing_activities']),
+    (3004, 'cfs', 'end_cash_position', []),
+    (3005, 'cfs', 'beginning_cash_position', []),
+    (3006, 'cfs', 'changes_in_cash', []),
+    (3007, 'cfs', 'capital_expenditure', ['capital_expenditures', 'capex']),
+    (3008, 'cfs', 'issuance_of_debt', []),
+    (3009, 'cfs', 'repayment_of_debt', []),
+    (3010, 'cfs', 'repurchase_of_capital_stock', []),
+    (3011, 'cfs', 'free_cash_flow', []),
+    (3012, 'cfs', 'income_tax_paid_supplemental_data', []),
+    (3013, 'cfs', 'interest_paid_supplemental_data', []),
+]
+
+def label_key(label):
+    """
+    Matching key for a row label or name: lowercase, & as and, every run of
+    other characters as one underscore. 'Selling, General & Administrative'
+    and 'selling_general_and_administrative' share a key.
+    """
+    return re.sub('[^a-z0-9]+', '_', label.lower().replace('&', 'and')).strip('_')
+
+# Lookups built once from CANONICAL_ROWS
+ROWS_BY_ID = {row_id:dict(statement = statement, name = name, synonyms = synonyms) for row_id, statement, name, synonyms in CANONICAL_ROWS}
+ID_BY_NAME = {name:row_id for row_id, statement, name, synonyms in CANONICAL_ROWS}
+NAME_BY_KEY = dict()
+for row_id, statement, name, synonyms in CANONICAL_ROWS:
+    for label in synonyms + [name]:
+        NAME_BY_KEY[label_key(label)] = name
+
+def row_id(name):
+    """
+    Id of a canonical row name. None for names outside the taxonomy.
+    """
+    return ID_BY_NAME.get(name)
+
+def canonical_name(label):
+    """
+    Canonical row name for a label, row name or synonym. None when unmapped.
+    """
+    return NAME_BY_KEY.get(label_key(label))
+
+def resolve_row_name(label, rows = None):
+    """
+    Row name a label is saved under: its canonical name, or its cleaned
+    heading when it's outside the taxonomy.
+
+    args:
+        label: label as shown on Yahoo Finance, row name or synonym.
+        rows: optional statement dict. A synonym row can keep its own name
+        when the canonical name was already taken, so the first of the two
+        names found in rows is returned.
+    """
+    names = [x for x in [canonical_name(label), clean_statement_heading(label)] if x != None]
+    if rows != None:
+        names = [x for x in names if x in rows.keys()] + names
+
+    return names[0]
+
+def canonicalize_rows(rows):
+    """
+    Rename synonym rows of one statement to their canonical names.
+
+    A synonym is only renamed when no other row already has the canonical
+    name, so two rows never collide. The exact name wins over a synonym, and
+    an earlier synonym wins over a later one.
+
+    args:
+        rows: statement dict like company.statements['is']['statement'].
+
+    returns: tuple of (rows, row_ids, unmapped). rows is a new dict in the
+    same order, row_ids maps each canonical row name to its id and unmapped
+    lists names that matched nothing.
+    """
+    names = [x for x in rows.keys() if x not in ['year', 'year_adjusted']]
+
+    # STEP 1: Exact canonical names claim their name first
+    claimed = set(x for x in names if x in ID_BY_NAME.keys())
+    renames = dict()
+    for name in names:
+        if name in claimed:
+            continue
+        canonical = canonical_name(name)
+        if canonical != None and canonical not in claimed:
+            renames[name] = canonical
+            claimed.add(canonical)
+        elif canonical != None:
+            logger.debug('%s would duplicate %s. Keeping it under its own name.', name, canonical)
+
+    # STEP 2: Rebuild the dict in the same order, under canonical names
+    canonical_rows = {renames.get(k, k):v for k, v in rows.items()}
+    row_ids = {x:ID_BY_NAME[x] for x in canonical_rows.keys() if x in ID_BY_NAME.keys()}
+    unmapped = [x for x in canonical_rows.keys() if x not in row_ids.keys() and x not in ['year', 'year_adjusted']]
+
+    return canonical_rows, row_ids, unmapped
+
+def canonicalize_statement(statement_dict):
+    """
+    Canonicalize one statement dict in place, like
+    company.statements['is'], and store its row_ids.
+
+    returns: list of unmapped row names.
+    """
+    statement_dict['statement'], statement_dict['row_ids'], unmapped = canonicalize_rows(statement_dict['statement'])
+    increment('rows_unmapped', len(unmapped))
+
+    return unmapped
+
+def canonicalize_company(co):
+    """
+    Canonicalize every statement of a company object in place. Use on
+    statements saved before parsing canonicalized them, then save_statements().
+
+    returns: dict of statement -> list of unmapped row names.
+    """
+    unmapped = {k:canonicalize_statement(v) for k, v in co.statements.items() if 'statement' in v.keys()}
+    co.index_metrics()
+
+    return unmapped
+
+def unmapped_report(tickers = None, path = OUTPUT_PATH, suggestions = 3):
+    """
+    Rows in saved statements that match no canonical row or synonym, most
+    common first. Use it to grow CANONICAL_ROWS.
+
+    args:
+        tickers: optional list of tickers. Default is every saved ticker.
+        suggestions: closest canonical names to list for each row.
+
+    returns: list of dicts with name, statements (list), companies (count)
+    and closest (canonical names that look alike).
+    """
+    available = get_available_tickers(path)
+    tickers = available.keys() if tickers == None else [x for x in tickers if x in available.keys()]
+
+    found = dict()
+    for ticker in tickers:
+        for statement in available[ticker]:
+            rows = import_statement_json(path + ticker + '_' + statement + '.json')['statement']
+            for name in rows.keys():
+                if name in ['year', 'year_adjusted'] or canonical_name(name) != None:
+                    continue
+                entry = found.setdefault(name, dict(name = name, statements = set(), companies = set()))
+                entry['statements'].add(statement)
+                entry['companies'].add(ticker)
+
+    report = []
+    for entry in found.values():
+        report.append(dict(name = entry['name'],
+                            statements = sorted(entry['statements']),
+                            companies = len(entry['companies']),
+                            closest = difflib.get_close_matches(entry['name'], ID_BY_NAME.keys(), n = suggestions)))
+
+    return sorted(report, key = lambda x: (-x['companies'], x['name']))
@@ -0,0 +1,195 @@
+"""
+Growth and rolling-window analytics along the statement year axis.
+
+Statements store years newest first (ttm, 2021, 2020, ...). Every function
+here takes and returns arrays in that same order, with years on the last axis,
+so results line up with ['year_adjusted'] and can be dropped straight into
+statement['metrics']. Internally, values are flipped to oldest-first before
+windows are taken.
+
+Functions work on a single row, a statement's worth of rows or a whole cube
+(see modules.universe) in one vectorized pass. Years without enough history
+for a window come back as NaN.
+
+The ttm column counts as the most recent year, same as everywhere else in
+this project.
+"""
+
+from modules.universe import stack_companies, get_universe_years
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import re
+
+# Names of rows created by attach_analytics(). Skipped when picking rows to
+# analyze, so running it twice doesn't create growth-of-growth rows.
+ANALYTICS_SUFFIX = re.compile('_(yoy_growth|cagr_[0-9]+|rolling_mean_[0-9]+|volatility_[0-9]+)$')
+
+def chronological(values):
+    """
+    Flip the year axis (last axis) between newest-first and oldest-first.
+    """
+    return np.flip(values, axis = -1)
+
+def rolling_window(values, window):
+    """
+    Helper function of the rolling functions in this module.
+
+    Returns sliding windows over the year axis of a newest-first array.
+    Windows are views, not copies. Shape is values.shape[:-1] x n_windows x window,
+    where the windows are in newest-first order and each window's own values
+    are oldest-first.
+    """
+    windows = sliding_window_view(chronological(np.asarray(values, dtype = float)), window, axis = -1)
+
+    return np.flip(windows, axis = -2)
+
+def pad_windows(result, n_years):
+    """
+    Helper function of the rolling functions in this module.
+
+    Rolling results have one value per full window, so the oldest years are
+    missing. Pads them with NaN so the result lines up with the input years.
+    """
+    padded = np.full(result.shape[:-1] + (n_years,), np.nan)
+    padded[..., :result.shape[-1]] = result
+
+    return padded
+
+def yoy_growth(values):
+    """
+    Year over year growth. (this year - last year) / abs(last year).
+
+    Dividing by the absolute value keeps the sign meaningful when last year
+    was negative (a loss shrinking to a smaller loss is positive growth).
+    The oldest year has no prior year, so it's NaN.
+    """
+    values = np.asarray(values, dtype = float)
+    growth = np.full(values.shape, np.nan)
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        growth[..., :-1] = (values[..., :-1] - values[..., 1:]) / np.abs(values[..., 1:])
+    growth[~np.isfinite(growth)] = np.nan
+
+    return growth
+
+def cagr(values, periods = 3):
+    """
+    Compound annual growth rate over the trailing number of periods.
+
+    (this year / value periods ago) ^ (1 / periods) - 1. NaN when either end is
+    zero or negative, since compound growth isn't defined there.
+    """
+    values = np.asarray(values, dtype = float)
+    growth = np.full(values.shape, np.nan)
+
+    if values.shape[-1] > periods:
+        end = values[..., :-periods]
+        start = values[..., periods:]
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            growth[..., :-periods] = np.where((end > 0) & (start > 0), (end / start) ** (1 / periods) - 1, np.nan)
+
+    return growth
+
+def rolling_mean(values, window = 3):
+    """
+    Mean of each trailing window of years. NaN if any year in the window is NaN.
+    """
+    n_years = np.shape(values)[-1]
+    if n_years < window:
+        return np.full(np.shape(values), np.nan)
+
+    return pad_windows(rolling_window(values, window).mean(axis = -1), n_years)
+
+def rolling_std(values, window = 3):
+    """
+    Sample standard deviation of each trailing window of years.
+    """
+    n_years = np.shape(values)[-1]
+    if n_years < window:
+        return np.full(np.shape(values), np.nan)
+
+    return pad_windows(rolling_window(values, window).std(axis = -1, ddof = 1), n_years)
+
+def rolling_volatility(values, window = 3, growth = None):
+    """
+    Volatility of a row: the standard deviation of its year over year growth
+    across each trailing window.
+
+    growth: optional yoy_growth(values), when it's already been computed.
+    """
+    growth = yoy_growth(values) if growth is None else growth
+
+    return rolling_std(growth, window)
+
+def compute_analytics(values, window = 3, periods = 3):
+    """
+    Run every analytic in this module on the same array at once.
+
+    args:
+        values: np array with years newest first on the last axis.
+        window: years in each rolling window.
+        periods: years of compounding for cagr.
+
+    returns: dict mapping analytic suffix (yoy_growth, cagr_3, etc.) to an
+    array shaped like values.
+    """
+    growth = yoy_growth(values)
+
+    analytics = {'yoy_growth':growth,
+                'cagr_{}'.format(periods):cagr(values, periods),
+                'rolling_mean_{}'.format(window):rolling_mean(values, window),
+                'volatility_{}'.format(window):rolling_volatility(values, window, growth = growth)}
+
+    return analytics
+
+def universe_analytics(companies, locations = ['statement','metrics'], names = None, window = 3, periods = 3):
+    """
+    Compute growth and rolling analytics for every row of every company in one pass.
+
+    args:
+        companies: list of company objects.
+        locations: statement dicts to analyze.
+        names: optional list of row/metric names. Default is every row.
+        window, periods: see compute_analytics().
+
+    returns: tuple of (cube, analytics). cube is the stacked input (see
+    modules.universe). analytics maps suffix to a tickers x keys x years array.
+    """
+    cube = stack_companies(companies, locations = locations, names = names, years = get_universe_years(companies))
+    keep = [i for i, key in enumerate(cube['keys']) if not ANALYTICS_SUFFIX.search(key[2])]
+    cube['keys'] = [cube['keys'][i] for i in keep]
+    cube['values'] = cube['values'][:, keep, :]
+
+    return cube, compute_analytics(cube['values'], window = window, periods = periods)
+
+def attach_analytics(companies, locations = ['statement','metrics'], names = None, window = 3, periods = 3):
+    """
+    Compute analytics for many companies at once and store the results in
+    each company's statement['metrics'] dict.
+
+    Results are named <row>_<analytic>, like total_revenue_yoy_growth or
+    net_margin_cagr_3, and are aligned with the statement's year_adjusted.
+
+    NOTE: calculate_metrics() resets statement['metrics'], so run this after it.
+
+    returns: None
+    """
+    companies = companies if isinstance(companies, list) else [companies]
+    cube, analytics = universe_analytics(companies, locations = locations, names = names, window = window, periods = periods)
+    year_positions = {year:i for i, year in enumerate(cube['years'])}
+
+    for i, co in enumerate(companies):
+        for j, (statement, location, name) in enumerate(cube['keys']):
+            statement_dict = co.statements.get(statement, dict())
+            if name not in statement_dict.get(location, dict()).keys():
+                continue
+
+            cols = [year_positions[x] for x in statement_dict['statement']['year_adjusted']]
+            metrics = statement_dict.setdefault('metrics', dict())
+            for suffix, values in analytics.items():
+                metrics[name + '_' + suffix] = values[i, j, cols]
+
+        co.index_metrics()
+
+    return None
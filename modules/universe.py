@@ -0,0 +1,245 @@
+"""
+Functions for working with the whole universe of statements saved to the output
+folder at once.
+
+Company objects store every row as a separate np array inside nested dicts.
+That's convenient for one company, but slow when a question spans hundreds of
+tickers. The functions here stack many companies onto one shared year axis
+so that analyses can run as array math over the whole universe.
+
+A stacked universe is called a "cube" throughout this project. It's a dict:
+    tickers: list of ticker labels, one per company.
+    keys: list of (statement, location, name) tuples. location is 'statement'
+    or 'metrics'.
+    years: list of year_adjusted values, newest first like statements.
+    values: 3D np array. Shape is tickers x keys x years. NaN where missing.
+    currencies: list of reporting currencies, one per company.
+"""
+
+from modules.classes import company
+from modules.files import get_available_tickers
+from modules.cleaning import stack_rows, company_label
+from modules.taxonomy import ROWS_BY_ID, ID_BY_NAME
+from modules.validation import check_statements, format_report
+
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+def load_companies(tickers = None, statements = ['is','bs','cfs'], calculate = True, compact = False):
+    """
+    Import saved statements for many tickers and return them as company objects.
+
+    args:
+        tickers: list of ticker symbols. Default is every ticker in the output folder.
+        statements: list of statements to import for each ticker. Statements a
+        ticker doesn't have saved are skipped.
+        calculate: whether to run calculate_metrics() on each company after import.
+        compact: store each company with compact_statements(). Cuts memory for
+        large universes.
+
+    returns: list of company objects.
+    """
+    available = get_available_tickers()
+    tickers = sorted(available.keys()) if tickers == None else tickers
+
+    companies = []
+    for ticker in tickers:
+        ticker_statements = [x for x in statements if x in available.get(ticker, [])]
+        if len(ticker_statements) == 0:
+            logger.warning('No saved statements for %s. Skipping.', ticker)
+            continue
+
+        co = company(ticker, initial_statements = ticker_statements, method = 'import')
+        if compact:
+            co.compact_statements()
+        if calculate:
+            try:
+                co.calculate_metrics()
+            except KeyError as e:
+                logger.warning('Could not calculate metrics for %s. Missing row %s.', ticker, e)
+        companies.append(co)
+
+    return companies
+
+def validate_universe(tickers = None, tolerance = 0.01, verbose = True):
+    """
+    Import saved statements and run every integrity check on all of them in
+    one sweep. Metrics aren't calculated, since broken statements are exactly
+    the ones that would make calculate_metrics() fail.
+
+    args:
+        tickers: list of ticker symbols. Default is every ticker in the output folder.
+        tolerance: relative difference allowed on accounting identities.
+        verbose: print the compact report.
+
+    returns: dict mapping ticker to a list of problems. Empty if all clear.
+    """
+    report = check_statements(load_companies(tickers, calculate = False), tolerance = tolerance)
+
+    if verbose:
+        print(format_report(report))
+
+    return report
+
+def get_universe_years(companies):
+    """
+    Return every year_adjusted value found in any statement of any company,
+    newest first.
+    """
+    years = set()
+    for co in companies:
+        for statement in co.statements.values():
+            if 'statement' in statement.keys():
+                years |= set(statement['statement']['year_adjusted'])
+
+    return sorted(years, reverse = True)
+
+def get_company_keys(co, locations = ['metrics'], statements = None):
+    """
+    List (statement, location, name) keys for every np array row a company
+    holds in the given locations.
+    """
+    statements = co.statements.keys() if statements == None else statements
+
+    keys = []
+    for statement in statements:
+        if statement not in co.statements.keys():
+            continue
+        for location in locations:
+            section = co.statements[statement].get(location, dict())
+            keys += [(statement, location, k) for k, v in section.items() if isinstance(v, np.ndarray)]
+
+    return keys
+
+def stack_companies(companies, locations = ['metrics'], statements = None, names = None, years = None):
+    """
+    Stack statement rows and/or metrics of many company objects into one cube.
+
+    args:
+        companies: list of company objects.
+        locations: which statement dicts to pull from. 'statement', 'metrics' or both.
+        statements: list of statements to include (is, bs, cfs). Default is all.
+        names: optional list of row or metric names to keep. Default keeps every
+        row found in any company. When a name exists in more than one statement,
+        only the first statement's version is kept.
+        years: optional shared year axis. Default is every year in any company.
+
+    returns: cube dict (see module docstring).
+    """
+    years = get_universe_years(companies) if years == None else years
+
+    # STEP 1: Gather the union of keys across all companies, in first-seen order
+    keys = []
+    seen_names = set()
+    for co in companies:
+        for key in get_company_keys(co, locations, statements):
+            if key in keys or (names != None and key[2] not in names):
+                continue
+            # A name is only kept once, so lookups by name are unambiguous
+            if key[2] in seen_names:
+                continue
+            keys.append(key)
+            seen_names.add(key[2])
+
+    # Keep the caller's order when names were requested
+    if names != None:
+        keys.sort(key = lambda x: names.index(x[2]))
+
+    # STEP 2: Fill a tickers x keys x years array, one company at a time
+    values = np.full((len(companies), len(keys), len(years)), np.nan)
+    for i, co in enumerate(companies):
+        rows = []
+        row_years = []
+        for statement, location, name in keys:
+            statement_dict = co.statements.get(statement, dict())
+            rows.append(statement_dict.get(location, dict()).get(name))
+            row_years.append(statement_dict['statement']['year_adjusted'] if 'statement' in statement_dict.keys() else [])
+        values[i] = stack_rows(rows, row_years, years)
+
+    cube = dict(tickers = [company_label(co) for co in companies],
+                keys = keys,
+                years = years,
+                values = values,
+                currencies = [co.currency for co in companies])
+
+    return cube
+
+def stack_by_id(companies, statements = None, ids = None, years = None):
+    """
+    Stack statement rows of many company objects by canonical row id (see
+    modules.taxonomy). Each company's rows are placed with one integer-indexed
+    assignment per statement, not a lookup per name. Rows outside the
+    taxonomy are left out.
+
+    args:
+        companies: list of company objects.
+        statements: list of statements to include (is, bs, cfs). Default is all.
+        ids: optional list of row ids to keep, in order. Default is every
+        canonical row, in id order.
+        years: optional shared year axis. Default is every year in any company.
+
+    returns: cube dict (see module docstring) with an extra row_ids list,
+    aligned with keys.
+    """
+    years = get_universe_years(companies) if years == None else years
+    ids = [x for x in sorted(ROWS_BY_ID.keys()) if statements == None or ROWS_BY_ID[x]['statement'] in statements] if ids == None else ids
+
+    # id -> position on the keys axis. -1 for ids not being stacked.
+    slot_of = np.full(max(ROWS_BY_ID.keys()) + 1, -1)
+    slot_of[ids] = np.arange(len(ids))
+    year_positions = {x:i for i, x in enumerate(years)}
+
+    values = np.full((len(companies), len(ids), len(years)), np.nan)
+    for i, co in enumerate(companies):
+        for statement, statement_dict in co.statements.items():
+            if 'statement' not in statement_dict.keys() or (statements != None and statement not in statements):
+                continue
+            rows = statement_dict['statement']
+            row_ids = statement_dict.get('row_ids') or {k:ID_BY_NAME[k] for k in rows.keys() if k in ID_BY_NAME.keys()}
+            names = [k for k in row_ids.keys() if isinstance(rows.get(k), np.ndarray) and slot_of[row_ids[k]] >= 0]
+            if len(names) == 0:
+                continue
+
+            slots = slot_of[[row_ids[x] for x in names]]
+            keep = [j for j, x in enumerate(rows['year_adjusted']) if x in year_positions.keys()]
+            cols = [year_positions[rows['year_adjusted'][j]] for j in keep]
+            values[i][np.ix_(slots, cols)] = np.stack([rows[x] for x in names])[:, keep]
+
+    return dict(tickers = [company_label(co) for co in companies],
+                keys = [(ROWS_BY_ID[x]['statement'], 'statement', ROWS_BY_ID[x]['name']) for x in ids],
+                row_ids = list(ids),
+                years = years,
+                values = values,
+                currencies = [co.currency for co in companies])
+
+def aggregate_cube(cube):
+    """
+    Sum every company in a cube, the way company.__add__() sums a segment:
+    a year is kept only when every company covers it, and a value is NaN
+    when any company is missing it.
+
+    returns: tuple of (years, np array of keys x years).
+    """
+    totals = cube['values'].sum(axis = 0)
+    covered = ~np.all(np.isnan(cube['values']), axis = 1).any(axis = 0) if len(cube['tickers']) > 0 else np.zeros(len(cube['years']), dtype = bool)
+
+    return [x for x, k in zip(cube['years'], covered) if k], totals[:, covered]
+
+def cube_names(cube):
+    """
+    Return the row/metric names in a cube, in the order of its keys axis.
+    """
+    return [x[2] for x in cube['keys']]
+
+def cube_index(cube, name):
+    """
+    Return the position of a row or metric name on a cube's keys axis.
+    Raises KeyError when the cube doesn't hold that name.
+    """
+    names = cube_names(cube)
+    if name not in names:
+        raise KeyError('{} not found in cube. Available: {}'.format(name, ', '.join(names)))
+
+    return names.index(name)
@@ -0,0 +1,218 @@
+"""
+Accounting-integrity checks for scraped and saved statements.
+
+Scraping can mangle statements quietly. extract_row_name() is hyphen sensitive
+and dictify_statement()'s col_mode filter can drop rows, and we usually only
+notice when a ratio looks absurd in a plot.
+
+check_statements() sweeps many companies at once. Each identity below is
+evaluated for every company and year in a single array operation after the
+rows involved are stacked onto a shared year axis.
+
+company.save_statements() and the scrape pipeline run log_problems() on
+every statement they save, so a bad scrape is logged as a warning when it
+happens instead of when a plot looks wrong.
+
+Example:
+    report = check_statements(load_companies(calculate = False))
+    print(format_report(report))
+"""
+
+from modules.cleaning import stack_rows, company_label
+from modules.instrumentation import increment
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Identities that should hold on every statement, as
+# (statement, total row, [(sign, component row), ...]).
+IDENTITIES = [
+    ('bs', 'total_assets', [(1, 'total_liabilities_net_minority_interest'), (1, 'total_equity_gross_minority_interest')]),
+    ('is', 'gross_profit', [(1, 'total_revenue'), (-1, 'cost_of_revenue')]),
+    ('is', 'operating_income', [(1, 'gross_profit'), (-1, 'operating_expense')])
+]
+
+# Rows calculate_metrics() can't run without
+REQUIRED_ROWS = {
+    'is':['total_revenue','cost_of_revenue','gross_profit','operating_expense','operating_income',
+            'pretax_income','tax_provision','net_income','basic_average_shares','diluted_average_shares'],
+    'bs':['current_assets','current_liabilities','total_liabilities_net_minority_interest',
+            'total_equity_gross_minority_interest'],
+    'cfs':['operating_cash_flow']
+}
+
+def check_identity(companies, statement, total, components, tolerance = 0.01):
+    """
+    Check one accounting identity for many companies at once.
+
+    args:
+        companies: list of company objects.
+        statement: is, bs or cfs.
+        total: row that should equal the signed sum of components.
+        components: list of (sign, row) tuples.
+        tolerance: relative difference allowed, as a share of abs(total).
+
+    returns: dict mapping ticker to a list of (year, relative error) tuples
+    for every year the identity fails. Companies missing any involved row are
+    left out. check_required_rows() reports those.
+    """
+    # STEP 1: Only companies holding every row of the identity, one value per
+    # year, can be checked. check_year_order() reports rows with the wrong length.
+    rows = [total] + [x[1] for x in components]
+    checked = []
+    for co in companies:
+        if statement not in co.statements.keys():
+            continue
+        statement_dict = co.statements[statement]['statement']
+        if all(x in statement_dict.keys() and len(statement_dict[x]) == len(statement_dict['year_adjusted']) for x in rows):
+            checked.append(co)
+    if len(checked) == 0:
+        return dict()
+
+    row_years = [co.statements[statement]['statement']['year_adjusted'] for co in checked]
+    years = sorted(set().union(*row_years), reverse = True)
+
+    # STEP 2: Stack each involved row across companies into a companies x years array
+    totals = stack_rows([co.statements[statement]['statement'][total] for co in checked], row_years, years)
+    summed = np.zeros_like(totals)
+    for sign, row in components:
+        summed += sign * stack_rows([co.statements[statement]['statement'][row] for co in checked], row_years, years)
+
+    # STEP 3: Compare in one shot. NaN (year not reported) never fails.
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        error = np.abs(totals - summed) / np.maximum(np.abs(totals), 1)
+    failed = np.nan_to_num(error) > tolerance
+
+    failures = dict()
+    for i, j in zip(*np.nonzero(failed)):
+        failures.setdefault(company_label(checked[i]), []).append((years[j], error[i, j]))
+
+    return failures
+
+def check_year_order(companies, statements = None):
+    """
+    Check that every statement's year_adjusted runs strictly newest to oldest
+    with no repeats, and that every row has one value per year.
+
+    Year lists are stacked into one padded array so the ordering check is a
+    single np.diff over all statements.
+
+    args:
+        statements: optional list of statements (is, bs, cfs) to check.
+        Default is every statement.
+
+    returns: dict mapping ticker to a list of problem descriptions.
+    """
+    labels = []
+    year_lists = []
+    problems = dict()
+
+    for co in companies:
+        for key, statement in co.statements.items():
+            if 'statement' not in statement.keys() or (statements != None and key not in statements):
+                continue
+            statement_dict = statement['statement']
+            labels.append((company_label(co), key))
+            year_lists.append(statement_dict['year_adjusted'])
+
+            # Rows dropped or misaligned by the col_mode filter show up as length mismatches
+            bad_rows = [k for k, v in statement_dict.items() if isinstance(v, np.ndarray) and len(v) != len(statement_dict['year_adjusted'])]
+            if len(bad_rows) > 0:
+                problems.setdefault(company_label(co), []).append('{} rows with wrong year count: {}'.format(key, ', '.join(bad_rows)))
+
+    if len(year_lists) == 0:
+        return problems
+
+    width = max(len(x) for x in year_lists)
+    years = np.full((len(year_lists), width), np.nan)
+    for i, x in enumerate(year_lists):
+        years[i, :len(x)] = [float(y) for y in x]
+
+    with np.errstate(invalid = 'ignore'):
+        unordered = np.any(np.diff(years, axis = 1) >= 0, axis = 1)
+
+    for i in np.flatnonzero(unordered):
+        ticker, key = labels[i]
+        problems.setdefault(ticker, []).append('{} years not strictly descending: {}'.format(key, ', '.join(year_lists[i])))
+
+    return problems
+
+def check_required_rows(companies, required = REQUIRED_ROWS, statements = None):
+    """
+    List rows calculate_metrics() needs that a company's statements don't have.
+    statements optionally limits the check to some statements.
+
+    returns: dict mapping ticker to a list of problem descriptions.
+    """
+    problems = dict()
+    for co in companies:
+        for key, rows in required.items():
+            if key not in co.statements.keys() or 'statement' not in co.statements[key].keys() or (statements != None and key not in statements):
+                continue
+            missing = [x for x in rows if x not in co.statements[key]['statement'].keys()]
+            if len(missing) > 0:
+                problems.setdefault(company_label(co), []).append('{} missing rows: {}'.format(key, ', '.join(missing)))
+
+    return problems
+
+def check_statements(companies, tolerance = 0.01, statements = None):
+    """
+    Run every integrity check on many companies at once.
+
+    args:
+        companies: list of company objects (or a single company object).
+        tolerance: relative difference allowed on accounting identities.
+        statements: optional list of statements (is, bs, cfs) to check.
+        Default is every statement.
+
+    returns: dict mapping ticker to a list of problem descriptions. Tickers
+    that pass every check aren't included, so an empty dict means all clear.
+    """
+    companies = companies if isinstance(companies, list) else [companies]
+
+    report = check_required_rows(companies, statements = statements)
+    for ticker, problems in check_year_order(companies, statements).items():
+        report.setdefault(ticker, []).extend(problems)
+
+    for statement, total, components in IDENTITIES:
+        if statements != None and statement not in statements:
+            continue
+        failures = check_identity(companies, statement, total, components, tolerance)
+        for ticker, fails in failures.items():
+            worst = max(x[1] for x in fails)
+            report.setdefault(ticker, []).append('{} {} identity off in {} (worst {:.1%})'.format(
+                statement, total, ', '.join(x[0] for x in fails), worst))
+
+    return report
+
+def log_problems(companies, statements = None, tolerance = 0.01):
+    """
+    Run check_statements() and log every problem as a warning. Used on save
+    and scrape paths, which keep going when a statement looks wrong.
+
+    returns: the check_statements() report.
+    """
+    report = check_statements(companies, tolerance = tolerance, statements = statements)
+    for ticker, problems in report.items():
+        for problem in problems:
+            logger.warning('%s: %s', ticker, problem)
+    increment('validation_problems', sum(len(x) for x in report.values()))
+
+    return report
+
+def format_report(report):
+    """
+    Compact text version of a check_statements() report. One line per problem.
+    """
+    if len(report) == 0:
+        return 'All statements passed integrity checks.'
+
+    lines = ['{} tickers have problems:'.format(len(report))]
+    for ticker in sorted(report.keys()):
+        for problem in report[ticker]:
+            lines.append('{}: {}'.format(ticker, problem))
+
+    return '\n'.join(lines)
@@ -0,0 +1,30 @@
+from modules.refresh import refresh_universe
+from modules.instrumentation import write_run_summary, write_prometheus_file
+import argparse
+import logging
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Rescrape only the saved statements that could have new data on Yahoo Finance, merging new years into the saved files.')
+    parser.add_argument('tickers', type = str, nargs = '*', help = 'Optional ticker symbols to check. Default is every saved ticker.')
+    parser.add_argument('--filing-lag', type = int, default = 90, help = 'Days after fiscal year end before a new annual report is expected.')
+    parser.add_argument('--ttm-max-age', type = int, default = 100, help = 'Days before a statement with a ttm column is rescraped. 0 turns this off.')
+    parser.add_argument('--browsers', type = int, default = None, help = 'Scrape with modules.pipeline using this many browsers.')
+    parser.add_argument('--dry-run', action = 'store_true', help = 'Only list what is due.')
+    parser.add_argument('--log-level', type = str, default = 'INFO', help = 'DEBUG, INFO, WARNING or ERROR.')
+    parser.add_argument('--metrics-json', type = str, default = None, help = 'Optional path to write a JSON timing summary of this run to.')
+    parser.add_argument('--metrics-prom', type = str, default = None, help = 'Optional path to write Prometheus text format metrics to.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level = args.log_level.upper(), format = '%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    refresh_universe(tickers = args.tickers or None,
+                    filing_lag_days = args.filing_lag,
+                    ttm_max_age_days = args.ttm_max_age or None,
+                    dry_run = args.dry_run,
+                    browsers = args.browsers)
+
+    if args.metrics_json:
+        write_run_summary(args.metrics_json)
+
+    if args.metrics_prom:
+        write_prometheus_file(args.metrics_prom)
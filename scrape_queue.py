@@ -0,0 +1,55 @@
+from modules.jobqueue import sqlite_store, run_worker
+from modules.instrumentation import write_run_summary, write_prometheus_file
+from definitions import JOB_PATH
+from multiprocessing import Process
+import argparse
+import logging
+
+def start_worker(queue_file, log_level, **kwargs):
+    logging.basicConfig(level = log_level.upper(), format = '%(asctime)s %(levelname)s %(name)s: %(message)s')
+    run_worker(sqlite_store(queue_file), **kwargs)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Resumable scrape job queue. Add jobs once, then run workers on any number of processes or machines sharing the queue file.')
+    parser.add_argument('command', type = str, choices = ['add', 'work', 'status', 'retry-failed'], help = 'add queues tickers, work scrapes until the queue is empty, status counts jobs, retry-failed requeues failed jobs.')
+    parser.add_argument('tickers', type = str, nargs = '*', help = 'Ticker symbols to queue with add.')
+    parser.add_argument('--queue', type = str, default = JOB_PATH + 'jobs.sqlite', help = 'SQLite file holding the queue.')
+    parser.add_argument('--statements', type = str, default = 'is,bs,cfs', help = 'Comma separated statements to queue for each ticker.')
+    parser.add_argument('--workers', type = int, default = 1, help = 'Worker processes to run on this machine.')
+    parser.add_argument('--lease', type = int, default = 300, help = 'Seconds a job stays claimed without a heartbeat.')
+    parser.add_argument('--max-attempts', type = int, default = 3)
+    parser.add_argument('--merge', action = 'store_true', help = 'Merge new years into saved statements instead of replacing them.')
+    parser.add_argument('--log-level', type = str, default = 'INFO', help = 'DEBUG, INFO, WARNING or ERROR.')
+    parser.add_argument('--metrics-json', type = str, default = None, help = 'Optional path to write a JSON timing summary of this run to. Single worker only.')
+    parser.add_argument('--metrics-prom', type = str, default = None, help = 'Optional path to write Prometheus text format metrics to. Single worker only.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level = args.log_level.upper(), format = '%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    store = sqlite_store(args.queue)
+
+    if args.command == 'add':
+        added = store.add_jobs([(ticker, statement) for ticker in args.tickers for statement in args.statements.split(',')])
+        print('Added {} jobs.'.format(added))
+    elif args.command == 'work':
+        options = dict(lease_seconds = args.lease, heartbeat_seconds = max(args.lease // 5, 1), max_attempts = args.max_attempts, merge = args.merge)
+        if args.workers == 1:
+            run_worker(store, **options)
+        else:
+            workers = [Process(target = start_worker, args = (args.queue, args.log_level), kwargs = options) for i in range(args.workers)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+    elif args.command == 'retry-failed':
+        print('Requeued {} jobs.'.format(store.retry_failed()))
+
+    print(store.counts())
+    for failure in store.failures():
+        print('FAILED {} {} after {} attempts: {}'.format(*failure))
+
+    if args.metrics_json:
+        write_run_summary(args.metrics_json)
+
+    if args.metrics_prom:
+        write_prometheus_file(args.metrics_prom)